@@ -0,0 +1,130 @@
+"""Driver location ingestion benchmark: single POSTs vs JSON batches vs binary batches.
+
+Run while either stack is up (microservice gateway on 8000 or layered node on 8101).
+Reports updates/s and updates/s per server core for each mode. Against the microservice
+gateway it also reports gateway CPU per update and benchmarks the /drivers/stream
+WebSocket (needs the `websockets` package).
+"""
+import os, sys, json, time, random, asyncio
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from evaluation import detect_gateway, PICKUP_LAT, PICKUP_LON
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "layered-arch"))
+from layered.api import locwire  # noqa: E402  (same frame format as services/common/locwire.py)
+
+# ------------------ Config (no CLI needed) ------------------
+DRIVERS = 5000
+UPDATES = 20000
+BATCH_SIZES = [100, 500, 2000]
+CONCURRENCY = 8
+# Cores available to the stack under test; defaults to this machine (docker on localhost).
+SERVER_CORES = int(os.getenv("SERVER_CORES", os.cpu_count() or 1))
+
+
+def make_updates(n: int):
+    out = []
+    for _ in range(n):
+        d = f"bench_d{random.randrange(DRIVERS)}"
+        out.append((d, PICKUP_LAT + random.random() / 10, PICKUP_LON + random.random() / 10, True))
+    return out
+
+
+def gateway_stats(gw: str):
+    try:
+        r = requests.get(f"{gw}/drivers/stream/stats", timeout=5)
+        return r.json() if r.status_code == 200 else None
+    except requests.exceptions.RequestException:
+        return None
+
+
+def report(gw: str, label: str, total: int, failed: int, elapsed: float, before) -> dict:
+    ups = total / elapsed if elapsed > 0 else 0.0
+    row = {
+        "mode": label,
+        "updates": total,
+        "failed_requests": failed,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(ups, 1),
+        "updates_per_s_per_core": round(ups / SERVER_CORES, 1),
+    }
+    after = gateway_stats(gw) if before else None
+    if after:
+        row["gateway_cpu_us_per_update"] = round((after["cpu_s"] - before["cpu_s"]) * 1e6 / total, 2)
+    print(row)
+    return row
+
+
+def run(gw: str, label: str, chunks, send) -> dict:
+    session = requests.Session()
+    total = sum(len(c) for c in chunks)
+    before = gateway_stats(gw)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
+        failed = sum(1 for ok in ex.map(lambda c: send(session, c), chunks) if not ok)
+    return report(gw, label, total, failed, time.perf_counter() - t0, before)
+
+
+def run_stream(gw: str, updates, per_frame: int):
+    try:
+        import websockets
+    except ImportError:
+        print("stream mode skipped (pip install websockets)")
+        return None
+    url = gw.replace("http://", "ws://") + "/drivers/stream"
+    before = gateway_stats(gw)
+
+    async def one_conn(part):
+        async with websockets.connect(url) as ws:
+            for i in range(0, len(part), per_frame):
+                frame = [{"driver_id": d, "lat": lat, "lon": lon, "available": a}
+                         for d, lat, lon, a in part[i:i + per_frame]]
+                await ws.send(json.dumps(frame if per_frame > 1 else frame[0]))
+
+    async def all_conns():
+        parts = [updates[i::CONCURRENCY] for i in range(CONCURRENCY)]
+        await asyncio.gather(*(one_conn(p) for p in parts))
+
+    t0 = time.perf_counter()
+    asyncio.run(all_conns())
+    # Wait until the coalescer has drained everything it was sent.
+    while True:
+        stats = gateway_stats(gw)
+        if not stats or stats["received"] - before["received"] >= len(updates) and stats["buffered"] == 0:
+            break
+        time.sleep(0.01)
+    return report(gw, f"stream_{per_frame}_per_frame", len(updates), 0, time.perf_counter() - t0, before)
+
+
+def main():
+    gw, label = detect_gateway()
+    print(f"Detected: {label} at {gw} (server cores assumed: {SERVER_CORES})")
+    updates = make_updates(UPDATES)
+
+    def send_single(s, chunk):
+        d, lat, lon, avail = chunk[0]
+        return s.post(f"{gw}/drivers/location", json={"driver_id": d, "lat": lat, "lon": lon, "available": avail}).ok
+
+    def send_json(s, chunk):
+        body = {"updates": [{"driver_id": d, "lat": lat, "lon": lon, "available": a} for d, lat, lon, a in chunk]}
+        return s.post(f"{gw}/drivers/location/batch", json=body).ok
+
+    def send_binary(s, chunk):
+        return s.post(f"{gw}/drivers/location/batch", data=locwire.pack_updates(chunk),
+                      headers={"content-type": locwire.CONTENT_TYPE}).ok
+
+    # Single-update mode is slow; sample a slice so the run stays short.
+    single = updates[: max(1, UPDATES // 10)]
+    run(gw, "single", [[u] for u in single], send_single)
+    for size in BATCH_SIZES:
+        chunks = [updates[i:i + size] for i in range(0, len(updates), size)]
+        run(gw, f"json_batch_{size}", chunks, send_json)
+        run(gw, f"binary_batch_{size}", chunks, send_binary)
+    if gateway_stats(gw):
+        run_stream(gw, updates, 1)
+        run_stream(gw, updates, 50)
+
+
+if __name__ == "__main__":
+    main()
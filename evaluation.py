@@ -59,14 +59,17 @@ def detect_gateway() -> Tuple[str, str]:
             pass
     raise SystemExit("Could not detect a running gateway. Start microservice (8000) or layered (8101) first.")
 
+SEED_BATCH = 5000
+
 def seed_system(gw: str, drivers: int, lat0: float, lon0: float) -> None:
-    jpost(gw, "/auth/register", {"user_id": "r", "role": "rider"})
-    for i in range(drivers):
-        d = f"d{i}"
-        jpost(gw, "/auth/register", {"user_id": d, "role": "driver"})
-        lat = lat0 + random.random() / 100
-        lon = lon0 + random.random() / 100
-        jpost(gw, "/drivers/location", {"driver_id": d, "lat": lat, "lon": lon, "available": True})
+    # Batch endpoints: one request (and one Redis round trip) per SEED_BATCH users
+    users = [{"user_id": "r", "role": "rider"}] + [{"user_id": f"d{i}", "role": "driver"} for i in range(drivers)]
+    for i in range(0, len(users), SEED_BATCH):
+        jpost(gw, "/auth/register/batch", {"users": users[i:i + SEED_BATCH]})
+    updates = [{"driver_id": f"d{i}", "lat": lat0 + random.random() / 100, "lon": lon0 + random.random() / 100,
+                "available": True} for i in range(drivers)]
+    for i in range(0, len(updates), SEED_BATCH):
+        jpost(gw, "/drivers/location/batch", {"updates": updates[i:i + SEED_BATCH]})
 
 # ------------------ Bench core ------------------
 def ride_cycle(gw: str, lat: float, lon: float):
@@ -0,0 +1,106 @@
+# bench_data_layer.py  (needs a local Redis it may flush; starts its own node)
+# Runs one layered node with DATA_LAYER=sync and then =async and drives the same
+# request mix at each concurrency level: driver location pings, ride lookups, ride
+# history pages and logins. Reports requests/s and p50/p95 latency per level.
+import os, sys, time, random, asyncio, statistics, subprocess
+
+import httpx
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from layered.common.history import record  # noqa: E402
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/15")
+PORT = 8199
+DRIVERS = 5000
+RIDERS = 5000
+RIDES = 50_000
+CONCURRENCY = [20, 100, 500]
+REQUESTS = 5000          # per concurrency level
+MIX = [("location", 0.5), ("ride", 0.3), ("history", 0.1), ("login", 0.1)]
+
+
+def seed(r):
+    r.flushdb()
+    pipe = r.pipeline(transaction=False)
+    for i in range(DRIVERS):
+        pipe.hset(f"user:d{i}", "role", "driver")
+    for i in range(RIDERS):
+        pipe.hset(f"user:r{i}", "role", "rider")
+    for ride_id in range(1, RIDES + 1):
+        rider, driver = f"r{ride_id % RIDERS}", f"d{ride_id % DRIVERS}"
+        pipe.hset(f"ride:{ride_id}", mapping={"rider_id": rider, "driver_id": driver, "status": "completed",
+                                             "pickup_lat": 32.7, "pickup_lon": -97.1,
+                                             "dest_lat": 32.8, "dest_lon": -97.2})
+        record(pipe, ride_id, rider, driver, ride_id)
+        if ride_id % 5000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def call(c, rnd):
+    op = rnd.choices([name for name, _ in MIX], [w for _, w in MIX])[0]
+    base = f"http://localhost:{PORT}"
+    if op == "location":
+        return c.post(f"{base}/drivers/location", json={"driver_id": f"d{rnd.randrange(DRIVERS)}",
+                                                        "lat": 32.7 + rnd.random() / 10,
+                                                        "lon": -97.1 - rnd.random() / 10})
+    if op == "ride":
+        return c.get(f"{base}/rides/{rnd.randint(1, RIDES)}")
+    if op == "history":
+        return c.get(f"{base}/riders/r{rnd.randrange(RIDERS)}/rides", params={"limit": 10})
+    return c.post(f"{base}/auth/login", json={"user_id": f"r{rnd.randrange(RIDERS)}"})
+
+
+async def fire(concurrency: int) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    rnd = random.Random(concurrency)
+    lat, codes = [], {}
+
+    async def one(c):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                code = (await call(c, rnd)).status_code
+            except httpx.HTTPError as e:
+                # Dropped or refused connections count against the layer, not the bench
+                code = type(e).__name__
+            lat.append((time.perf_counter() - t0) * 1000.0)
+            codes[code] = codes.get(code, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as c:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(c) for _ in range(REQUESTS)))
+        elapsed = time.perf_counter() - t0
+    lat.sort()
+    return {"concurrency": concurrency, "req_per_s": round(REQUESTS / elapsed, 1),
+            "p50_ms": round(statistics.median(lat), 2), "p95_ms": round(lat[int(0.95 * len(lat))], 2),
+            "codes": codes}
+
+
+def run(layer: str):
+    env = {**os.environ, "REDIS_URL": REDIS_URL, "DATA_LAYER": layer, "NODE_ID": "bench",
+           "ARCHIVE_DIR": os.getenv("ARCHIVE_DIR", "/tmp/bench-ride-archive")}
+    node = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "layered.main:app", "--port", str(PORT), "--log-level", "warning"],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"http://localhost:{PORT}/health")
+                break
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        for concurrency in CONCURRENCY:
+            print({"data_layer": layer, **asyncio.run(fire(concurrency))})
+    finally:
+        node.terminate()
+        node.wait()
+
+
+if __name__ == "__main__":
+    seed(redis.from_url(REDIS_URL, decode_responses=True))
+    for layer in ("sync", "async"):
+        run(layer)
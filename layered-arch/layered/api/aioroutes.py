@@ -0,0 +1,103 @@
+"""Async handlers for the hot routes, served when DATA_LAYER=async.
+
+Same paths, models and status codes as routes.py. Routes not redefined here
+(registration and the root route) keep their sync handlers, so `router` below is a
+complete replacement for routes.router.
+"""
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from layered.api import routes
+from layered.api.routes import DriverLocation, Login, RideReq, UserIds, location_updates, require_user, require_users
+from layered.common import tokens
+from layered.common.history import MAX_PAGE
+from layered.service import aiocore
+
+router = APIRouter()
+
+@router.post("/auth/users/exists")
+async def users_exist(p: UserIds):
+    try:
+        return {"exists": await aiocore.users_exist(p.user_ids)}
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+@router.post("/auth/login")
+async def login(p: Login):
+    try:
+        token = await aiocore.login_user(p.user_id)
+        return {"token": token, "expires_in": tokens.TTL_S}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.get("/me/{user_id}")
+async def me(user_id: str):
+    data = await aiocore.get_user(user_id)
+    if not data:
+        raise HTTPException(status_code=404, detail="user not found")
+    return {"user_id": user_id, **data}
+
+@router.post("/drivers/location")
+async def loc(p: DriverLocation, authorization: str = Header(None)):
+    require_user(authorization, p.driver_id, "driver")
+    await aiocore.update_driver_location(p.driver_id, p.lat, p.lon, p.available)
+    return {"ok": True}
+
+@router.post("/drivers/location/batch")
+async def loc_batch(request: Request, authorization: str = Header(None)):
+    updates, rejected = await location_updates(request)
+    require_users(authorization, [u[0] for u in updates], "driver")
+    applied = await aiocore.update_driver_locations(updates)
+    return {"ok": True, "received": len(updates) + len(rejected), "applied": applied, "rejected": rejected}
+
+@router.post("/rides/request")
+async def ride(p: RideReq, authorization: str = Header(None)):
+    require_user(authorization, p.rider_id, "rider")
+    try:
+        return await aiocore.request_ride(p.rider_id, p.pickup_lat, p.pickup_lon, p.dest_lat, p.dest_lon)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.get("/rides/{ride_id}")
+async def get_ride(ride_id: int):
+    data = await aiocore.get_ride(ride_id)
+    if not data:
+        raise HTTPException(status_code=404, detail="ride not found")
+    return {"ride_id": ride_id, **data}
+
+@router.get("/riders/{rider_id}/rides")
+async def rider_rides(rider_id: str, cursor: str = None, limit: int = Query(20, ge=1, le=MAX_PAGE)):
+    try:
+        return await aiocore.ride_history("rider", rider_id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/drivers/{driver_id}/rides")
+async def driver_rides(driver_id: str, cursor: str = None, limit: int = Query(20, ge=1, le=MAX_PAGE)):
+    try:
+        return await aiocore.ride_history("driver", driver_id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _trip(call, ride_id: int):
+    try:
+        return await call(ride_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.post("/trips/{ride_id}/start")
+async def start(ride_id: int):
+    return await _trip(aiocore.start_trip, ride_id)
+
+@router.post("/trips/{ride_id}/cancel")
+async def cancel(ride_id: int):
+    return await _trip(aiocore.cancel_trip, ride_id)
+
+@router.post("/trips/{ride_id}/complete")
+async def complete(ride_id: int):
+    return await _trip(aiocore.complete_trip, ride_id)
+
+# Everything else keeps its sync handler
+_served = {(route.path, method) for route in router.routes for method in route.methods}
+router.routes.extend(route for route in routes.router.routes
+                     if not any((route.path, method) in _served for method in route.methods))
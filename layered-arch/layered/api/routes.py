@@ -1,5 +1,9 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from typing import Any, Dict, List
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+from layered.common import locwire, tokens
+from layered.common.history import MAX_PAGE
 from layered.service import core
 
 router = APIRouter()
@@ -8,15 +12,25 @@ class Register(BaseModel):
     user_id: str
     role: str
 
+class RegisterBatch(BaseModel):
+    users: List[Register]
+
 class Login(BaseModel):
     user_id: str
 
+class UserIds(BaseModel):
+    user_ids: List[str]
+
 class DriverLocation(BaseModel):
     driver_id: str
-    lat: float
-    lon: float
+    lat: float = Field(ge=-locwire.MAX_LAT, le=locwire.MAX_LAT)
+    lon: float = Field(ge=-locwire.MAX_LON, le=locwire.MAX_LON)
     available: bool = True
 
+class LocationBatch(BaseModel):
+    # Records are validated one by one so one bad record doesn't sink the batch
+    updates: List[Dict[str, Any]]
+
 class RideReq(BaseModel):
     rider_id: str
     pickup_lat: float
@@ -24,6 +38,23 @@ class RideReq(BaseModel):
     dest_lat: float
     dest_lon: float
 
+def require_user(authorization, user_id: str, role: str):
+    try:
+        core.authorize(authorization, user_id, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+def require_users(authorization, user_ids, role: str):
+    # Batches: every id must be the token's subject, unless it is a service token
+    try:
+        core.authorize_many(authorization, user_ids, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
 @router.get("/")
 def root():
     return {"ok": True}
@@ -38,21 +69,74 @@ def register(p: Register):
     except KeyError as e:
         raise HTTPException(status_code=409, detail=str(e))
 
+@router.post("/auth/register/batch")
+def register_batch(p: RegisterBatch):
+    try:
+        return core.register_users([(u.user_id, u.role) for u in p.users])
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+@router.post("/auth/users/exists")
+def users_exist(p: UserIds):
+    try:
+        return {"exists": core.users_exist(p.user_ids)}
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
 @router.post("/auth/login")
 def login(p: Login):
     try:
         token = core.login_user(p.user_id)
-        return {"token": token}
+        return {"token": token, "expires_in": tokens.TTL_S}
     except KeyError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+@router.get("/me/{user_id}")
+def me(user_id: str):
+    data = core.get_user(user_id)
+    if not data:
+        raise HTTPException(status_code=404, detail="user not found")
+    return {"user_id": user_id, **data}
+
 @router.post("/drivers/location")
-def loc(p: DriverLocation):
+def loc(p: DriverLocation, authorization: str = Header(None)):
+    require_user(authorization, p.driver_id, "driver")
     core.update_driver_location(p.driver_id, p.lat, p.lon, p.available)
     return {"ok": True}
 
+async def location_updates(request: Request):
+    """(updates, rejected) from JSON {"updates": [...]} or a binary locwire frame.
+
+    updates are (driver_id, lat, lon, available) tuples; records out of range are left
+    out and described in rejected instead of failing the batch.
+    """
+    body = await request.body()
+    updates, rejected = [], []
+    try:
+        if request.headers.get("content-type", "").startswith(locwire.CONTENT_TYPE):
+            return locwire.unpack_updates(body, rejected), rejected
+        for i, item in enumerate(LocationBatch.model_validate_json(body).updates):
+            try:
+                u = DriverLocation.model_validate(item)
+            except ValidationError as e:
+                err = e.errors()[0]
+                rejected.append(locwire.rejection(i, item.get("driver_id"), f"{err['loc'][0]}: {err['msg']}"))
+                continue
+            updates.append((u.driver_id, u.lat, u.lon, u.available))
+        return updates, rejected
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/drivers/location/batch")
+async def loc_batch(request: Request, authorization: str = Header(None)):
+    updates, rejected = await location_updates(request)
+    require_users(authorization, [u[0] for u in updates], "driver")
+    applied = await run_in_threadpool(core.update_driver_locations, updates)
+    return {"ok": True, "received": len(updates) + len(rejected), "applied": applied, "rejected": rejected}
+
 @router.post("/rides/request")
-def ride(p: RideReq):
+def ride(p: RideReq, authorization: str = Header(None)):
+    require_user(authorization, p.rider_id, "rider")
     try:
         return core.request_ride(p.rider_id, p.pickup_lat, p.pickup_lon, p.dest_lat, p.dest_lon)
     except LookupError as e:
@@ -66,12 +150,38 @@ def get_ride(ride_id: int):
         raise HTTPException(status_code=404, detail="ride not found")
     return {"ride_id": ride_id, **data}
 
+@router.get("/riders/{rider_id}/rides")
+def rider_rides(rider_id: str, cursor: str = None, limit: int = Query(20, ge=1, le=MAX_PAGE)):
+    # Newest first; pass next_cursor back as ?cursor= for the following page
+    try:
+        return core.ride_history("rider", rider_id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/drivers/{driver_id}/rides")
+def driver_rides(driver_id: str, cursor: str = None, limit: int = Query(20, ge=1, le=MAX_PAGE)):
+    try:
+        return core.ride_history("driver", driver_id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @router.post("/trips/{ride_id}/start")
 def start(ride_id: int):
     try:
         return core.start_trip(ride_id)
     except LookupError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.post("/trips/{ride_id}/cancel")
+def cancel(ride_id: int):
+    try:
+        return core.cancel_trip(ride_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 @router.post("/trips/{ride_id}/complete")
 def complete(ride_id: int):
@@ -79,3 +189,5 @@ def complete(ride_id: int):
         return core.complete_trip(ride_id)
     except LookupError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
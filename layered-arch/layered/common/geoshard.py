@@ -0,0 +1,289 @@
+"""Region-sharded driver geo index.
+
+Drivers are partitioned by a coarse lat/lon grid cell and every cell is its own geo key,
+``drivers:geo:{<lat_idx>:<lon_idx>}``. With several shard URLs the cells are spread
+client-side across standalone Redis instances (crc32 of the cell). Searches fan out to
+every cell the search circle touches, wrapping at the antimeridian, and merge the hits by
+distance.
+
+This spreads the GEOADD/GEOSEARCH work and keeps each sorted set small. It does not
+remove the shared keys: per-driver bookkeeping stays in single keys on the primary,
+``drivers:cell`` (driver -> current cell), ``drivers:seen`` and ``drivers:available``,
+and every update and reap goes through them. It is not Redis Cluster safe either. When
+all cells live on the primary, the Lua scripts below clear cell keys they cannot declare
+in KEYS: which cell a driver left is only known inside the script.
+"""
+import asyncio
+import math
+import zlib
+
+import redis
+import redis.asyncio as aioredis
+
+DEFAULT_CELL_DEG = 0.5
+CELLS_KEY = "drivers:cell"
+SEEN_KEY = "drivers:seen"
+AVAILABLE_KEY = "drivers:available"
+KM_PER_DEG = 111.32
+
+# KEYS[1] = drivers:cell, ARGV = drop flag, driver, cell, driver, cell, ...
+# Records each driver's new cell and returns the previous one ('' if none). With the
+# drop flag set (every cell lives on this instance) it also removes the driver from the
+# cell it left, which saves the caller a second round trip. That cell key is not in
+# KEYS, so this mode is for standalone Redis only.
+_SWAP_CELLS = """
+local old = {}
+for i = 2, #ARGV, 2 do
+  local prev = redis.call('HGET', KEYS[1], ARGV[i]) or ''
+  if ARGV[1] == '1' and prev ~= '' and prev ~= ARGV[i + 1] then
+    redis.call('ZREM', 'drivers:geo:{' .. prev .. '}', ARGV[i])
+  end
+  old[#old + 1] = prev
+  redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return old
+"""
+
+# KEYS = drivers:seen, drivers:available, drivers:cell; ARGV = cutoff, batch size, drop flag.
+# Takes up to a batch of drivers last seen at or before the cutoff, forgets them on the
+# primary and returns a flat [driver, cell, ...] list so the caller can clear the cells
+# (already done here when the drop flag is set, as in _SWAP_CELLS).
+_REAP_STALE = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #ids == 0 then return {} end
+local cells = redis.call('HMGET', KEYS[3], unpack(ids))
+redis.call('SREM', KEYS[2], unpack(ids))
+redis.call('ZREM', KEYS[1], unpack(ids))
+redis.call('HDEL', KEYS[3], unpack(ids))
+local out = {}
+for i, id in ipairs(ids) do
+  out[#out + 1] = id
+  out[#out + 1] = cells[i] or ''
+  if ARGV[3] == '1' and cells[i] then redis.call('ZREM', 'drivers:geo:{' .. cells[i] .. '}', id) end
+end
+return out
+"""
+
+
+def split_urls(value: str):
+    """Parse a comma separated GEO_SHARD_URLS value."""
+    return [u.strip() for u in (value or "").split(",") if u.strip()]
+
+
+def wrap_lon(lon: float) -> float:
+    """Longitude in [-180, 180)."""
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def cell_of(lat: float, lon: float, cell_deg: float = DEFAULT_CELL_DEG) -> str:
+    return f"{math.floor(lat / cell_deg)}:{math.floor(wrap_lon(lon) / cell_deg)}"
+
+
+def geo_key(cell: str) -> str:
+    return "drivers:geo:{" + cell + "}"
+
+
+def cells_for_radius(lat: float, lon: float, radius_km: float, cell_deg: float = DEFAULT_CELL_DEG):
+    """All cells intersecting the bounding box of the search circle."""
+    dlat = radius_km / KM_PER_DEG
+    dlon = radius_km / (KM_PER_DEG * max(math.cos(math.radians(lat)), 0.01))
+    i0, i1 = math.floor((lat - dlat) / cell_deg), math.floor((lat + dlat) / cell_deg)
+    # Longitude spans, split where the box crosses the antimeridian
+    west = wrap_lon(lon - dlon)
+    east = west + 2 * dlon
+    if 2 * dlon >= 360:
+        spans = [(-180.0, 180.0)]
+    elif east > 180:
+        spans = [(west, 180.0), (-180.0, east - 360)]
+    else:
+        spans = [(west, east)]
+    # 180 itself belongs to -180's cell, so a span ending there stops just short of it
+    cols = dict.fromkeys(j for lo, hi in spans
+                         for j in range(math.floor(lo / cell_deg),
+                                        math.floor(min(hi, math.nextafter(180.0, 0.0)) / cell_deg) + 1))
+    return [f"{i}:{j}" for i in range(i0, i1 + 1) for j in cols]
+
+
+class ShardedGeoIndex:
+    def __init__(self, primary, shard_urls=(), cell_deg: float = DEFAULT_CELL_DEG):
+        self.primary = primary
+        self.shards = [redis.from_url(u, decode_responses=True) for u in shard_urls] or [primary]
+        self.cell_deg = cell_deg
+        # Cells all on the primary: the scripts clear left-behind cells themselves
+        self.local_cells = len(self.shards) == 1 and self.shards[0] is primary
+        self._swap_cells = primary.register_script(_SWAP_CELLS)
+        self._reap_stale = primary.register_script(_REAP_STALE)
+
+    def shard_for(self, cell: str):
+        return self.shards[zlib.crc32(cell.encode()) % len(self.shards)]
+
+    def _pipelines(self):
+        # One non-transactional pipeline per distinct client, in first-use order.
+        pipes = {}
+
+        def get(client):
+            if id(client) not in pipes:
+                pipes[id(client)] = client.pipeline(transaction=False)
+            return pipes[id(client)]
+        return pipes, get
+
+    def _queue_update(self, updates, now: float):
+        latest = {u[0]: u for u in updates}
+        cells, by_cell, avail, busy, swap = {}, {}, [], [], []
+        for driver_id, lat, lon, available in latest.values():
+            cell = cells[driver_id] = cell_of(lat, lon, self.cell_deg)
+            by_cell.setdefault(cell, []).extend((lon, lat, driver_id))
+            (avail if available else busy).append(driver_id)
+            swap += (driver_id, cell)
+
+        pipes, get = self._pipelines()
+        primary = get(self.primary)  # first, so results[0] holds the swap reply
+        # A bare EVALSHA: a pipeline holding a Script would first spend a round trip on
+        # SCRIPT EXISTS. update() loads the script and retries if Redis lost it.
+        primary.evalsha(self._swap_cells.sha, 1, CELLS_KEY, int(self.local_cells), *swap)
+        primary.zadd(SEEN_KEY, {d: now for d in latest})
+        if avail:
+            primary.sadd(AVAILABLE_KEY, *avail)
+        if busy:
+            primary.srem(AVAILABLE_KEY, *busy)
+        for cell, geo in by_cell.items():
+            get(self.shard_for(cell)).geoadd(geo_key(cell), geo)
+        return latest, cells, pipes
+
+    def _moved(self, latest, cells, old_cells):
+        """Drivers still listed in the cell they left, by that cell."""
+        if self.local_cells:
+            return {}
+        moved = {}
+        for driver_id, old in zip(latest, old_cells):
+            if old and old != cells[driver_id]:
+                moved.setdefault(old, []).append(driver_id)
+        return moved
+
+    def update(self, updates, now: float) -> int:
+        """Index (driver_id, lat, lon, available) tuples; the last update per driver wins.
+
+        One pipeline per shard, sent together. With several shards a driver who changed
+        cells costs a follow-up to drop them from the old one; on a single instance the
+        swap script does that, so an update is always one round trip.
+        """
+        if not updates:
+            return 0
+        try:
+            return self._update(updates, now)
+        except redis.exceptions.NoScriptError:
+            # Script cache flushed (Redis restarted); every queued command is idempotent
+            self.primary.script_load(_SWAP_CELLS)
+            return self._update(updates, now)
+
+    def _update(self, updates, now: float) -> int:
+        latest, cells, pipes = self._queue_update(updates, now)
+        results = [p.execute() for p in pipes.values()]
+        self._remove_from_cells(self._moved(latest, cells, results[0][0]))
+        return len(latest)
+
+    def _queue_remove(self, by_cell):
+        pipes, get = self._pipelines()
+        for cell, ids in by_cell.items():
+            get(self.shard_for(cell)).zrem(geo_key(cell), *ids)
+        return pipes
+
+    def _remove_from_cells(self, by_cell):
+        if not by_cell:
+            return
+        for p in self._queue_remove(by_cell).values():
+            p.execute()
+
+    def _queue_search(self, lat: float, lon: float, radius_km: float, count: int, available_only: bool = False):
+        pipes, get = self._pipelines()
+        if available_only:
+            get(self.primary).smembers(AVAILABLE_KEY)  # first, so results[0][0] holds it
+        for cell in cells_for_radius(lat, lon, radius_km, self.cell_deg):
+            get(self.shard_for(cell)).execute_command(
+                "GEOSEARCH", geo_key(cell), "FROMLONLAT", lon, lat,
+                "BYRADIUS", radius_km, "km", "ASC", "COUNT", count, "WITHDIST"
+            )
+        return pipes
+
+    @staticmethod
+    def _nearest(results, count: int, available_only: bool = False):
+        avail = None
+        if available_only:
+            avail = set(results[0][0])
+            results = [results[0][1:]] + list(results[1:])
+        hits = []
+        for replies in results:
+            for rows in replies:
+                hits += [(float(dist), member) for member, dist in rows]
+        hits.sort()
+        out, seen = [], set()
+        for _, member in hits:
+            if member not in seen:
+                seen.add(member)
+                out.append(member)
+        return [member for member in out[:count] if avail is None or member in avail]
+
+    def search(self, lat: float, lon: float, radius_km: float, count: int, available_only: bool = False):
+        """Nearest `count` driver ids within the radius, closest first.
+
+        available_only drops the ones not in drivers:available, read in the same round trip.
+        """
+        pipes = self._queue_search(lat, lon, radius_km, count, available_only)
+        return self._nearest([p.execute() for p in pipes.values()], count, available_only)
+
+    def reap(self, cutoff: float, batch: int):
+        """Remove up to `batch` drivers last seen at or before `cutoff`; returns their ids."""
+        flat = self._reap_stale(keys=[SEEN_KEY, AVAILABLE_KEY, CELLS_KEY],
+                                args=[cutoff, batch, int(self.local_cells)])
+        ids = flat[0::2]
+        if not self.local_cells:
+            by_cell = {}
+            for driver_id, cell in zip(ids, flat[1::2]):
+                if cell:
+                    by_cell.setdefault(cell, []).append(driver_id)
+            self._remove_from_cells(by_cell)
+        return ids
+
+    def sizes(self) -> dict:
+        pipe = self.primary.pipeline(transaction=False)
+        pipe.hlen(CELLS_KEY)
+        pipe.scard(AVAILABLE_KEY)
+        pipe.zcard(SEEN_KEY)
+        geo, avail, seen = pipe.execute()
+        return {"drivers_geo_size": geo, "drivers_available_size": avail, "drivers_seen_size": seen}
+
+
+class AsyncShardedGeoIndex(ShardedGeoIndex):
+    """The same index over redis.asyncio clients, for the async data layer.
+
+    update() and search() are coroutines that run the per-shard pipelines concurrently;
+    reap() and sizes() stay with the sync index used by the background reaper.
+    """
+    def __init__(self, primary, shard_urls=(), cell_deg: float = DEFAULT_CELL_DEG):
+        self.primary = primary
+        self.shards = [aioredis.from_url(u, decode_responses=True) for u in shard_urls] or [primary]
+        self.cell_deg = cell_deg
+        self.local_cells = len(self.shards) == 1 and self.shards[0] is primary
+        self._swap_cells = primary.register_script(_SWAP_CELLS)
+
+    async def update(self, updates, now: float) -> int:
+        if not updates:
+            return 0
+        try:
+            return await self._update(updates, now)
+        except redis.exceptions.NoScriptError:
+            await self.primary.script_load(_SWAP_CELLS)
+            return await self._update(updates, now)
+
+    async def _update(self, updates, now: float) -> int:
+        latest, cells, pipes = self._queue_update(updates, now)
+        results = await asyncio.gather(*(p.execute() for p in pipes.values()))
+        moved = self._moved(latest, cells, results[0][0])
+        if moved:
+            await asyncio.gather(*(p.execute() for p in self._queue_remove(moved).values()))
+        return len(latest)
+
+    async def search(self, lat: float, lon: float, radius_km: float, count: int, available_only: bool = False):
+        pipes = self._queue_search(lat, lon, radius_km, count, available_only)
+        results = await asyncio.gather(*(p.execute() for p in pipes.values()))
+        return self._nearest(results, count, available_only)
@@ -0,0 +1,116 @@
+"""Bounded LRU/TTL read-through cache for Redis hashes, invalidated over pub/sub.
+
+Writers publish the changed key on ``cache:invalidate`` (the ride transition script
+does it in the same call that changes the status), and every process holding a
+ReadCache drops its copy. Loads race with invalidations: a value read from Redis is
+only stored if no invalidation for its key arrived while it was being read. While the
+subscription is down, the cache is emptied and bypassed, so a missed message can't
+leave stale entries; ttl_s bounds staleness for anything else.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+CHANNEL = "cache:invalidate"
+
+
+class ReadCache:
+    def __init__(self, r, max_entries: int = 100_000, ttl_s: float = 30, channel: str = CHANNEL):
+        self.r = r
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.channel = channel
+        self.enabled = max_entries > 0
+        self.ready = False
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._loading = {}  # key -> token of the load in progress
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "cache_invalidations": 0, "cache_bypassed": 0}
+
+    def start(self):
+        if self.enabled:
+            threading.Thread(target=self._follow, daemon=True).start()
+
+    def _follow(self):
+        while True:
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.ready = True
+                for msg in pubsub.listen():
+                    self.invalidate(msg["data"].split("\n"))
+            except redis.RedisError as e:
+                self.ready = False
+                self.clear()
+                print(f"[ReadCache] Invalidation feed lost, cache off until it is back: {e}")
+                time.sleep(1)
+
+    def get(self, key: str, load):
+        """Cached value for `key`, else load() (stored unless empty or invalidated meanwhile)."""
+        hit, value, token = self._lookup(key)
+        if hit:
+            return value
+        value = load()
+        self._store(key, token, value)
+        return value
+
+    async def aget(self, key: str, load):
+        """get() for the async data layer; `load` is a coroutine function."""
+        hit, value, token = self._lookup(key)
+        if hit:
+            return value
+        value = await load()
+        self._store(key, token, value)
+        return value
+
+    def _lookup(self, key: str):
+        """(hit, value, load token); a None token means don't store what gets loaded."""
+        if not (self.enabled and self.ready):
+            self.stats["cache_bypassed"] += 1
+            return False, None, None
+        token = object()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return True, entry[0], None
+            self.stats["cache_misses"] += 1
+            self._loading[key] = token
+        return False, None, token
+
+    def _store(self, key: str, token, value):
+        if token is None:
+            return
+        with self._lock:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                if value:
+                    self._entries[key] = (value, time.time() + self.ttl_s)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._loading.pop(key, None)
+                self.stats["cache_invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+
+    def publish(self, client, keys):
+        """Queue an invalidation of `keys` for every process on `client`."""
+        if keys:
+            client.publish(self.channel, "\n".join(keys))
+
+    def snapshot(self) -> dict:
+        looked_up = self.stats["cache_hits"] + self.stats["cache_misses"]
+        return {**self.stats, "cache_size": len(self._entries), "cache_ready": self.ready,
+                "cache_hit_rate": round(self.stats["cache_hits"] / looked_up, 4) if looked_up else 0.0}
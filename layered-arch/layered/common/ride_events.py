@@ -0,0 +1,89 @@
+"""Ride lifecycle events on a Redis stream, plus a consumer-group reader.
+
+Every ride state change (matched, ongoing, completed) is appended to ``rides:events``
+on the same pipeline as the HSET that makes it, so producers pay no extra round trip.
+Downstream systems read the stream through a consumer group in batches and ack each
+batch with one XACK. Delivery is at-least-once; consumers should treat events as
+idempotent (the same ride can report the same status twice).
+"""
+import os
+import time
+
+import redis
+
+STREAM_KEY = "rides:events"
+# Approximate cap on the stream; consumers that fall further behind lose events.
+MAXLEN = int(os.getenv("RIDE_EVENTS_MAXLEN", "1000000"))
+
+
+def append(client, ride_id, status: str, **fields):
+    """Queue one event on `client` (normally the pipeline carrying the state change)."""
+    event = {"ride_id": str(ride_id), "status": status, "ts": f"{time.time():.3f}"}
+    event.update((k, str(v)) for k, v in fields.items() if v is not None)
+    client.xadd(STREAM_KEY, event, maxlen=MAXLEN, approximate=True)
+
+
+class RideEventConsumer:
+    """
+    group:    consumer group name, one per downstream system
+    consumer: this process's name inside the group
+    count:    events per XREADGROUP
+    block_ms: how long read() waits for new events before returning an empty batch
+    """
+    def __init__(self, r, group: str, consumer: str, count: int = 500, block_ms: int = 1000,
+                 stream: str = STREAM_KEY):
+        self.r = r
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.block_ms = block_ms
+        self.stream = stream
+        # Re-deliver what this consumer read but never acked before reading new events.
+        self._backlog = True
+
+    def ensure_group(self, start_id: str = "0"):
+        """Create the group if needed; "0" replays the whole stream, "$" only new events."""
+        try:
+            self.r.xgroup_create(self.stream, self.group, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self) -> list:
+        """Next batch of (event_id, fields)."""
+        while self._backlog:
+            entries, n = self._read("0", None)
+            if entries:
+                return entries
+            # A batch of trimmed entries only (now acked) may have more pending behind it;
+            # the backlog is done once the pending list comes back empty.
+            self._backlog = n > 0
+        return self._read(">", self.block_ms)[0]
+
+    def _read(self, start: str, block):
+        """(entries with fields, number of entries the reply held)."""
+        resp = self.r.xreadgroup(self.group, self.consumer, {self.stream: start}, count=self.count, block=block)
+        entries = resp[0][1] if resp else []
+        # Pending entries trimmed from the stream come back without fields; drop them.
+        gone = [eid for eid, fields in entries if not fields]
+        if gone:
+            self.ack(gone)
+        return [(eid, fields) for eid, fields in entries if fields], len(entries)
+
+    def ack(self, ids):
+        if ids:
+            self.r.xack(self.stream, self.group, *ids)
+
+    def claim_stale(self, min_idle_ms: int = 60000) -> list:
+        """Take over events another consumer read but did not ack within `min_idle_ms`."""
+        resp = self.r.xautoclaim(self.stream, self.group, self.consumer, min_idle_ms, "0-0", count=self.count)
+        return [(eid, fields) for eid, fields in resp[1] if fields]
+
+    def run(self, handler, stop=lambda: False):
+        """Call handler(batch) for every batch and ack it once the handler returns."""
+        self.ensure_group()
+        while not stop():
+            batch = self.read()
+            if batch:
+                handler(batch)
+                self.ack([eid for eid, _ in batch])
@@ -0,0 +1,90 @@
+"""Ride state machine with server-side compare-and-set transitions.
+
+    matched -> ongoing -> completed
+    matched | ongoing -> cancelled
+
+A transition is one Lua call. It checks the current status, sets the new one, appends
+the event to ``rides:events`` and optionally returns the driver to the available set,
+all in one round trip. Closed rides are also listed in ``rides:closed`` for the
+archiver. Asking for the state the ride is already in succeeds without changing
+anything, so retries are safe. Rides in either ridecodec layout are handled and keep
+their layout. Every change is published on ``cache:invalidate`` so read caches drop
+the ride.
+"""
+import time
+
+from . import ride_events
+from .readcache import CHANNEL as INVALIDATE_CHANNEL
+from .ridecodec import STATUSES
+
+# Closed (completed or cancelled) rides by close time; the archiver drains it.
+CLOSED_KEY = "rides:closed"
+TERMINAL = ("completed", "cancelled")
+
+TRANSITIONS = {
+    "ongoing": ("matched",),
+    "completed": ("ongoing",),
+    "cancelled": ("matched", "ongoing"),
+}
+
+# KEYS: ride hash, events stream, available drivers, closed rides
+# ARGV: ride id, target status, allowed current statuses (comma separated),
+#       free driver (1/0), event timestamp, stream maxlen, terminal (1/0),
+#       cache invalidation channel
+# Returns {outcome, status, driver_id}; outcome is ok, same, missing or conflict.
+_TRANSITION = """
+local NAMES = {%s}
+local cur = redis.call('HMGET', KEYS[1], 'status', 'driver_id', 's', 'd')
+local field, status, driver, value = 'status', cur[1], cur[2] or '', ARGV[2]
+if not status and cur[3] then
+  -- compact layout: status is an index into NAMES
+  field, status, driver = 's', NAMES[tonumber(cur[3]) + 1], cur[4] or ''
+  for i, name in ipairs(NAMES) do
+    if name == ARGV[2] then value = tostring(i - 1) end
+  end
+end
+if not status then return {'missing', '', ''} end
+if status == ARGV[2] then return {'same', status, driver} end
+if not string.find(',' .. ARGV[3] .. ',', ',' .. status .. ',', 1, true) then
+  return {'conflict', status, driver}
+end
+redis.call('HSET', KEYS[1], field, value)
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[6], '*',
+           'ride_id', ARGV[1], 'status', ARGV[2], 'ts', ARGV[5], 'driver_id', driver)
+if ARGV[4] == '1' and driver ~= '' then redis.call('SADD', KEYS[3], driver) end
+if ARGV[7] == '1' then redis.call('ZADD', KEYS[4], ARGV[5], ARGV[1]) end
+redis.call('PUBLISH', ARGV[8], KEYS[1])
+return {'ok', ARGV[2], driver}
+""" % ", ".join(f"'{name}'" for name in STATUSES)
+
+
+class RideStateMachine:
+    def __init__(self, r):
+        self.r = r
+        self._transition = r.register_script(_TRANSITION)
+
+    def transition(self, ride_id, to: str, free_driver: bool = False, client=None):
+        """Move a ride to `to`. Returns {"outcome", "status", "driver_id"}.
+
+        With a pipeline as `client` the call is queued and the result comes from its
+        execute() (see parse()).
+        """
+        res = self._transition(
+            keys=[f"ride:{ride_id}", ride_events.STREAM_KEY, "drivers:available", CLOSED_KEY],
+            args=[str(ride_id), to, ",".join(TRANSITIONS[to]), int(free_driver), f"{time.time():.3f}",
+                  ride_events.MAXLEN, int(to in TERMINAL), INVALIDATE_CHANNEL],
+            client=client,
+        )
+        return res if client is not None else self.parse(res)
+
+    @staticmethod
+    def parse(res) -> dict:
+        outcome, status, driver_id = res
+        return {"outcome": outcome, "status": status or None, "driver_id": driver_id or None}
+
+
+class AsyncRideStateMachine(RideStateMachine):
+    """The same script on a redis.asyncio client; transition() is a coroutine."""
+    async def transition(self, ride_id, to: str, free_driver: bool = False, client=None):
+        res = await RideStateMachine.transition(self, ride_id, to, free_driver, client=client or self.r)
+        return res if client is not None else self.parse(res)
@@ -0,0 +1,113 @@
+"""Stateless signed access tokens.
+
+    base64url(JSON claims) "." base64url(HMAC-SHA256(secret, claims part))
+
+Claims are sub (user id), role, iat and exp. Any process holding AUTH_TOKEN_SECRET
+verifies a token locally in a few microseconds; nothing is looked up in Redis. The
+flip side: a token stays valid until it expires, so keep AUTH_TOKEN_TTL_S short.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+DEV_SECRET = "dev-only-secret"
+SECRET = os.getenv("AUTH_TOKEN_SECRET", DEV_SECRET)
+TTL_S = int(os.getenv("AUTH_TOKEN_TTL_S", "3600"))
+# When set, requests acting for a user must carry a token for that user
+REQUIRED = os.getenv("AUTH_REQUIRED", "false").lower() in ("1", "true", "yes")
+
+# Anyone who knows the secret can mint service tokens, which act for every driver.
+if REQUIRED and SECRET in ("", DEV_SECRET):
+    raise RuntimeError("AUTH_REQUIRED is on but AUTH_TOKEN_SECRET is empty or the development default; "
+                       "set a secret of your own")
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(body: str, secret: str) -> str:
+    return _b64(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest())
+
+
+def issue(user_id: str, role: str, ttl_s: int = None, secret: str = None, now: float = None) -> str:
+    now = int(now if now is not None else time.time())
+    claims = {"sub": user_id, "role": role, "iat": now, "exp": now + (ttl_s or TTL_S)}
+    body = _b64(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{body}.{_sign(body, secret or SECRET)}"
+
+
+def verify(token: str, secret: str = None, now: float = None) -> dict:
+    """Claims of a valid, unexpired token; raises InvalidToken otherwise."""
+    try:
+        body, sig = token.split(".")
+    except (AttributeError, ValueError):
+        raise InvalidToken("malformed token")
+    if not hmac.compare_digest(sig, _sign(body, secret or SECRET)):
+        raise InvalidToken("bad signature")
+    try:
+        claims = json.loads(_unb64(body))
+    except ValueError:
+        raise InvalidToken("malformed token")
+    if claims.get("exp", 0) <= (now if now is not None else time.time()):
+        raise InvalidToken("token expired")
+    return claims
+
+
+def bearer(authorization: str) -> str:
+    """Token from an "Authorization: Bearer <token>" header value, or None."""
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    return None
+
+
+# Tokens for other services and fleet aggregators, which report positions for many
+# drivers. Only a holder of AUTH_TOKEN_SECRET can mint one: login issues the user's
+# registered role, and registration accepts only rider and driver.
+SERVICE_ROLE = "service"
+
+
+def _claims(authorization: str, required: bool = None):
+    token = bearer(authorization)
+    if token is None:
+        if REQUIRED if required is None else required:
+            raise InvalidToken("missing bearer token")
+        return None
+    return verify(token)
+
+
+def authorize(authorization: str, user_id: str, role: str, required: bool = None) -> dict:
+    """Check that the request may act as `user_id` with `role`.
+
+    Returns the claims, or None when no token was sent and tokens are not required.
+    Raises PermissionError when the token is valid but for someone else.
+    """
+    claims = _claims(authorization, required)
+    if claims is not None and (claims["sub"] != user_id or claims["role"] != role):
+        raise PermissionError(f"token is for {claims['role']} {claims['sub']}")
+    return claims
+
+
+def authorize_many(authorization: str, user_ids, role: str, required: bool = None) -> dict:
+    """authorize() for a request acting for several users, such as a location batch.
+
+    A `role` token covers only its own subject, so every id must be that subject; a
+    SERVICE_ROLE token covers anyone.
+    """
+    claims = _claims(authorization, required)
+    if claims is None or claims["role"] == SERVICE_ROLE:
+        return claims
+    if claims["role"] != role or any(u != claims["sub"] for u in user_ids):
+        raise PermissionError(f"token is for {claims['role']} {claims['sub']}")
+    return claims
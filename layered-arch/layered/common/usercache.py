@@ -0,0 +1,191 @@
+"""In-process user directory: Bloom filter for "no such user", TTL cache for roles.
+
+Every process keeps a Bloom filter of all user ids, filled by a SCAN of ``user:*`` at
+start and kept current through the ``users:registered`` channel, which registration
+publishes to in the same pipeline as its HSETNX. A lookup for an id the filter has
+never seen is answered locally, so floods of bogus ids never reach Redis. Known users'
+roles sit in a small LRU with a TTL, so repeat logins skip Redis too.
+
+Until the first scan finishes, and again after the subscription drops, the filter is
+not trusted and lookups go to Redis. A user registered elsewhere can read as missing
+for the moment it takes the publish to arrive.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+CHANNEL = "users:registered"
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.m = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def add(self, item: str):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+
+class UserDirectory:
+    """
+    capacity / error_rate: Bloom filter sizing; more users than capacity only raises the
+                           false-positive rate (extra Redis lookups), never drops users
+    ttl_s / max_entries:   positive cache of user roles
+    """
+    def __init__(self, r, capacity: int = 1_000_000, error_rate: float = 0.01,
+                 ttl_s: float = 300, max_entries: int = 100_000):
+        self.r = r
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.ready = False
+        self._lock = threading.Lock()
+        self._roles = OrderedDict()  # user_id -> (role, expires_at)
+        self.stats = {"user_lookups": 0, "user_bloom_rejects": 0, "user_cache_hits": 0, "user_redis_lookups": 0}
+
+    # --- sync -------------------------------------------------------------
+    def start(self):
+        threading.Thread(target=self._follow, daemon=True).start()
+
+    def _follow(self):
+        while True:
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                # Subscribe before scanning so nothing registered during the scan is missed
+                pubsub.subscribe(CHANNEL)
+                self._warm()
+                for msg in pubsub.listen():
+                    self.added(msg["data"].split("\n"))
+            except redis.RedisError as e:
+                self.ready = False
+                print(f"[UserDirectory] Sync lost, rescanning: {e}")
+                time.sleep(1)
+
+    def _warm(self):
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        for key in self.r.scan_iter(match="user:*", count=10000):
+            bloom.add(key[5:])
+        with self._lock:
+            # Ids published while scanning went into the old filter; carry them over
+            merged = int.from_bytes(bloom.bits, "little") | int.from_bytes(self.bloom.bits, "little")
+            bloom.bits = bytearray(merged.to_bytes(len(bloom.bits), "little"))
+            self.bloom = bloom
+            self.ready = True
+
+    def added(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                if user_id:
+                    self.bloom.add(user_id)
+
+    def publish(self, client, user_ids):
+        """Queue the announcement of new users on `client` (the registration pipeline).
+
+        Ids that turn out to exist already are announced too; that is harmless.
+        """
+        if user_ids:
+            client.publish(CHANNEL, "\n".join(user_ids))
+
+    def registered(self, users):
+        """(user_id, role) pairs this process just created; known here before the publish echoes back."""
+        self.added([user_id for user_id, _ in users])
+        for user_id, role in users:
+            self._remember(user_id, role)
+
+    # --- lookups ------------------------------------------------------------
+    def _cached(self, user_id: str):
+        with self._lock:
+            entry = self._roles.get(user_id)
+            if entry and entry[1] > time.time():
+                self._roles.move_to_end(user_id)
+                return entry[0]
+            return None
+
+    def _remember(self, user_id: str, role: str):
+        with self._lock:
+            self._roles[user_id] = (role, time.time() + self.ttl_s)
+            self._roles.move_to_end(user_id)
+            while len(self._roles) > self.max_entries:
+                self._roles.popitem(last=False)
+
+    def _rejects(self, user_id: str) -> bool:
+        self.stats["user_lookups"] += 1
+        if self.ready and user_id not in self.bloom:
+            self.stats["user_bloom_rejects"] += 1
+            return True
+        return False
+
+    def local_role(self, user_id: str):
+        """(settled, role): settled is False when only Redis can tell."""
+        if self._rejects(user_id):
+            return True, None
+        role = self._cached(user_id)
+        if role is not None:
+            self.stats["user_cache_hits"] += 1
+            return True, role
+        self.stats["user_redis_lookups"] += 1
+        return False, None
+
+    def loaded(self, user_id: str, role):
+        """Record a role read from Redis after local_role() could not settle it."""
+        if role is not None:
+            self._remember(user_id, role)
+        return role
+
+    def role(self, user_id: str):
+        """The user's role, or None if there is no such user."""
+        settled, role = self.local_role(user_id)
+        if settled:
+            return role
+        return self.loaded(user_id, self.r.hget(f"user:{user_id}", "role"))
+
+    def exists(self, user_id: str) -> bool:
+        return self.role(user_id) is not None
+
+    def local_exists(self, user_ids):
+        """(answers, unsettled): existence per id where known locally, and indexes left for Redis."""
+        out, ask = [None] * len(user_ids), []
+        for i, user_id in enumerate(user_ids):
+            settled, role = self.local_role(user_id)
+            if settled:
+                out[i] = role is not None
+            else:
+                ask.append(i)
+        return out, ask
+
+    def exist_many(self, user_ids) -> list:
+        """Existence of each id; only ids the filter and cache cannot settle go to Redis, in one pipeline."""
+        out, ask = self.local_exists(user_ids)
+        if ask:
+            pipe = self.r.pipeline(transaction=False)
+            for i in ask:
+                pipe.exists(f"user:{user_ids[i]}")
+            for i, n in zip(ask, pipe.execute()):
+                out[i] = bool(n)
+        return out
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["user_lookups"] or 1
+        return {**self.stats,
+                "user_local_hit_rate": round((self.stats["user_bloom_rejects"] + self.stats["user_cache_hits"]) / lookups, 4),
+                "user_bloom_ready": self.ready, "user_bloom_items": self.bloom.count,
+                "user_role_cache_size": len(self._roles)}
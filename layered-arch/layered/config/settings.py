@@ -2,10 +2,36 @@ import os
 from functools import lru_cache
 from pydantic import BaseModel
 import redis
+import redis.asyncio as aioredis
 
 class Settings(BaseModel):
     redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
     node_id: str = os.getenv("NODE_ID", "node-local")
+    driver_ttl_s: float = float(os.getenv("DRIVER_TTL_S", "120"))
+    reap_interval_s: float = float(os.getenv("REAP_INTERVAL_S", "10"))
+    reap_batch: int = int(os.getenv("REAP_BATCH", "500"))
+    geo_shard_urls: str = os.getenv("GEO_SHARD_URLS", "")
+    geo_cell_deg: float = float(os.getenv("GEO_CELL_DEG", "0.5"))
+    # In-process user directory: Bloom filter of user ids plus a TTL'd role cache
+    user_bloom_capacity: int = int(os.getenv("USER_BLOOM_CAPACITY", "1000000"))
+    user_bloom_error_rate: float = float(os.getenv("USER_BLOOM_ERROR_RATE", "0.01"))
+    user_cache_ttl_s: float = float(os.getenv("USER_CACHE_TTL_S", "300"))
+    # Read-through cache of ride and user hashes; read_cache_max=0 turns it off
+    read_cache_max: int = int(os.getenv("READ_CACHE_MAX", "100000"))
+    read_cache_ttl_s: float = float(os.getenv("READ_CACHE_TTL_S", "30"))
+    register_batch_max: int = int(os.getenv("REGISTER_BATCH_MAX", "10000"))
+    # Modules shared with the microservice design (layered/common) read their own
+    # variables: AUTH_TOKEN_SECRET, AUTH_TOKEN_TTL_S, AUTH_REQUIRED, RIDE_ID_MODE,
+    # RIDE_ID_BLOCK, RIDE_ENCODING and RIDE_EVENTS_MAXLEN.
+    # Closed rides move to segment files after archive_after_s; archive_dir must be
+    # shared by all nodes so any node can serve archived rides.
+    archive_dir: str = os.getenv("ARCHIVE_DIR", "/data/ride-archive")
+    archive_after_s: float = float(os.getenv("ARCHIVE_AFTER_S", "3600"))
+    archive_interval_s: float = float(os.getenv("ARCHIVE_INTERVAL_S", "60"))
+    archive_batch: int = int(os.getenv("ARCHIVE_BATCH", "10000"))
+    # "sync" (redis-py in FastAPI's threadpool) or "async" (redis.asyncio on the event loop)
+    # for the hot routes; see api/aioroutes.py
+    data_layer: str = os.getenv("DATA_LAYER", "sync")
 
 @lru_cache
 def get_settings() -> Settings:
@@ -14,3 +40,8 @@ def get_settings() -> Settings:
 @lru_cache
 def get_redis():
     return redis.from_url(get_settings().redis_url, decode_responses=True)
+
+@lru_cache
+def get_aioredis():
+    return aioredis.from_url(get_settings().redis_url, decode_responses=True)
+
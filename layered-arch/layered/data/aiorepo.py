@@ -0,0 +1,89 @@
+"""The hot paths of repo.py on redis.asyncio, for DATA_LAYER=async.
+
+Same keys, scripts and pipelines as the sync repo, awaited on the event loop instead
+of holding a threadpool thread per request. The in-process pieces are shared with
+repo.py: user directory, read cache, ride id allocator and archive. Their background
+threads (pub/sub followers, reaper, archiver) keep using the sync client, and the calls
+that still block (a ride id block refill, archive file reads) run in a worker thread.
+"""
+import asyncio
+import time
+from layered.common import ride_events, ridecodec
+from layered.common.geoshard import AsyncShardedGeoIndex, split_urls
+from layered.common.history import AsyncRideHistory, record
+from layered.common.ridestate import AsyncRideStateMachine
+from layered.config.settings import get_aioredis, get_settings
+from layered.data import repo
+
+r = get_aioredis()
+geo = AsyncShardedGeoIndex(r, split_urls(get_settings().geo_shard_urls), get_settings().geo_cell_deg)
+rides = AsyncRideStateMachine(r)
+history = AsyncRideHistory(r, repo.archive)
+
+# Users
+async def get_user_role(user_id: str):
+    settled, role = repo.users.local_role(user_id)
+    if settled:
+        return role
+    return repo.users.loaded(user_id, await r.hget(f"user:{user_id}", "role"))
+
+async def users_exist(user_ids) -> list:
+    out, ask = repo.users.local_exists(user_ids)
+    if ask:
+        pipe = r.pipeline(transaction=False)
+        for i in ask:
+            pipe.exists(f"user:{user_ids[i]}")
+        for i, n in zip(ask, await pipe.execute()):
+            out[i] = bool(n)
+    return out
+
+async def get_user(user_id: str):
+    return await repo.cache.aget(f"user:{user_id}", lambda: r.hgetall(f"user:{user_id}"))
+
+# Drivers geo + availability
+async def set_driver_locations(updates) -> int:
+    return await geo.update(updates, time.time())
+
+async def nearby_drivers(lat: float, lon: float, radius_km: float = 10, count: int = 1):
+    return await geo.search(lat, lon, radius_km, count, available_only=True)
+
+# Rides
+async def new_ride(rider_id: str, driver_id: str, pickup_lat: float, pickup_lon: float, dest_lat: float, dest_lon: float) -> int:
+    # Block leases and snowflake ids don't touch Redis per ride; only a refill (or
+    # RIDE_ID_MODE=incr) needs the sync client, off the loop
+    ride_id = repo.ids.take()
+    if ride_id is None:
+        ride_id = await asyncio.to_thread(repo.ids.next)
+    pipe = r.pipeline()
+    pipe.hset(f"ride:{ride_id}", mapping=ridecodec.encode({
+        "rider_id": rider_id,
+        "driver_id": driver_id,
+        "status": "matched",
+        "pickup_lat": pickup_lat,
+        "pickup_lon": pickup_lon,
+        "dest_lat": dest_lat,
+        "dest_lon": dest_lon,
+    }))
+    pipe.srem("drivers:available", driver_id)
+    record(pipe, ride_id, rider_id, driver_id, time.time())
+    ride_events.append(pipe, ride_id, "matched", rider_id=rider_id, driver_id=driver_id)
+    await pipe.execute()
+    return ride_id
+
+async def get_ride(ride_id: int):
+    async def load():
+        return ridecodec.decode(await r.hgetall(f"ride:{ride_id}"))
+    data = await repo.cache.aget(f"ride:{ride_id}", load)
+    if not data:
+        data = await asyncio.to_thread(repo.archive.get, ride_id)
+        if data is not None:
+            data["archived"] = True
+    return data
+
+async def ride_history(role: str, user_id: str, cursor, limit: int):
+    return await history.page(role, user_id, cursor, limit)
+
+async def transition_ride(ride_id: int, status: str, free_driver: bool = False) -> dict:
+    res = await rides.transition(ride_id, status, free_driver)
+    repo.cache.invalidate([f"ride:{ride_id}"])
+    return res
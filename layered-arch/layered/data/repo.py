@@ -1,37 +1,87 @@
-from layered.config.settings import get_redis
+import time
+from layered.common import ride_events, ridecodec
+from layered.common.archive import SegmentArchive, archive_closed
+from layered.common.geoshard import ShardedGeoIndex, split_urls
+from layered.common.history import RideHistory, record
+from layered.common.idalloc import ride_ids
+from layered.common.readcache import ReadCache
+from layered.common.ridestate import RideStateMachine
+from layered.common.usercache import UserDirectory
+from layered.config.settings import get_redis, get_settings
 
 r = get_redis()
+geo = ShardedGeoIndex(r, split_urls(get_settings().geo_shard_urls), get_settings().geo_cell_deg)
+rides = RideStateMachine(r)
+archive = SegmentArchive(get_settings().archive_dir)
+history = RideHistory(r, archive)
+ids = ride_ids(r, get_settings().node_id)
+# Ride and user reads; every node drops entries on the transition script's invalidations
+cache = ReadCache(r, get_settings().read_cache_max, get_settings().read_cache_ttl_s)
+users = UserDirectory(r, get_settings().user_bloom_capacity, get_settings().user_bloom_error_rate,
+                      get_settings().user_cache_ttl_s)
 
 # Users
+# Existence and role checks go through the user directory and mostly stay in-process
 def user_exists(user_id: str) -> bool:
-    return r.exists(f"user:{user_id}") == 1
+    return users.exists(user_id)
 
-def create_user(user_id: str, role: str):
-    r.hset(f"user:{user_id}", mapping={"role": role})
+def create_user(user_id: str, role: str) -> bool:
+    """Create-if-absent; False if the user already exists."""
+    return create_users([(user_id, role)])[0]
+
+def create_users(new_users) -> list:
+    """(user_id, role) pairs in one pipeline of HSETNX; True per user created.
+
+    The same pipeline announces the ids to every node's user directory.
+    """
+    pipe = r.pipeline(transaction=False)
+    for user_id, role in new_users:
+        pipe.hsetnx(f"user:{user_id}", "role", role)
+    users.publish(pipe, [user_id for user_id, _ in new_users])
+    created = [bool(n) for n in pipe.execute()[:len(new_users)]]
+    users.registered([user for user, ok in zip(new_users, created) if ok])
+    return created
+
+def users_exist(user_ids) -> list:
+    return users.exist_many(user_ids)
 
 def get_user(user_id: str):
-    return r.hgetall(f"user:{user_id}")
+    return cache.get(f"user:{user_id}", lambda: r.hgetall(f"user:{user_id}"))
+
+def get_user_role(user_id: str):
+    return users.role(user_id)
+
+def user_directory_stats() -> dict:
+    return users.snapshot()
+
+def read_cache_stats() -> dict:
+    return cache.snapshot()
 
 # Drivers geo + availability
 def set_driver_location(driver_id: str, lat: float, lon: float, available: bool):
-    r.geoadd("drivers:geo", (lon, lat, driver_id))
-    if available:
-        r.sadd("drivers:available", driver_id)
-    else:
-        r.srem("drivers:available", driver_id)
+    set_driver_locations([(driver_id, lat, lon, available)])
+
+def set_driver_locations(updates) -> int:
+    """Index (driver_id, lat, lon, available) tuples; one pipeline per geo shard."""
+    return geo.update(updates, time.time())
+
+def reap_stale_drivers(cutoff: float, batch: int) -> list:
+    return geo.reap(cutoff, batch)
+
+def driver_index_sizes() -> dict:
+    return geo.sizes()
 
 def nearby_drivers(lat: float, lon: float, radius_km: float = 10, count: int = 1):
-    ids = r.execute_command(
-        "GEOSEARCH", "drivers:geo", "FROMLONLAT", lon, lat, "BYRADIUS", radius_km, "km", "ASC", "COUNT", count
-    )
-    avail = set(r.smembers("drivers:available"))
-    return [d for d in ids if d in avail]
+    # Geo search and availability in one round trip
+    return geo.search(lat, lon, radius_km, count, available_only=True)
 
 # Rides
 def new_ride(rider_id: str, driver_id: str, pickup_lat: float, pickup_lon: float, dest_lat: float, dest_lon: float) -> int:
-    ride_id = r.incr("seq:ride")
+    ride_id = ids.next()
     key = f"ride:{ride_id}"
-    r.hset(key, mapping={
+    # Ride, driver reservation, history indexes and the "matched" event in one round trip
+    pipe = r.pipeline()
+    pipe.hset(key, mapping=ridecodec.encode({
         "rider_id": rider_id,
         "driver_id": driver_id,
         "status": "matched",
@@ -39,15 +89,32 @@ def new_ride(rider_id: str, driver_id: str, pickup_lat: float, pickup_lon: float
         "pickup_lon": pickup_lon,
         "dest_lat": dest_lat,
         "dest_lon": dest_lon,
-    })
-    r.srem("drivers:available", driver_id)
+    }))
+    pipe.srem("drivers:available", driver_id)
+    record(pipe, ride_id, rider_id, driver_id, time.time())
+    ride_events.append(pipe, ride_id, "matched", rider_id=rider_id, driver_id=driver_id)
+    pipe.execute()
     return ride_id
 
 def get_ride(ride_id: int):
-    return r.hgetall(f"ride:{ride_id}")
+    data = cache.get(f"ride:{ride_id}", lambda: ridecodec.decode(r.hgetall(f"ride:{ride_id}")))
+    if not data:
+        # Closed long enough ago to have been archived?
+        data = archive.get(ride_id)
+        if data is not None:
+            data["archived"] = True
+    return data
+
+def ride_history(role: str, user_id: str, cursor, limit: int):
+    """(rides, next_cursor), newest first; O(page size) however long the history is."""
+    return history.page(role, user_id, cursor, limit)
 
-def set_ride_status(ride_id: int, status: str):
-    r.hset(f"ride:{ride_id}", mapping={"status": status})
+def archive_closed_rides(older_than_s: float, batch: int) -> int:
+    return archive_closed(r, get_settings().archive_dir, older_than_s, batch)
 
-def free_driver(driver_id: str):
-    r.sadd("drivers:available", driver_id)
+def transition_ride(ride_id: int, status: str, free_driver: bool = False) -> dict:
+    """Compare-and-set status change, event and optional driver release in one round trip."""
+    res = rides.transition(ride_id, status, free_driver)
+    # Other nodes hear it from the script's publish; don't wait for the echo here
+    cache.invalidate([f"ride:{ride_id}"])
+    return res
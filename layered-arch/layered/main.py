@@ -1,10 +1,44 @@
+import threading
+import time
 from fastapi import FastAPI
-from layered.api.routes import router
+from layered.api import aioroutes, routes
 from layered.config.settings import get_settings
+from layered.service import core
 
 app = FastAPI(title="Layered Ride-Sharing (HTTP)")
-app.include_router(router)
+app.include_router(aioroutes.router if get_settings().data_layer == "async" else routes.router)
 
 @app.get("/health")
 def health():
     return {"status": "ok", "node": get_settings().node_id}
+
+@app.get("/metrics")
+def metrics():
+    return {"node": get_settings().node_id, **core.driver_index_metrics(), **core.user_directory_metrics(),
+            **core.read_cache_metrics()}
+
+def reap_loop():
+    while True:
+        time.sleep(get_settings().reap_interval_s)
+        try:
+            n = core.reap_stale_drivers()
+            if n:
+                print(f"[{get_settings().node_id}] Reaped {n} stale drivers")
+        except Exception as e:
+            print(f"[{get_settings().node_id}] Reaper failed: {e}")
+
+def archive_loop():
+    while True:
+        time.sleep(get_settings().archive_interval_s)
+        try:
+            n = core.archive_closed_rides()
+            if n:
+                print(f"[{get_settings().node_id}] Archived {n} closed rides")
+        except Exception as e:
+            print(f"[{get_settings().node_id}] Archiver failed: {e}")
+
+@app.on_event("startup")
+def startup_event():
+    core.start_caches()
+    threading.Thread(target=reap_loop, daemon=True).start()
+    threading.Thread(target=archive_loop, daemon=True).start()
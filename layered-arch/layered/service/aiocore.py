@@ -0,0 +1,59 @@
+"""Coroutine versions of the hot service calls in core.py, over data/aiorepo.py.
+
+Validation and error mapping are core.py's; only the data access is awaited.
+"""
+from layered.common import tokens
+from layered.config.settings import get_settings
+from layered.data import aiorepo
+from layered.service import core
+
+# Auth
+async def users_exist(user_ids) -> dict:
+    if len(user_ids) > get_settings().register_batch_max:
+        raise ValueError(f"at most {get_settings().register_batch_max} user ids per request")
+    return dict(zip(user_ids, await aiorepo.users_exist(user_ids)))
+
+async def login_user(user_id: str) -> str:
+    role = await aiorepo.get_user_role(user_id)
+    if role is None:
+        raise KeyError("user not found")
+    return tokens.issue(user_id, role)
+
+async def get_user(user_id: str) -> dict:
+    return await aiorepo.get_user(user_id)
+
+# Location
+async def update_driver_location(driver_id: str, lat: float, lon: float, available: bool = True):
+    await aiorepo.set_driver_locations([(driver_id, lat, lon, available)])
+
+async def update_driver_locations(updates) -> int:
+    return await aiorepo.set_driver_locations(updates)
+
+# Matching
+async def request_ride(rider_id: str, pickup_lat: float, pickup_lon: float, dest_lat: float, dest_lon: float) -> dict:
+    drivers = await aiorepo.nearby_drivers(pickup_lat, pickup_lon, 10, 1)
+    if not drivers:
+        raise LookupError("no drivers available")
+    driver_id = drivers[0]
+    ride_id = await aiorepo.new_ride(rider_id, driver_id, pickup_lat, pickup_lon, dest_lat, dest_lon)
+    return {"ride_id": ride_id, "driver_id": driver_id, "status": "matched"}
+
+# Trips
+async def get_ride(ride_id: int):
+    return await aiorepo.get_ride(ride_id)
+
+async def ride_history(role: str, user_id: str, cursor=None, limit: int = 20) -> dict:
+    rides, next_cursor = await aiorepo.ride_history(role, user_id, cursor, limit)
+    return {"rides": rides, "next_cursor": next_cursor}
+
+async def _transition(ride_id: int, status: str, free_driver: bool = False) -> dict:
+    return core.transition_result(ride_id, status, await aiorepo.transition_ride(ride_id, status, free_driver))
+
+async def start_trip(ride_id: int) -> dict:
+    return await _transition(ride_id, "ongoing")
+
+async def complete_trip(ride_id: int) -> dict:
+    return await _transition(ride_id, "completed", free_driver=True)
+
+async def cancel_trip(ride_id: int) -> dict:
+    return await _transition(ride_id, "cancelled", free_driver=True)
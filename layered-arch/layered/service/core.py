@@ -1,22 +1,96 @@
+import time
+from layered.common import tokens
+from layered.config.settings import get_settings
 from layered.data import repo
 
+reaper_stats = {"drivers_reaped": 0, "reap_runs": 0}
+ROLES = {"rider", "driver"}
+
 # Auth
 def register_user(user_id: str, role: str):
-    if role not in {"rider", "driver"}:
+    if role not in ROLES:
         raise ValueError("role must be rider or driver")
-    if repo.user_exists(user_id):
+    if not repo.create_user(user_id, role):
         raise KeyError("user exists")
-    repo.create_user(user_id, role)
+
+def register_users(users) -> dict:
+    """Register (user_id, role) pairs in one round trip; conflicts are reported, not raised."""
+    if len(users) > get_settings().register_batch_max:
+        raise ValueError(f"at most {get_settings().register_batch_max} users per batch")
+    valid = [(user_id, role) for user_id, role in users if role in ROLES]
+    created = repo.create_users(valid)
+    return {
+        "created": sum(created),
+        "conflicts": [user_id for (user_id, _), ok in zip(valid, created) if not ok],
+        "invalid": [user_id for user_id, role in users if role not in ROLES],
+    }
+
+def users_exist(user_ids) -> dict:
+    if len(user_ids) > get_settings().register_batch_max:
+        raise ValueError(f"at most {get_settings().register_batch_max} user ids per request")
+    return dict(zip(user_ids, repo.users_exist(user_ids)))
 
 def login_user(user_id: str) -> str:
-    if not repo.user_exists(user_id):
+    role = repo.get_user_role(user_id)
+    if role is None:
         raise KeyError("user not found")
-    return user_id  # trivial token
+    # Signed token; any node verifies it without touching Redis
+    return tokens.issue(user_id, role)
+
+def get_user(user_id: str) -> dict:
+    return repo.get_user(user_id)
+
+def authorize(authorization: str, user_id: str, role: str):
+    """Raises tokens.InvalidToken (bad or missing token) or PermissionError (someone else's)."""
+    return tokens.authorize(authorization, user_id, role)
+
+def authorize_many(authorization: str, user_ids, role: str):
+    """authorize() for every one of user_ids; a service token covers anyone."""
+    return tokens.authorize_many(authorization, user_ids, role)
 
 # Location
 def update_driver_location(driver_id: str, lat: float, lon: float, available: bool = True):
     repo.set_driver_location(driver_id, lat, lon, available)
 
+def update_driver_locations(updates) -> int:
+    return repo.set_driver_locations(updates)
+
+def reap_stale_drivers() -> int:
+    s = get_settings()
+    cutoff = time.time() - s.driver_ttl_s
+    total = 0
+    while True:
+        ids = repo.reap_stale_drivers(cutoff, s.reap_batch)
+        total += len(ids)
+        if len(ids) < s.reap_batch:
+            break
+    reaper_stats["drivers_reaped"] += total
+    reaper_stats["reap_runs"] += 1
+    return total
+
+def archive_closed_rides() -> int:
+    s = get_settings()
+    total = 0
+    # Keep going while full batches are waiting
+    while True:
+        n = repo.archive_closed_rides(s.archive_after_s, s.archive_batch)
+        total += n
+        if n < s.archive_batch:
+            return total
+
+def driver_index_metrics() -> dict:
+    return {**repo.driver_index_sizes(), **reaper_stats}
+
+def user_directory_metrics() -> dict:
+    return repo.user_directory_stats()
+
+def read_cache_metrics() -> dict:
+    return repo.read_cache_stats()
+
+def start_caches():
+    repo.users.start()
+    repo.cache.start()
+
 # Matching
 def request_ride(rider_id: str, pickup_lat: float, pickup_lon: float, dest_lat: float, dest_lon: float) -> dict:
     drivers = repo.nearby_drivers(pickup_lat, pickup_lon, 10, 1)
@@ -27,19 +101,26 @@ def request_ride(rider_id: str, pickup_lat: float, pickup_lon: float, dest_lat:
     return {"ride_id": ride_id, "driver_id": driver_id, "status": "matched"}
 
 # Trips
-def start_trip(ride_id: int) -> dict:
-    ride = repo.get_ride(ride_id)
-    if not ride:
+def ride_history(role: str, user_id: str, cursor=None, limit: int = 20) -> dict:
+    rides, next_cursor = repo.ride_history(role, user_id, cursor, limit)
+    return {"rides": rides, "next_cursor": next_cursor}
+
+def _transition(ride_id: int, status: str, free_driver: bool = False) -> dict:
+    return transition_result(ride_id, status, repo.transition_ride(ride_id, status, free_driver))
+
+def transition_result(ride_id: int, status: str, res: dict) -> dict:
+    """The trip response for a transition outcome; raises LookupError / ValueError."""
+    if res["outcome"] == "missing":
         raise LookupError("ride not found")
-    repo.set_ride_status(ride_id, "ongoing")
-    return {"ride_id": ride_id, "status": "ongoing"}
+    if res["outcome"] == "conflict":
+        raise ValueError(f"ride is {res['status']}, cannot become {status}")
+    return {"ride_id": ride_id, "status": res["status"], "driver_id": res["driver_id"]}
+
+def start_trip(ride_id: int) -> dict:
+    return _transition(ride_id, "ongoing")
 
 def complete_trip(ride_id: int) -> dict:
-    ride = repo.get_ride(ride_id)
-    if not ride:
-        raise LookupError("ride not found")
-    repo.set_ride_status(ride_id, "completed")
-    driver_id = ride.get("driver_id")
-    if driver_id:
-        repo.free_driver(driver_id)
-    return {"ride_id": ride_id, "status": "completed"}
+    return _transition(ride_id, "completed", free_driver=True)
+
+def cancel_trip(ride_id: int) -> dict:
+    return _transition(ride_id, "cancelled", free_driver=True)
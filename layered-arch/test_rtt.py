@@ -0,0 +1,149 @@
+import os
+import sys
+import threading
+import time
+
+# Scratch database; the script flushes it
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")
+os.environ.setdefault("ARCHIVE_DIR", "/tmp/test-rtt-archive")
+os.environ.setdefault("REAP_INTERVAL_S", "3600")
+os.environ.setdefault("ARCHIVE_INTERVAL_S", "3600")
+
+import redis
+import redis.asyncio.connection
+import redis.connection
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from layered.api import aioroutes, routes  # noqa: E402
+from layered.config.settings import get_redis  # noqa: E402
+from layered.data import repo  # noqa: E402
+from layered.service import core  # noqa: E402
+
+# Round trips allowed per call. /rides/request is a search then a create: the driver
+# has to be chosen before the ride naming them can be written.
+BUDGETS = {"/rides/request": 2}
+
+# --- RTT counter -------------------------------------------------------------
+# Every command or pipeline redis-py sends goes out through one send_packed_command,
+# so counting those counts round trips. Pub/sub followers only read once subscribed.
+rtt = {"n": 0}
+_lock = threading.Lock()
+
+def _counting(send):
+    def counted(self, *args, **kwargs):
+        with _lock:
+            rtt["n"] += 1
+        return send(self, *args, **kwargs)
+    return counted
+
+def _counting_async(send):
+    async def counted(self, *args, **kwargs):
+        with _lock:
+            rtt["n"] += 1
+        return await send(self, *args, **kwargs)
+    return counted
+
+redis.connection.AbstractConnection.send_packed_command = _counting(
+    redis.connection.AbstractConnection.send_packed_command)
+redis.asyncio.connection.AbstractConnection.send_packed_command = _counting_async(
+    redis.asyncio.connection.AbstractConnection.send_packed_command)
+# ------------------------------------------------------------------------------
+
+def print_status(message):
+    print(f"\n[TEST] {message}")
+
+def print_check(message):
+    print(f"  ... {message}")
+
+def measured(c, method, path, **kwargs):
+    before = rtt["n"]
+    resp = getattr(c, method)(path, **kwargs)
+    return resp, rtt["n"] - before
+
+def walk(c, tag):
+    """One pass over the routes; returns [(route, status, round trips)]."""
+    rider, driver = f"rtt_rider_{tag}", f"rtt_driver_{tag}"
+    out = []
+
+    def call(route, method, path, **kwargs):
+        resp, n = measured(c, method, path, **kwargs)
+        out.append((route, resp.status_code, n))
+        return resp
+
+    call("/auth/register", "post", "/auth/register", json={"user_id": rider, "role": "rider"})
+    call("/auth/register/batch", "post", "/auth/register/batch",
+         json={"users": [{"user_id": driver, "role": "driver"}]})
+    call("/auth/users/exists", "post", "/auth/users/exists", json={"user_ids": [rider, f"nobody_{tag}"]})
+    call("/auth/login", "post", "/auth/login", json={"user_id": rider})
+    call("/me/{user_id}", "get", f"/me/{rider}")
+    call("/drivers/location", "post", "/drivers/location", json={"driver_id": driver, "lat": 33.73, "lon": -97.11})
+    # A different grid cell: leaving the old one has to fit in the same round trip
+    call("/drivers/location/batch", "post", "/drivers/location/batch",
+         json={"updates": [{"driver_id": driver, "lat": 32.7357, "lon": -97.1081}]})
+    ride = call("/rides/request", "post", "/rides/request",
+                json={"rider_id": rider, "pickup_lat": 32.7357, "pickup_lon": -97.1081,
+                      "dest_lat": 32.75, "dest_lon": -97.12}).json()
+    ride_id = ride["ride_id"]
+    call("/rides/{ride_id}", "get", f"/rides/{ride_id}")
+    call("/trips/{ride_id}/start", "post", f"/trips/{ride_id}/start")
+    call("/trips/{ride_id}/complete", "post", f"/trips/{ride_id}/complete")
+    call("/riders/{rider_id}/rides", "get", f"/riders/{rider}/rides")
+    call("/drivers/{driver_id}/rides", "get", f"/drivers/{driver}/rides")
+    return out
+
+def check_layer(name, router):
+    """[(route, status, round trips, budget)] of a measured pass over one data layer."""
+    print_status(f"Data layer: {name}")
+    app = FastAPI()
+    app.include_router(router)
+    rows = []
+    with TestClient(app) as c:
+        # First pass loads the Lua scripts and the ride id lease; measure the second
+        walk(c, f"{name}_warm")
+        for route, status, n in walk(c, name):
+            budget = BUDGETS.get(route, 1)
+            ok = status < 400 and n <= budget
+            print_check(f"{'OK  ' if ok else 'FAIL'} {route:<28} {status}  {n} round trip(s)  (max {budget})")
+            rows.append((route, status, n, budget))
+    return rows
+
+def measure():
+    """{layer: rows} for both data layers, on a flushed scratch database."""
+    get_redis().flushdb()
+    core.start_caches()
+    # Let the pub/sub followers subscribe before anything is counted
+    while not (repo.users.ready and repo.cache.ready):
+        time.sleep(0.05)
+    return {"sync": check_layer("sync", routes.router), "async": check_layer("async", aioroutes.router)}
+
+def redis_error():
+    try:
+        get_redis().ping()
+    except redis.RedisError as e:
+        return e
+    return None
+
+def test_round_trips():
+    error = redis_error()
+    if error is not None:
+        import pytest
+        pytest.skip(f"Redis not reachable: {error}")
+    for layer, rows in measure().items():
+        for route, status, n, budget in rows:
+            assert status < 400, f"{layer} {route}: HTTP {status}"
+            assert n <= budget, f"{layer} {route}: {n} round trips, max {budget}"
+
+def main():
+    error = redis_error()
+    if error is not None:
+        print_status(f"FATAL: Could not connect to Redis. Is it running? {error}")
+        return False
+    failed = sum(status >= 400 or n > budget
+                 for rows in measure().values() for _, status, n, budget in rows)
+    print_status("PASSED" if not failed else f"FAILED: {failed} route(s) over budget")
+    return not failed
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,161 @@
+# bench_2pc.py  (in-process, no docker needed)
+# Starts N dummy 2PC participants on localhost with a fixed service delay and compares
+# trip-completion latency of the old sequential coordinator with the concurrent one, and
+# of full 2PC over the network with one in-process participant plus one-phase commit.
+# Generate the stubs first:  python -m grpc_tools.protoc -I. --python_out=. --grpc_python_out=. twophase.proto
+import os, sys, time, uuid, statistics, threading
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import twophase_pb2  # noqa: E402
+import twophase_pb2_grpc  # noqa: E402
+from services.trip_service.coordinator import (  # noqa: E402
+    GroupCommitter, LocalParticipant, ParticipantRegistry, RemoteParticipant, run_2pc,
+)
+
+PARTICIPANT_COUNTS = [2, 4, 8]
+DELAY_MS = 5             # per-call service time of every participant
+SLOW_DELAY_MS = 200      # one participant in the "slow" scenario
+TRANSACTIONS = 100
+BASE_PORT = 51100
+BATCH_WINDOWS_MS = [0, 1, 2, 5, 10, 20]
+CLIENTS = 64             # concurrent HTTP handlers completing trips
+GROUP_DURATION_S = 5
+
+
+class DummyParticipant(twophase_pb2_grpc.ParticipantServicer):
+    def __init__(self, delay_ms: float):
+        self.delay = delay_ms / 1000.0
+
+    def VoteRequest(self, request, context):
+        time.sleep(self.delay)
+        return twophase_pb2.VoteReply(vote_commit=True)
+
+    def GlobalCommit(self, request, context):
+        time.sleep(self.delay)
+        return twophase_pb2.GlobalCommitReply()
+
+    def GlobalAbort(self, request, context):
+        time.sleep(self.delay)
+        return twophase_pb2.GlobalAbortReply()
+
+    def OnePhaseCommit(self, request, context):
+        time.sleep(self.delay)
+        return twophase_pb2.VoteReply(vote_commit=True)
+
+
+def start_participants(delays_ms):
+    servers, stubs = [], []
+    for i, delay in enumerate(delays_ms):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        twophase_pb2_grpc.add_ParticipantServicer_to_server(DummyParticipant(delay), server)
+        port = BASE_PORT + i
+        server.add_insecure_port(f"localhost:{port}")
+        server.start()
+        servers.append(server)
+        stubs.append(RemoteParticipant(f"P{i}", f"localhost:{port}"))
+    return servers, stubs
+
+
+def sequential_2pc(tx_id, participants, ride_id, driver_id):
+    # The previous coordinator: one participant after the other, 2 s per call.
+    vote_args = twophase_pb2.VoteRequestArgs(transaction_id=tx_id, ride_id=ride_id, driver_id=driver_id)
+    ok = True
+    for p in participants:
+        try:
+            ok &= p.stub.VoteRequest(vote_args, timeout=2.0).vote_commit
+        except grpc.RpcError:
+            ok = False
+    args = twophase_pb2.GlobalCommitArgs(transaction_id=tx_id, ride_id=ride_id, driver_id=driver_id)
+    for p in participants:
+        try:
+            p.stub.GlobalCommit(args, timeout=2.0)
+        except grpc.RpcError:
+            pass
+    return ok
+
+
+def measure(fn, participants) -> dict:
+    fn(str(uuid.uuid4()), participants, "1", "d")  # warm up channels
+    lat = []
+    for _ in range(TRANSACTIONS):
+        t0 = time.perf_counter()
+        fn(str(uuid.uuid4()), participants, "1", "d")
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    lat.sort()
+    return {"p50_ms": round(statistics.median(lat), 2), "p95_ms": round(lat[int(0.95 * len(lat))], 2)}
+
+
+def main():
+    for n in PARTICIPANT_COUNTS:
+        for label, delays in [("uniform", [DELAY_MS] * n), ("one_slow", [SLOW_DELAY_MS] + [DELAY_MS] * (n - 1))]:
+            servers, stubs = start_participants(delays)
+            try:
+                seq = measure(sequential_2pc, stubs)
+                par = measure(run_2pc, stubs)
+            finally:
+                for s in servers:
+                    s.stop(None)
+            print({"participants": n, "scenario": label,
+                   "sequential_p50_ms": seq["p50_ms"], "sequential_p95_ms": seq["p95_ms"],
+                   "concurrent_p50_ms": par["p50_ms"], "concurrent_p95_ms": par["p95_ms"]})
+
+    # Trip-service shape: its own participant plus Location. Before: both over gRPC with
+    # full 2PC (4 RPCs). Now: Trip in-process and one OnePhaseCommit to Location (1 RPC).
+    servers, stubs = start_participants([DELAY_MS, DELAY_MS])
+    try:
+        before = measure(sequential_2pc, stubs)
+        local = LocalParticipant("Local", DummyParticipant(DELAY_MS))
+        after = measure(run_2pc, [local, stubs[1]])
+    finally:
+        for s in servers:
+            s.stop(None)
+    print({"scenario": "local_plus_one_remote",
+           "grpc_2pc_p50_ms": before["p50_ms"], "grpc_2pc_p95_ms": before["p95_ms"],
+           "local_1pc_p50_ms": after["p50_ms"], "local_1pc_p95_ms": after["p95_ms"]})
+
+    for window in BATCH_WINDOWS_MS:
+        print(group_commit(window))
+
+
+def group_commit(window_ms: float) -> dict:
+    # Trip-service shape again, with CLIENTS threads completing trips back to back.
+    servers, stubs = start_participants([DELAY_MS])
+    registry = ParticipantRegistry()
+    registry.register_local("Trip", DummyParticipant(DELAY_MS))
+    registry.register("Location", stubs[0].target)
+    committer = GroupCommitter(registry, window_ms=window_ms)
+    committer.complete("0", "d")  # warm up the channel
+    lat, lock = [], threading.Lock()
+    stop_at = time.perf_counter() + GROUP_DURATION_S
+
+    def client():
+        mine = []
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            committer.complete("1", "d")
+            mine.append((time.perf_counter() - t0) * 1000.0)
+        with lock:
+            lat.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(CLIENTS)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        registry.close()
+        for s in servers:
+            s.stop(None)
+        stubs[0].close()
+    lat.sort()
+    return {"scenario": "group_commit", "window_ms": window_ms,
+            "completions_per_s": round(len(lat) / GROUP_DURATION_S, 1),
+            "p50_ms": round(statistics.median(lat), 2), "p95_ms": round(lat[int(0.95 * len(lat))], 2)}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# bench_geoshard.py  (needs several local Redis instances, no services)
+# Measures driver index throughput (location updates + nearby searches) as the geo cells
+# are spread over 1, 2 and 4 Redis instances. Start the instances first, e.g.
+#   for p in 6380 6381 6382 6383; do docker run -d -p $p:6379 redis:7-alpine; done
+import os, sys, time, random
+from multiprocessing import Pool
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from services.common.geoshard import ShardedGeoIndex  # noqa: E402
+
+PRIMARY_URL = "redis://localhost:6379/0"
+SHARD_URLS = [f"redis://localhost:{p}/0" for p in (6380, 6381, 6382, 6383)]
+SHARD_COUNTS = [1, 2, 4]
+CELL_DEG = 0.5
+WORKERS = 8
+DURATION_S = 10
+BATCH = 200             # location updates per write
+SEARCHES_PER_WRITE = 4
+DRIVERS = 100_000
+# Drivers spread over a ~5x5 degree region so they fall into ~100 cells.
+LAT0, LON0, SPAN = 30.0, -100.0, 5.0
+
+
+def worker(args):
+    shard_urls, seed = args
+    rnd = random.Random(seed)
+    primary = redis.from_url(PRIMARY_URL, decode_responses=True)
+    geo = ShardedGeoIndex(primary, shard_urls, CELL_DEG)
+    updates = searches = 0
+    deadline = time.perf_counter() + DURATION_S
+    while time.perf_counter() < deadline:
+        batch = [(f"bench_d{rnd.randrange(DRIVERS)}", LAT0 + rnd.random() * SPAN,
+                  LON0 + rnd.random() * SPAN, True) for _ in range(BATCH)]
+        updates += geo.update(batch, time.time())
+        for _ in range(SEARCHES_PER_WRITE):
+            geo.search(LAT0 + rnd.random() * SPAN, LON0 + rnd.random() * SPAN, 10, 5)
+            searches += 1
+    return updates, searches
+
+
+def run(n_shards: int) -> dict:
+    shard_urls = SHARD_URLS[:n_shards]
+    for url in [PRIMARY_URL] + shard_urls:
+        redis.from_url(url).flushdb()
+    with Pool(WORKERS) as pool:
+        results = pool.map(worker, [(shard_urls, i) for i in range(WORKERS)])
+    updates = sum(u for u, _ in results)
+    searches = sum(s for _, s in results)
+    return {
+        "shards": n_shards,
+        "updates_per_s": round(updates / DURATION_S, 1),
+        "searches_per_s": round(searches / DURATION_S, 1),
+    }
+
+
+if __name__ == "__main__":
+    base = None
+    for n in SHARD_COUNTS:
+        row = run(n)
+        base = base or row["searches_per_s"]
+        row["search_speedup_x"] = round(row["searches_per_s"] / base, 2) if base else None
+        print(row)
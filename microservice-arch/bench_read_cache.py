@@ -0,0 +1,82 @@
+# bench_read_cache.py  (needs a local Redis it may flush, no services)
+# Ride lookups per second through the read-through cache, on and off, with a share of
+# rides changing state meanwhile so invalidations (and re-reads) are part of the cost.
+# Reads follow a skewed popularity, as when riders and drivers poll their active trip.
+import os, sys, time, random, threading
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from services.common import ridecodec  # noqa: E402
+from services.common.readcache import ReadCache  # noqa: E402
+from services.common.ridestate import RideStateMachine  # noqa: E402
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/15")
+RIDES = 100_000
+THREADS = 8
+DURATION_S = 5
+WRITES_PER_S = [0, 200, 2000]   # state changes per second from "another node"
+HOT_SHARE = 0.9                 # share of reads that go to the hottest 1% of rides
+
+
+def seed(r):
+    r.flushdb()
+    pipe = r.pipeline(transaction=False)
+    for ride_id in range(1, RIDES + 1):
+        pipe.hset(f"ride:{ride_id}", mapping={"rider_id": f"r{ride_id}", "driver_id": f"d{ride_id}",
+                                             "status": "matched", "pickup_lat": 32.7, "pickup_lon": -97.1,
+                                             "dest_lat": 32.8, "dest_lon": -97.2})
+        if ride_id % 5000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def pick(rnd):
+    hot = RIDES // 100
+    return rnd.randint(1, hot) if rnd.random() < HOT_SHARE else rnd.randint(1, RIDES)
+
+
+def run(cache_max, writes_per_s):
+    r = redis.from_url(REDIS_URL, decode_responses=True)
+    seed(r)
+    cache = ReadCache(r, cache_max, ttl_s=30)
+    cache.start()
+    while cache.enabled and not cache.ready:
+        time.sleep(0.01)
+    stop = time.time() + DURATION_S
+    reads = [0] * THREADS
+
+    def reader(i):
+        rnd = random.Random(i)
+        while time.time() < stop:
+            ride_id = pick(rnd)
+            cache.get(f"ride:{ride_id}", lambda: ridecodec.decode(r.hgetall(f"ride:{ride_id}")))
+            reads[i] += 1
+
+    def writer():
+        # Reset a ride to matched, then start it through the transition script, which
+        # publishes the invalidation every cache receives.
+        rnd = random.Random(99)
+        rides = RideStateMachine(r)
+        while writes_per_s and time.time() < stop:
+            ride_id = pick(rnd)
+            r.hset(f"ride:{ride_id}", "status", "matched")
+            rides.transition(ride_id, "ongoing")
+            time.sleep(1 / writes_per_s)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(THREADS)]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = cache.snapshot()
+    return {"cache": "on" if cache_max else "off", "writes_per_s": writes_per_s,
+            "reads_per_s": round(sum(reads) / DURATION_S), "hit_rate": stats["cache_hit_rate"],
+            "invalidations": stats["cache_invalidations"]}
+
+
+if __name__ == "__main__":
+    for writes in WRITES_PER_S:
+        for cache_max in (0, 100_000):
+            print(run(cache_max, writes))
@@ -0,0 +1,98 @@
+# bench_ride_encoding.py  (needs a local Redis it may flush, no services)
+# Loads RIDES synthetic rides in each layout and reports Redis memory per ride plus
+# read latency: full ride (HGETALL + decode) and the status/driver read the trip
+# service does (HMGET). "packed" is a single struct-packed string per ride, shown for
+# comparison only: it is the smallest, but the transition script could no longer
+# update the status field in place.
+#   RIDES=10000000 REDIS_URL=redis://localhost:6379/15 python bench_ride_encoding.py
+import os, sys, time, random, struct, statistics
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from services.common import ridecodec  # noqa: E402
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/15")
+RIDES = int(os.getenv("RIDES", "10000000"))
+SAMPLES = 20_000
+PIPELINE = 5_000
+LAT0, LON0 = 32.7357, -97.1081
+
+
+def synthetic(ride_id):
+    rnd = random.Random(ride_id)
+    return {
+        "rider_id": f"rider{rnd.randrange(1_000_000)}",
+        "driver_id": f"driver{rnd.randrange(100_000)}",
+        "status": rnd.choice(ridecodec.STATUSES),
+        "pickup_lat": round(LAT0 + rnd.uniform(-1, 1), 6),
+        "pickup_lon": round(LON0 + rnd.uniform(-1, 1), 6),
+        "dest_lat": round(LAT0 + rnd.uniform(-1, 1), 6),
+        "dest_lon": round(LON0 + rnd.uniform(-1, 1), 6),
+    }
+
+
+def pack(ride):
+    coords = (round(ride[c] * 1e6) for c in ridecodec.COORDS)
+    return (struct.pack("<B4i", ridecodec.STATUSES.index(ride["status"]), *coords)
+            + f"{ride['rider_id']}\0{ride['driver_id']}".encode())
+
+
+def unpack(raw):
+    status, *coords = struct.unpack_from("<B4i", raw)
+    rider_id, driver_id = raw[17:].decode().split("\0")
+    ride = {"rider_id": rider_id, "driver_id": driver_id, "status": ridecodec.STATUSES[status]}
+    ride.update((c, str(v / 1e6)) for c, v in zip(ridecodec.COORDS, coords))
+    return ride
+
+
+def load(r, layout):
+    pipe = r.pipeline(transaction=False)
+    for ride_id in range(1, RIDES + 1):
+        ride = synthetic(ride_id)
+        if layout == "packed":
+            pipe.set(f"ride:{ride_id}", pack(ride))
+        else:
+            pipe.hset(f"ride:{ride_id}", mapping=ridecodec.encode(ride, layout))
+        if ride_id % PIPELINE == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def timed(fn, ids):
+    lat = []
+    for ride_id in ids:
+        t0 = time.perf_counter()
+        fn(ride_id)
+        lat.append((time.perf_counter() - t0) * 1e6)
+    lat.sort()
+    return statistics.median(lat), lat[int(len(lat) * 0.99)]
+
+
+def run(layout):
+    r = redis.from_url(REDIS_URL)
+    text = redis.from_url(REDIS_URL, decode_responses=True)
+    r.flushdb()
+    before = r.info("memory")["used_memory"]
+    t0 = time.time()
+    load(r, layout)
+    load_s = time.time() - t0
+    per_ride = (r.info("memory")["used_memory"] - before) / RIDES
+
+    ids = random.Random(7).sample(range(1, RIDES + 1), min(SAMPLES, RIDES))
+    if layout == "packed":
+        full = timed(lambda i: unpack(r.get(f"ride:{i}")), ids)
+        state = timed(lambda i: unpack(r.get(f"ride:{i}"))["status"], ids)
+    else:
+        full = timed(lambda i: ridecodec.decode(text.hgetall(f"ride:{i}")), ids)
+        state = timed(lambda i: ridecodec.state_of(text.hmget(f"ride:{i}", *ridecodec.STATE_FIELDS)), ids)
+    r.flushdb()
+    return {"layout": layout, "bytes_per_ride": round(per_ride, 1), "load_s": round(load_s, 1),
+            "get_p50_us": round(full[0], 1), "get_p99_us": round(full[1], 1),
+            "state_p50_us": round(state[0], 1), "state_p99_us": round(state[1], 1)}
+
+
+if __name__ == "__main__":
+    print(f"{RIDES} rides")
+    for layout in ("hash", "compact", "packed"):
+        print(run(layout))
@@ -0,0 +1,96 @@
+# bench_trip_async.py  (needs Redis on localhost; starts its own trip service)
+# Puts a slow Location participant behind the trip service and compares how many
+# completions per second the trip service accepts in blocking mode and with ?async=true,
+# then waits for the async outcomes to land.
+# Generate the stubs first:  python -m grpc_tools.protoc -I. --python_out=. --grpc_python_out=. twophase.proto
+import os, sys, time, asyncio, statistics, subprocess
+from concurrent import futures
+
+import grpc
+import httpx
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import twophase_pb2_grpc  # noqa: E402
+from bench_2pc import DummyParticipant  # noqa: E402
+
+REDIS_URL = "redis://localhost:6379/0"
+TRIP_PORT = 8104
+LOCATION_PORT = 51200
+SLOW_MS = 500            # Location's service time per call
+CLIENTS = 64
+REQUESTS = 1000          # per mode
+
+
+async def fire(mode_async: bool, first_ride: int) -> dict:
+    sem = asyncio.Semaphore(CLIENTS)
+    lat, codes, tx_ids = [], {}, []
+
+    async def one(c, ride_id):
+        async with sem:
+            t0 = time.perf_counter()
+            res = await c.post(f"http://localhost:{TRIP_PORT}/trips/{ride_id}/complete",
+                               params={"async": "true"} if mode_async else None)
+            lat.append((time.perf_counter() - t0) * 1000.0)
+            codes[res.status_code] = codes.get(res.status_code, 0) + 1
+            if res.status_code == 202:
+                tx_ids.append(res.json()["transaction_id"])
+
+    limits = httpx.Limits(max_connections=CLIENTS)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as c:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(c, first_ride + i) for i in range(REQUESTS)))
+        elapsed = time.perf_counter() - t0
+        settled = None
+        if tx_ids:
+            # How long until every accepted completion has an outcome
+            while True:
+                statuses = await asyncio.gather(*(c.get(f"http://localhost:{TRIP_PORT}/transactions/{t}")
+                                                  for t in tx_ids))
+                if all(s.json()["status"] != "pending" for s in statuses):
+                    settled = round(time.perf_counter() - t0, 2)
+                    break
+                await asyncio.sleep(0.2)
+    lat.sort()
+    return {"mode": "async" if mode_async else "blocking", "accepted_per_s": round(REQUESTS / elapsed, 1),
+            "p50_ms": round(statistics.median(lat), 2), "p95_ms": round(lat[int(0.95 * len(lat))], 2),
+            "codes": codes, "all_settled_s": settled}
+
+
+def main():
+    r = redis.from_url(REDIS_URL, decode_responses=True)
+    pipe = r.pipeline(transaction=False)
+    for i in range(2 * REQUESTS):
+        pipe.hset(f"ride:{900000 + i}", mapping={"status": "ongoing", "driver_id": f"bench_d{i}"})
+    pipe.execute()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=64))
+    twophase_pb2_grpc.add_ParticipantServicer_to_server(DummyParticipant(SLOW_MS), server)
+    server.add_insecure_port(f"localhost:{LOCATION_PORT}")
+    server.start()
+    env = {**os.environ, "REDIS_URL": REDIS_URL, "LOCATION_GRPC_TARGET": f"localhost:{LOCATION_PORT}"}
+    trip = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "services.trip_service.main:app", "--port", str(TRIP_PORT), "--log-level", "warning"],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(50):
+            try:
+                httpx.get(f"http://localhost:{TRIP_PORT}/participants")
+                break
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        print(asyncio.run(fire(False, 900000)))
+        print(asyncio.run(fire(True, 900000 + REQUESTS)))
+    finally:
+        trip.terminate()
+        trip.wait()
+        server.stop(None)
+        pipe = r.pipeline(transaction=False)
+        for i in range(2 * REQUESTS):
+            pipe.delete(f"ride:{900000 + i}")
+        pipe.execute()
+
+
+if __name__ == "__main__":
+    main()
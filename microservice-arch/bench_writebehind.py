@@ -0,0 +1,101 @@
+# bench_writebehind.py  (offline simulation, no services needed)
+# Replays synthetic driver traces through the location write-behind buffer and reports
+# Redis writes/s against position staleness and matching quality for several settings.
+import os, sys, math, random, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from services.location_service.writebehind import WriteBehind, distance_m  # noqa: E402
+
+DRIVERS = 500
+SIM_S = 120
+PING_S = 1.0              # each driver pings once per second
+SPEED_MS = 8.0            # ~30 km/h; a quarter of drivers are parked
+PICKUPS_PER_SAMPLE = 20
+LAT0, LON0 = 32.7357, -97.1081
+M_PER_DEG = 111_320.0
+
+# (flush_ms, min_move_m, max_age_s)
+SETTINGS = [
+    (0, 0, 30),       # current behaviour: write every update
+    (0, 10, 30),
+    (0, 25, 30),
+    (2000, 0, 30),    # coalescing only
+    (1000, 10, 30),
+    (2000, 25, 30),
+]
+
+
+def run(flush_ms, min_move_m, max_age_s):
+    rnd = random.Random(42)
+    now = [0.0]
+    stored = {}
+    writes = [0]
+
+    def sink(batch):
+        writes[0] += len(batch)
+        for d, lat, lon, _ in batch:
+            stored[d] = (lat, lon)
+
+    wb = WriteBehind(sink, flush_ms, min_move_m, max_age_s, clock=lambda: now[0])
+    pos = {}
+    heading = {}
+    for i in range(DRIVERS):
+        d = f"d{i}"
+        pos[d] = (LAT0 + rnd.random() / 10, LON0 + rnd.random() / 10)
+        heading[d] = rnd.random() * 2 * math.pi if i % 4 else None
+
+    err, same, extra = [], 0, []
+    picks = 0
+    next_flush = flush_ms / 1000.0
+    t = 0.0
+    while t < SIM_S:
+        now[0] = t
+        batch = []
+        for d, (lat, lon) in pos.items():
+            h = heading[d]
+            if h is not None:
+                step = SPEED_MS * PING_S / M_PER_DEG
+                lat += step * math.sin(h)
+                lon += step * math.cos(h) / math.cos(math.radians(lat))
+                heading[d] = h + rnd.gauss(0, 0.2)
+                pos[d] = (lat, lon)
+            batch.append((d, lat, lon, True))
+        wb.offer(batch)
+        if flush_ms and t >= next_flush:
+            wb.flush()
+            next_flush += flush_ms / 1000.0
+
+        # Staleness of the index and its effect on nearest-driver matching.
+        for d, (lat, lon) in pos.items():
+            if d in stored:
+                err.append(distance_m(lat, lon, *stored[d]))
+        for _ in range(PICKUPS_PER_SAMPLE if stored else 0):
+            plat, plon = LAT0 + rnd.random() / 10, LON0 + rnd.random() / 10
+            best_true = min(pos, key=lambda d: distance_m(plat, plon, *pos[d]))
+            best_idx = min(stored, key=lambda d: distance_m(plat, plon, *stored[d]))
+            picks += 1
+            same += best_true == best_idx
+            extra.append(distance_m(plat, plon, *pos[best_idx]) - distance_m(plat, plon, *pos[best_true]))
+        t += PING_S
+
+    err.sort()
+    return {
+        "flush_ms": flush_ms,
+        "min_move_m": min_move_m,
+        "max_age_s": max_age_s,
+        "updates_per_s": round(DRIVERS / PING_S, 1),
+        "redis_writes_per_s": round(writes[0] / SIM_S, 1),
+        "staleness_mean_m": round(statistics.mean(err), 2),
+        "staleness_p95_m": round(err[int(0.95 * len(err))], 2),
+        "match_same_driver_pct": round(100.0 * same / picks, 2),
+        "match_extra_pickup_m": round(statistics.mean(extra), 2),
+    }
+
+
+if __name__ == "__main__":
+    base = None
+    for s in SETTINGS:
+        row = run(*s)
+        base = base or row["redis_writes_per_s"]
+        row["write_reduction_x"] = round(base / row["redis_writes_per_s"], 2) if row["redis_writes_per_s"] else None
+        print(row)
@@ -0,0 +1,43 @@
+# consume_ride_events.py  (run while the microservice stack is up)
+# Example downstream consumer: tails rides:events through a consumer group and prints
+# per-status counts and throughput. Run several copies with different CONSUMER names to
+# split the stream between them.
+import os, sys, time, collections
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from services.common.ride_events import RideEventConsumer  # noqa: E402
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+GROUP = os.getenv("GROUP", "analytics")
+CONSUMER = os.getenv("CONSUMER", f"consumer-{os.getpid()}")
+REPORT_EVERY_S = 5
+
+
+def main():
+    r = redis.from_url(REDIS_URL, decode_responses=True)
+    consumer = RideEventConsumer(r, GROUP, CONSUMER)
+    counts = collections.Counter()
+    state = {"t0": time.time(), "n": 0}
+
+    def handle(batch):
+        for _, event in batch:
+            counts[event["status"]] += 1
+        state["n"] += len(batch)
+        elapsed = time.time() - state["t0"]
+        if elapsed >= REPORT_EVERY_S:
+            print({"events_per_s": round(state["n"] / elapsed, 1), **counts})
+            state["t0"], state["n"] = time.time(), 0
+
+    # Pick up whatever a crashed member of the group left unacknowledged.
+    consumer.ensure_group()
+    stale = consumer.claim_stale()
+    if stale:
+        handle(stale)
+        consumer.ack([eid for eid, _ in stale])
+    consumer.run(handle)
+
+
+if __name__ == "__main__":
+    main()
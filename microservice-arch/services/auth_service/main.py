@@ -1,38 +1,102 @@
 import os
+from typing import List
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import redis
 
+from services.common import tokens
+from services.common.metrics import REGISTRY
+from services.common.readcache import ReadCache
+from services.common.usercache import UserDirectory
+
 r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
 app = FastAPI(title="Auth Service")
 
+ROLES = {"rider", "driver"}
+BATCH_MAX = int(os.getenv("REGISTER_BATCH_MAX", "10000"))
+
+# Bloom filter of user ids plus a role cache, so most lookups never reach Redis
+users = UserDirectory(r, int(os.getenv("USER_BLOOM_CAPACITY", "1000000")),
+                      float(os.getenv("USER_BLOOM_ERROR_RATE", "0.01")),
+                      float(os.getenv("USER_CACHE_TTL_S", "300")))
+for _name in users.snapshot():
+    REGISTRY.gauge(_name, lambda _name=_name: users.snapshot()[_name])
+
+# /me reads; user hashes don't change once created, so the TTL is only a safety net
+profiles = ReadCache(r, int(os.getenv("USER_PROFILE_CACHE_MAX", "100000")), float(os.getenv("USER_CACHE_TTL_S", "300")))
+for _name in profiles.snapshot():
+    REGISTRY.gauge(f"profile_{_name}", lambda _name=_name: profiles.snapshot()[_name])
+
+@app.on_event("startup")
+def startup_event():
+    users.start()
+    profiles.start()
+
 class Register(BaseModel):
     user_id: str
     role: str  # "rider" or "driver"
 
+class RegisterBatch(BaseModel):
+    users: List[Register]
+
 class Login(BaseModel):
     user_id: str
 
+class UserIds(BaseModel):
+    user_ids: List[str]
+
 @app.post("/register")
 def register(payload: Register):
-    if payload.role not in {"rider", "driver"}:
+    if payload.role not in ROLES:
         raise HTTPException(status_code=400, detail="role must be rider or driver")
-    key = f"user:{payload.user_id}"
-    if r.exists(key):
+    # Create-if-absent in one atomic command, announced to every user directory
+    pipe = r.pipeline(transaction=False)
+    pipe.hsetnx(f"user:{payload.user_id}", "role", payload.role)
+    users.publish(pipe, [payload.user_id])
+    if not pipe.execute()[0]:
         raise HTTPException(status_code=409, detail="user exists")
-    r.hset(key, mapping={"role": payload.role})
+    users.registered([(payload.user_id, payload.role)])
     return {"ok": True}
 
+@app.post("/register/batch")
+def register_batch(payload: RegisterBatch):
+    # One pipelined HSETNX per user: each create is atomic, the batch costs one round trip
+    if len(payload.users) > BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"at most {BATCH_MAX} users per batch")
+    valid = [u for u in payload.users if u.role in ROLES]
+    pipe = r.pipeline(transaction=False)
+    for u in valid:
+        pipe.hsetnx(f"user:{u.user_id}", "role", u.role)
+    users.publish(pipe, [u.user_id for u in valid])
+    created = pipe.execute()[:len(valid)]
+    users.registered([(u.user_id, u.role) for u, ok in zip(valid, created) if ok])
+    return {
+        "created": sum(created),
+        "conflicts": [u.user_id for u, ok in zip(valid, created) if not ok],
+        "invalid": [u.user_id for u in payload.users if u.role not in ROLES],
+    }
+
+@app.post("/users/exists")
+def users_exist(payload: UserIds):
+    if len(payload.user_ids) > BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"at most {BATCH_MAX} user ids per request")
+    return {"exists": dict(zip(payload.user_ids, users.exist_many(payload.user_ids)))}
+
 @app.post("/login")
 def login(payload: Login):
-    key = f"user:{payload.user_id}"
-    if not r.exists(key):
+    role = users.role(payload.user_id)
+    if role is None:
         raise HTTPException(status_code=404, detail="user not found")
-    return {"token": payload.user_id}
+    # Signed token; other services verify it without asking us or Redis
+    return {"token": tokens.issue(payload.user_id, role), "expires_in": tokens.TTL_S}
 
 @app.get("/me/{user_id}")
 def me(user_id: str):
-    data = r.hgetall(f"user:{user_id}")
+    data = profiles.get(f"user:{user_id}", lambda: r.hgetall(f"user:{user_id}"))
     if not data:
         raise HTTPException(status_code=404, detail="user not found")
     return {"user_id": user_id, **data}
+
+@app.get("/metrics")
+def metrics():
+    return REGISTRY.snapshot()
@@ -0,0 +1,245 @@
+"""Cold storage for closed rides: compressed columnar segment files.
+
+Completed and cancelled rides are listed in ``rides:closed`` (sorted by close time) by
+the state machine. archive_closed() takes the ones closed longer than a threshold,
+writes them as one segment file and deletes their hashes, so Redis only holds rides
+that are still active or recently closed.
+
+Segment layout (stdlib only: array + zlib, no Parquet/NumPy dependency):
+
+    b"RSEG1" | uint32 header length | JSON header | column blobs
+
+The header lists row count, min/max ride id and each column's type, offset and length.
+String columns ("strs") are a uint32 length per row followed by the UTF-8 bytes, so
+any id round-trips; segments written before that used newline-joined "str" columns.
+Every column is zlib-compressed on its own; ride ids are stored sorted so a lookup is
+a bisect on one column, then a decode of the row's segment.
+"""
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict
+
+from .readcache import CHANNEL as INVALIDATE_CHANNEL
+from .ridecodec import COORDS, STATUSES, decode
+from .ridestate import CLOSED_KEY
+
+MAGIC = b"RSEG1"
+SUFFIX = ".rseg"
+LOCK_KEY = "archive:lock"
+
+
+def _micro(v) -> int:
+    return int(round(float(v) * 1e6)) if v not in (None, "") else -2**31
+
+
+def _from_micro(v: int):
+    return None if v == -2**31 else str(v / 1e6)
+
+
+def _pack_strings(values) -> bytes:
+    raw = [v.encode() for v in values]
+    return array("I", (len(b) for b in raw)).tobytes() + b"".join(raw)
+
+
+def _unpack_strings(raw: bytes, n: int) -> list:
+    lengths = array("I", raw[:n * array("I").itemsize])
+    out, pos = [], len(lengths) * lengths.itemsize
+    for length in lengths:
+        out.append(raw[pos:pos + length].decode())
+        pos += length
+    return out
+
+
+def write_segment(directory: str, rows) -> str:
+    """rows: iterable of (ride_id, closed_at, ride hash). Returns the segment path."""
+    rows = sorted(rows, key=lambda row: int(row[0]))
+    columns = {
+        "ride_id": ("q", array("q", (int(rid) for rid, _, _ in rows)).tobytes()),
+        "closed_at": ("d", array("d", (float(ts) for _, ts, _ in rows)).tobytes()),
+        "status": ("B", array("B", (STATUSES.index(h.get("status", "completed")) for _, _, h in rows)).tobytes()),
+        "rider_id": ("strs", _pack_strings(h.get("rider_id", "") for _, _, h in rows)),
+        "driver_id": ("strs", _pack_strings(h.get("driver_id", "") for _, _, h in rows)),
+    }
+    for name in COORDS:
+        columns[name] = ("i", array("i", (_micro(h.get(name)) for _, _, h in rows)).tobytes())
+
+    header = {"rows": len(rows), "min_id": int(rows[0][0]), "max_id": int(rows[-1][0]), "columns": {}}
+    blobs, offset = [], 0
+    for name, (kind, raw) in columns.items():
+        blob = zlib.compress(raw, 6)
+        header["columns"][name] = {"type": kind, "offset": offset, "length": len(blob)}
+        blobs.append(blob)
+        offset += len(blob)
+    head = json.dumps(header).encode()
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}{SUFFIX}")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(head)) + head)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)  # readers never see a partial segment
+    return path
+
+
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path}: not a ride segment")
+            (n,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(n))
+            self.base = len(MAGIC) + 4 + n
+        self.min_id = self.header["min_id"]
+        self.max_id = self.header["max_id"]
+        self._columns = {}  # name -> decoded column, filled on first use
+
+    def _column(self, name: str):
+        col = self._columns.get(name)
+        if col is None:
+            col = self._columns[name] = self._decode(name)
+        return col
+
+    def _decode(self, name: str):
+        meta = self.header["columns"][name]
+        with open(self.path, "rb") as f:
+            f.seek(self.base + meta["offset"])
+            raw = zlib.decompress(f.read(meta["length"]))
+        if meta["type"] == "strs":
+            return _unpack_strings(raw, self.header["rows"])
+        if meta["type"] == "str":
+            return raw.decode().split("\n")
+        return array(meta["type"], raw)
+
+    def find(self, ride_id: int):
+        """Row index of ride_id in this segment, or None."""
+        if not self.min_id <= ride_id <= self.max_id:
+            return None
+        ids = self._column("ride_id")
+        i = bisect.bisect_left(ids, ride_id)
+        return i if i < len(ids) and ids[i] == ride_id else None
+
+    def row(self, i: int) -> dict:
+        out = {
+            "rider_id": self._column("rider_id")[i],
+            "driver_id": self._column("driver_id")[i],
+            "status": STATUSES[self._column("status")[i]],
+        }
+        for name in COORDS:
+            out[name] = _from_micro(self._column(name)[i])
+        out["closed_at"] = f"{self._column('closed_at')[i]:.3f}"
+        return out
+
+
+class SegmentArchive:
+    """Read side: finds a ride in the segment files, picking up new segments as they land.
+
+    Only the id range of every segment is kept for all files; opened segments, with the
+    columns decoded so far, are cached up to `cache_segments`. The directory is listed
+    again only when its mtime changes.
+    """
+    def __init__(self, directory: str, cache_segments: int = 64):
+        self.directory = directory
+        self.cache_segments = cache_segments
+        self._lock = threading.Lock()
+        self._mtime = None  # directory mtime at the last listing
+        self._ranges = []  # (path, min_id, max_id), newest segment first
+        self._segments = OrderedDict()  # path -> Segment, least recently used first
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            known = {path: (lo, hi) for path, lo, hi in self._ranges}
+        # Segment names start with their write time in ms, so newest sorts first
+        paths = sorted((os.path.join(self.directory, n) for n in os.listdir(self.directory)
+                        if n.endswith(SUFFIX)), reverse=True)
+        ranges = []
+        for path in paths:
+            if path not in known:
+                try:
+                    seg = self._segment(path)
+                except FileNotFoundError:
+                    continue
+                known[path] = (seg.min_id, seg.max_id)
+            ranges.append((path, *known[path]))
+        # mtime has clock-tick granularity: a segment landing within the same tick as
+        # this listing would not change it, so a recent mtime is not trusted yet.
+        settled = time.time_ns() - mtime > 1_000_000_000
+        with self._lock:
+            self._ranges, self._mtime = ranges, mtime if settled else None
+
+    def _segment(self, path: str) -> Segment:
+        with self._lock:
+            seg = self._segments.pop(path, None)
+            if seg is None:
+                seg = Segment(path)
+            self._segments[path] = seg
+            while len(self._segments) > self.cache_segments:
+                self._segments.popitem(last=False)
+            return seg
+
+    def get(self, ride_id: int):
+        self._refresh()
+        # Id ranges overlap (lease ids are only roughly ordered), so every segment whose
+        # range holds the id is a candidate. Newest first: a ride archived twice (crash
+        # between write and delete) resolves to its latest copy.
+        with self._lock:
+            candidates = [path for path, lo, hi in self._ranges if lo <= ride_id <= hi]
+        for path in candidates:
+            try:
+                seg = self._segment(path)
+            except FileNotFoundError:
+                continue
+            i = seg.find(ride_id)
+            if i is not None:
+                return seg.row(i)
+        return None
+
+
+def archive_closed(r, directory: str, older_than_s: float, batch: int = 10000) -> int:
+    """Move rides closed more than `older_than_s` ago into one new segment.
+
+    A short Redis lock keeps concurrent archivers (several nodes) from writing the same
+    rides twice. Hashes are deleted only after the segment is on disk.
+    """
+    token = uuid.uuid4().hex
+    if not r.set(LOCK_KEY, token, nx=True, px=60000):
+        return 0
+    try:
+        closed = r.zrangebyscore(CLOSED_KEY, "-inf", time.time() - older_than_s, start=0, num=batch,
+                                 withscores=True)
+        if not closed:
+            return 0
+        pipe = r.pipeline(transaction=False)
+        for ride_id, _ in closed:
+            pipe.hgetall(f"ride:{ride_id}")
+        hashes = pipe.execute()
+        rows = [(ride_id, ts, decode(h)) for (ride_id, ts), h in zip(closed, hashes) if h]
+        if rows:
+            write_segment(directory, rows)
+        pipe = r.pipeline()
+        for ride_id, _ in closed:
+            pipe.delete(f"ride:{ride_id}")
+        pipe.zrem(CLOSED_KEY, *[ride_id for ride_id, _ in closed])
+        pipe.publish(INVALIDATE_CHANNEL, "\n".join(f"ride:{ride_id}" for ride_id, _ in closed))
+        pipe.execute()
+        return len(rows)
+    finally:
+        if r.get(LOCK_KEY) == token:
+            r.delete(LOCK_KEY)
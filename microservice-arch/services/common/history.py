@@ -0,0 +1,96 @@
+"""Per-rider and per-driver ride history.
+
+``rider:<id>:rides`` and ``driver:<id>:rides`` are sorted sets of ride ids scored by
+request time. record() queues both ZADDs on the pipeline that writes the ride, so the
+indexes never disagree with the rides themselves.
+
+A page is one Lua call, so one round trip: ZREVRANK of the cursor, ZREVRANGE
+(O(log N + page size)) and an HGETALL per ride on the page. The cursor is the last ride id of the previous page,
+so rides requested while a client is paging don't shift the pages that follow.
+"""
+import asyncio
+
+from .ridecodec import decode
+
+ROLES = ("rider", "driver")
+MAX_PAGE = 100
+
+# KEYS: history sorted set
+# ARGV: cursor ride id ('' for the first page), page size
+# Returns {ids, hashes}: up to page size + 1 ride ids, newest first, and the flat HGETALL
+# of each of the first page size; false if the cursor is unknown. The ride keys are not
+# declared in KEYS, which is fine on a standalone Redis (rides are not cluster-sharded).
+_PAGE = """
+local start = 0
+if ARGV[1] ~= '' then
+  local rank = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+  if not rank then return false end
+  start = rank + 1
+end
+local ids = redis.call('ZREVRANGE', KEYS[1], start, start + tonumber(ARGV[2]))
+local hashes = {}
+for i = 1, math.min(#ids, tonumber(ARGV[2])) do
+  hashes[i] = redis.call('HGETALL', 'ride:' .. ids[i])
+end
+return {ids, hashes}
+"""
+
+
+def history_key(role: str, user_id: str) -> str:
+    return f"{role}:{user_id}:rides"
+
+
+def record(client, ride_id, rider_id: str, driver_id: str, ts: float):
+    """Queue the index writes for a new ride on `client` (the ride's own pipeline)."""
+    client.zadd(history_key("rider", rider_id), {str(ride_id): ts})
+    client.zadd(history_key("driver", driver_id), {str(ride_id): ts})
+
+
+class RideHistory:
+    """archive: optional SegmentArchive, consulted for rides no longer held in Redis."""
+    def __init__(self, r, archive=None):
+        self.r = r
+        self.archive = archive
+        self._page = r.register_script(_PAGE)
+
+    def page(self, role: str, user_id: str, cursor=None, limit: int = 20):
+        """Returns (rides, next_cursor); next_cursor is None on the last page.
+
+        Raises ValueError for an unknown role or a cursor that is not in this history.
+        """
+        limit = self._limit(role, limit)
+        reply = self._page(keys=[history_key(role, user_id)], args=[cursor or "", limit])
+        return self._result(reply, cursor, limit)
+
+    @staticmethod
+    def _limit(role: str, limit: int) -> int:
+        if role not in ROLES:
+            raise ValueError(f"unknown role {role!r}")
+        return max(1, min(limit, MAX_PAGE))
+
+    def _result(self, reply, cursor, limit: int):
+        if reply is None:
+            raise ValueError(f"cursor {cursor} is not in this history")
+        ids, hashes = reply
+        ids, more = ids[:limit], len(ids) > limit
+        rides = []
+        for ride_id, flat in zip(ids, hashes):
+            data = decode(dict(zip(flat[0::2], flat[1::2])))
+            if not data and self.archive is not None:
+                data = self.archive.get(int(ride_id))
+                if data is not None:
+                    data["archived"] = True
+            if data:
+                rides.append({"ride_id": int(ride_id), **data})
+        return rides, (ids[-1] if more else None)
+
+
+class AsyncRideHistory(RideHistory):
+    """RideHistory over a redis.asyncio client; page() is a coroutine."""
+    async def page(self, role: str, user_id: str, cursor=None, limit: int = 20):
+        limit = self._limit(role, limit)
+        reply = await self._page(keys=[history_key(role, user_id)], args=[cursor or "", limit])
+        if reply is not None and self.archive is not None and not all(reply[1][:limit]):
+            # Some rides are only in the archive: its file reads go off the loop
+            return await asyncio.to_thread(self._result, reply, cursor, limit)
+        return self._result(reply, cursor, limit)
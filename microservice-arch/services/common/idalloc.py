@@ -0,0 +1,119 @@
+"""Ride id allocation without a round trip per ride.
+
+    lease      (default) INCRBY seq:ride by RIDE_ID_BLOCK and hand the range out locally;
+               one round trip per block. Ids stay unique and small but are only
+               roughly ordered across processes, and a restart skips the rest of a block.
+    snowflake  no Redis at all: 41 bits of milliseconds since EPOCH_MS, 10 bits of node
+               id, 12 bits of sequence. Needs a distinct node id (0-1023) per process.
+    incr       the old behaviour, one INCR per ride.
+
+All three draw from or stay clear of the same counter space: lease and incr share
+``seq:ride``, and snowflake ids are far above anything the counter will reach.
+"""
+import os
+import re
+import threading
+import time
+import zlib
+
+MODE = os.getenv("RIDE_ID_MODE", "lease")
+BLOCK = int(os.getenv("RIDE_ID_BLOCK", "1000"))
+SEQ_KEY = "seq:ride"
+EPOCH_MS = 1_735_689_600_000  # 2025-01-01T00:00:00Z
+NODE_BITS, SEQ_BITS = 10, 12
+
+
+def node_number(node_id: str) -> int:
+    """0-1023 from a node name: its trailing number if it has one ("node3" -> 3)."""
+    m = re.search(r"(\d+)$", node_id or "")
+    n = int(m.group(1)) if m else zlib.crc32(node_id.encode())
+    return n % (1 << NODE_BITS)
+
+
+class LeasedIds:
+    def __init__(self, r, block: int = BLOCK, key: str = SEQ_KEY):
+        self.r = r
+        self.block = block
+        self.key = key
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+
+    def take(self):
+        """The next id if the current block has one, else None (next() refills)."""
+        with self._lock:
+            if self._next >= self._end:
+                return None
+            ride_id = self._next
+            self._next += 1
+            return ride_id
+
+    def next(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                # INCRBY returns the last id of the new block
+                self._end = self.r.incrby(self.key, self.block) + 1
+                self._next = self._end - self.block
+            ride_id = self._next
+            self._next += 1
+            return ride_id
+
+
+class SnowflakeIds:
+    def __init__(self, node: int, clock=time.time):
+        if not 0 <= node < 1 << NODE_BITS:
+            raise ValueError(f"node must be 0-{(1 << NODE_BITS) - 1}, got {node}")
+        self.node = node
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._seq = 0
+
+    def next(self) -> int:
+        return self._issue(wait=True)
+
+    def take(self):
+        """The next id, or None if this millisecond is used up (next() waits for the next)."""
+        return self._issue(wait=False)
+
+    def _issue(self, wait: bool):
+        with self._lock:
+            now = int(self.clock() * 1000)
+            if now < self._last_ms:
+                # Clock stepped back: keep issuing from the last timestamp seen
+                now = self._last_ms
+            if now == self._last_ms:
+                seq = (self._seq + 1) & ((1 << SEQ_BITS) - 1)
+                if seq == 0:
+                    # 4096 ids this millisecond already; wait for the next one
+                    if not wait:
+                        return None
+                    while now <= self._last_ms:
+                        now = int(self.clock() * 1000)
+            else:
+                seq = 0
+            self._seq, self._last_ms = seq, now
+            return ((now - EPOCH_MS) << (NODE_BITS + SEQ_BITS)) | (self.node << SEQ_BITS) | seq
+
+
+class IncrIds:
+    def __init__(self, r, key: str = SEQ_KEY):
+        self.r = r
+        self.key = key
+
+    def take(self):
+        """Always None: every id is a Redis call."""
+        return None
+
+    def next(self) -> int:
+        return self.r.incr(self.key)
+
+
+def ride_ids(r, node_id: str, mode: str = None, block: int = BLOCK):
+    mode = mode or MODE
+    if mode == "lease":
+        return LeasedIds(r, block)
+    if mode == "snowflake":
+        return SnowflakeIds(node_number(node_id))
+    if mode == "incr":
+        return IncrIds(r)
+    raise ValueError(f"unknown RIDE_ID_MODE {mode!r}")
@@ -0,0 +1,91 @@
+"""Compact binary wire format for batches of driver location updates.
+
+Frame layout (little endian):
+    header:  b"LOC1" + uint32 record count
+    record:  uint8 id length, id bytes (utf-8), int32 lat*1e6, int32 lon*1e6, uint8 flags
+
+Coordinates are scaled to micro-degrees (~0.11 m), which is well below GPS noise
+and keeps each record at 10 bytes plus the driver id.
+
+check() holds the limits every location path enforces: what GEOADD accepts and what a
+frame can carry. Batches drop the records that fail it and report them by index.
+"""
+import math
+import struct
+
+CONTENT_TYPE = "application/x-location-batch"
+MAGIC = b"LOC1"
+SCALE = 1_000_000
+
+_HEADER = struct.Struct("<4sI")
+_BODY = struct.Struct("<iiB")
+_AVAILABLE = 0x01
+
+# GEOADD rejects anything outside these (Web Mercator latitude limit)
+MAX_LAT = 85.05112878
+MAX_LON = 180.0
+MAX_ID_BYTES = 255
+
+
+def check(driver_id: str, lat: float, lon: float):
+    """Raises ValueError unless the update can be framed and indexed."""
+    if len(driver_id.encode("utf-8")) > MAX_ID_BYTES:
+        raise ValueError(f"driver_id longer than {MAX_ID_BYTES} bytes")
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        raise ValueError("lat/lon must be finite")
+    if abs(lat) > MAX_LAT or abs(lon) > MAX_LON:
+        raise ValueError(f"lat/lon out of range: {lat}, {lon}")
+
+
+def rejection(index: int, driver_id, error) -> dict:
+    return {"index": index, "driver_id": driver_id, "error": str(error)}
+
+
+def pack_updates(updates) -> bytes:
+    """updates: iterable of (driver_id, lat, lon, available) tuples."""
+    updates = list(updates)
+    out = bytearray(_HEADER.pack(MAGIC, len(updates)))
+    for driver_id, lat, lon, available in updates:
+        check(driver_id, lat, lon)
+        raw = driver_id.encode("utf-8")
+        out.append(len(raw))
+        out += raw
+        out += _BODY.pack(round(lat * SCALE), round(lon * SCALE), _AVAILABLE if available else 0)
+    return bytes(out)
+
+
+def unpack_updates(data: bytes, rejected=None):
+    """Inverse of pack_updates. Raises ValueError on a malformed frame.
+
+    Records that fail check() raise too, unless a `rejected` list is given: then they
+    are left out and described there (see rejection()).
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("truncated header")
+    magic, count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("bad magic")
+    off = _HEADER.size
+    updates = []
+    try:
+        for i in range(count):
+            n = data[off]
+            off += 1
+            driver_id = data[off:off + n].decode("utf-8")
+            off += n
+            lat, lon, flags = _BODY.unpack_from(data, off)
+            off += _BODY.size
+            lat, lon = lat / SCALE, lon / SCALE
+            try:
+                check(driver_id, lat, lon)
+            except ValueError as e:
+                if rejected is None:
+                    raise
+                rejected.append(rejection(i, driver_id, e))
+                continue
+            updates.append((driver_id, lat, lon, bool(flags & _AVAILABLE)))
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed record: {e}")
+    if off != len(data):
+        raise ValueError("trailing bytes after last record")
+    return updates
@@ -0,0 +1,104 @@
+"""Minimal in-process metrics: thread-safe counters, gauges and histograms, exposed as JSON."""
+import bisect
+import threading
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge:
+    """Either set explicitly or computed from a callback at snapshot time."""
+    def __init__(self, fn=None):
+        self._lock = threading.Lock()
+        self.fn = fn
+        self.value = 0
+
+    def set(self, v):
+        self.value = v
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def read(self):
+        return self.fn() if self.fn else self.value
+
+
+class Histogram:
+    """Latency histogram over fixed bucket bounds (seconds); quantiles are bucket upper bounds."""
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+              0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=BOUNDS):
+        self._lock = threading.Lock()
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, v: float):
+        i = bisect.bisect_left(self.bounds, v)
+        with self._lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.sum += v
+
+    def quantile(self, q: float) -> float:
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]  # overflow bucket: reported as the largest bound
+
+    def read(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "sum_s": round(self.sum, 6), "p50_s": self.quantile(0.5),
+                "p95_s": self.quantile(0.95), "p99_s": self.quantile(0.99)}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def counter(self, name: str) -> Counter:
+        with self._lock:
+            return self.counters.setdefault(name, Counter())
+
+    def gauge(self, name: str, fn=None) -> Gauge:
+        with self._lock:
+            g = self.gauges.setdefault(name, Gauge(fn))
+            if fn is not None:
+                g.fn = fn
+            return g
+
+    def histogram(self, name: str) -> Histogram:
+        with self._lock:
+            return self.histograms.setdefault(name, Histogram())
+
+    def snapshot(self) -> dict:
+        out = {name: c.value for name, c in self.counters.items()}
+        out.update((name, h.read()) for name, h in self.histograms.items())
+        for name, g in self.gauges.items():
+            try:
+                out[name] = g.read()
+            except Exception as e:  # a broken gauge must not take down /metrics
+                out[name] = f"error: {e}"
+        return out
+
+
+REGISTRY = Registry()
@@ -0,0 +1,59 @@
+"""Ride hash layouts.
+
+    hash     (default) rider_id, driver_id, status, pickup_lat, ... as text
+    compact  r, d, s, pa, po, da, do; status as a small int, coordinates as integer
+             micro-degrees, which Redis keeps as integers inside the hash's listpack
+
+RIDE_ENCODING only picks the layout new rides are written in. decode() reads either,
+and the transition script updates a ride in whatever layout it already has, so the
+setting can change without migrating existing rides. Compact saves about 40% of
+Redis memory per ride (see microservice-arch/bench_ride_encoding.py).
+"""
+import os
+
+ENCODING = os.getenv("RIDE_ENCODING", "hash")
+STATUSES = ("matched", "ongoing", "completed", "cancelled")
+COORDS = ("pickup_lat", "pickup_lon", "dest_lat", "dest_lon")
+SHORT = {"rider_id": "r", "driver_id": "d", "status": "s",
+         "pickup_lat": "pa", "pickup_lon": "po", "dest_lat": "da", "dest_lon": "do"}
+LONG = {v: k for k, v in SHORT.items()}
+
+# HMGET these, then state_of(), to read status and driver in either layout
+STATE_FIELDS = ("status", "driver_id", "s", "d")
+
+
+def encode(ride: dict, encoding: str = None) -> dict:
+    """HSET mapping for a ride given with its full field names."""
+    if (encoding or ENCODING) != "compact":
+        return ride
+    out = {}
+    for name, value in ride.items():
+        if name == "status":
+            value = STATUSES.index(value)
+        elif name in COORDS:
+            value = round(float(value) * 1e6)
+        out[SHORT.get(name, name)] = value
+    return out
+
+
+def decode(h: dict) -> dict:
+    """Ride hash (either layout) with full field names and text values."""
+    if "s" not in h:
+        return h
+    out = {}
+    for field, value in h.items():
+        name = LONG.get(field, field)
+        if name == "status":
+            value = STATUSES[int(value)]
+        elif name in COORDS:
+            value = str(int(value) / 1e6)
+        out[name] = value
+    return out
+
+
+def state_of(values):
+    """(status, driver_id) from an HMGET of STATE_FIELDS."""
+    status, driver_id, code, short_driver = values
+    if status is None and code is not None:
+        return STATUSES[int(code)], short_driver
+    return status, driver_id
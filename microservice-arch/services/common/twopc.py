@@ -0,0 +1,264 @@
+"""Durable state for the trip-completion 2PC: decision log, prepared records, recovery.
+
+Presumed abort: only commit decisions are logged, so an aborted transaction costs no
+log write, and a prepared transaction with no commit record is treated as aborted once
+it is older than the in-doubt window.
+
+A transaction covers a list of (ride_id, driver_id) items: one for a single completion,
+many under group commit.
+
+- Decision log: Redis stream ``2pc:decisions``, one entry per committed transaction,
+  listing the items that committed, plus a key ``2pc:decided:<tx_id>`` holding the same
+  items, written in the same MULTI. The stream is the audit trail; the sweeper and
+  recovery look transactions up by key instead of reading the stream.
+  The coordinator appends it before sending GlobalCommit. Under one-phase commit the
+  last participant appends it in the same MULTI as its own commit.
+- Prepared records: hash ``2pc:prepared:<participant>``, transaction id -> JSON payload.
+  Written when voting commit, deleted in the same MULTI that applies the outcome.
+- Pending table: the in-memory side of the prepared records, bounded and with a
+  deadline per entry; a sweeper resolves entries whose outcome never arrived.
+"""
+import functools
+import heapq
+import json
+import os
+import threading
+import time
+
+from services.common.metrics import REGISTRY
+
+DECISIONS_KEY = "2pc:decisions"
+# Approximate cap on the decision log. It must cover the longest participant outage.
+DECISIONS_MAXLEN = int(os.getenv("TWOPC_DECISIONS_MAXLEN", "100000"))
+DECIDED_PREFIX = "2pc:decided:"
+# Lifetime of the per-transaction decision keys; the same bound as the stream cap.
+DECISION_TTL_S = int(os.getenv("TWOPC_DECISION_TTL_S", str(7 * 24 * 3600)))
+LOOKUP_CHUNK = 1000
+INDOUBT_S = float(os.getenv("TWOPC_INDOUBT_S", "30"))
+# Prepares beyond this are refused (voted abort) instead of growing the pending table.
+PENDING_MAX = int(os.getenv("TWOPC_PENDING_MAX", "1000000"))
+SWEEP_INTERVAL_S = float(os.getenv("TWOPC_SWEEP_INTERVAL_S", "1"))
+
+m_recovered_commit = REGISTRY.counter("twopc_recovered_committed")
+m_recovered_abort = REGISTRY.counter("twopc_recovered_aborted")
+m_expired_commit = REGISTRY.counter("twopc_expired_committed")
+m_expired_abort = REGISTRY.counter("twopc_expired_aborted")
+
+
+def timed(phase: str):
+    """Record a participant RPC handler's latency in twopc_participant_<phase>_seconds."""
+    hist = REGISTRY.histogram(f"twopc_participant_{phase}_seconds")
+
+    def wrap(fn):
+        @functools.wraps(fn)
+        def handler(self, request, context):
+            t0 = time.perf_counter()
+            try:
+                return fn(self, request, context)
+            finally:
+                hist.observe(time.perf_counter() - t0)
+        return handler
+    return wrap
+
+
+def count_vote(reply, abort_reason: str = None):
+    """Count a participant's vote; abort_reason names the counter for a vote to abort."""
+    if not reply.vote_commit:
+        REGISTRY.counter(f"twopc_participant_abort_{abort_reason or 'unknown'}").inc()
+        REGISTRY.counter("twopc_participant_votes_abort").inc()
+    elif reply.read_only:
+        REGISTRY.counter("twopc_participant_votes_read_only").inc()
+    else:
+        REGISTRY.counter("twopc_participant_votes_commit").inc()
+
+
+def items_of(request) -> list:
+    """(ride_id, driver_id) items of a VoteRequestArgs/GlobalCommitArgs message."""
+    if request.ride_ids or request.driver_ids:
+        return list(zip(request.ride_ids, request.driver_ids))
+    if request.ride_id or request.driver_id:
+        return [(request.ride_id, request.driver_id)]
+    return []
+
+
+class DecisionLog:
+    def __init__(self, r):
+        self.r = r
+
+    def log_commit(self, tx_id: str, items, client=None):
+        """Append a commit record and its decision key, in one MULTI.
+
+        Pass a pipeline as `client` to make them part of its MULTI instead.
+        """
+        pipe = self.r.pipeline() if client is None else client
+        encoded = json.dumps([list(i) for i in items])
+        pipe.xadd(DECISIONS_KEY, {"tx": tx_id, "items": encoded}, maxlen=DECISIONS_MAXLEN, approximate=True)
+        pipe.set(DECIDED_PREFIX + tx_id, encoded, ex=DECISION_TTL_S)
+        if client is None:
+            pipe.execute()
+
+    def lookup(self, tx_ids) -> dict:
+        """Transaction id -> committed items, for those of `tx_ids` with a commit record.
+
+        One round trip: an MGET per chunk of ids, pipelined.
+        """
+        tx_ids = list(tx_ids)
+        if not tx_ids:
+            return {}
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(tx_ids), LOOKUP_CHUNK):
+            pipe.mget([DECIDED_PREFIX + tx for tx in tx_ids[i:i + LOOKUP_CHUNK]])
+        raws = [raw for chunk in pipe.execute() for raw in chunk]
+        return {tx: json.loads(raw) for tx, raw in zip(tx_ids, raws) if raw}
+
+
+class PreparedStore:
+    def __init__(self, r, participant: str):
+        self.r = r
+        self.key = f"2pc:prepared:{participant}"
+
+    def prepare(self, tx_id: str, payload: dict, client=None):
+        (client or self.r).hset(self.key, tx_id, json.dumps({**payload, "ts": time.time()}))
+
+    def forget(self, tx_id: str, client=None):
+        (client or self.r).hdel(self.key, tx_id)
+
+    def get(self, tx_id: str):
+        raw = self.r.hget(self.key, tx_id)
+        return json.loads(raw) if raw else None
+
+    def size(self) -> int:
+        return self.r.hlen(self.key)
+
+    def load(self) -> dict:
+        return {tx: json.loads(raw) for tx, raw in self.r.hgetall(self.key).items()}
+
+
+class _Pending:
+    __slots__ = ("deadline", "tx_id", "items")
+
+    def __init__(self, deadline, tx_id, items):
+        self.deadline = deadline
+        self.tx_id = tx_id
+        self.items = items
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class PendingTable:
+    """Prepared transactions waiting for their outcome, each with a deadline.
+
+    Records sit in a dict for lookup and in a min-heap by deadline for expiry. pop()
+    only unlinks the dict entry; the heap drops the record when its deadline passes, or
+    sooner once dead records outnumber live ones and the heap is rebuilt. The heap thus
+    stays within about twice `max_size`, whatever the throughput.
+    """
+    def __init__(self, ttl_s: float = INDOUBT_S, max_size: int = PENDING_MAX, clock=time.monotonic):
+        self.ttl_s = ttl_s
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._by_tx = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._by_tx)
+
+    def full(self) -> bool:
+        """Checked before voting; a full table votes abort rather than grow."""
+        return len(self._by_tx) >= self.max_size
+
+    def add(self, tx_id: str, items, ttl_s: float = None):
+        rec = _Pending(self.clock() + (self.ttl_s if ttl_s is None else ttl_s), tx_id, items)
+        with self._lock:
+            self._by_tx[tx_id] = rec
+            heapq.heappush(self._heap, rec)
+            self._compact()
+
+    def pop(self, tx_id: str):
+        with self._lock:
+            rec = self._by_tx.pop(tx_id, None)
+            self._compact()
+        return rec.items if rec else None
+
+    def _compact(self):
+        # Amortised O(1): a rebuild costs O(live) and follows at least as many pops
+        if len(self._heap) > 2 * len(self._by_tx) + 64:
+            self._heap = list(self._by_tx.values())
+            heapq.heapify(self._heap)
+
+    def expire(self) -> list:
+        """Remove and return (tx_id, items) of every entry past its deadline."""
+        now, out = self.clock(), []
+        with self._lock:
+            while self._heap and self._heap[0].deadline <= now:
+                rec = heapq.heappop(self._heap)
+                if self._by_tx.get(rec.tx_id) is rec:
+                    del self._by_tx[rec.tx_id]
+                    out.append((rec.tx_id, rec.items))
+        return out
+
+
+def sweep(r, table: PendingTable, store: PreparedStore, log: DecisionLog, apply_commit) -> dict:
+    """Resolve expired prepares: commit those the decision log has, abort the rest."""
+    expired = table.expire()
+    if not expired:
+        return {"committed": 0, "aborted": 0}
+    committed = log.lookup(tx_id for tx_id, _ in expired)
+    pipe = r.pipeline()
+    n_commit = 0
+    for tx_id, _ in expired:
+        if tx_id in committed:
+            apply_commit(pipe, committed[tx_id])
+            n_commit += 1
+        store.forget(tx_id, client=pipe)
+    pipe.execute()
+    m_expired_commit.inc(n_commit)
+    m_expired_abort.inc(len(expired) - n_commit)
+    return {"committed": n_commit, "aborted": len(expired) - n_commit}
+
+
+def sweep_loop(participant, interval_s: float = SWEEP_INTERVAL_S):
+    """Run participant.sweep() every `interval_s`; meant for a daemon thread."""
+    while True:
+        time.sleep(interval_s)
+        try:
+            res = participant.sweep()
+            if res["committed"] or res["aborted"]:
+                print(f"[{participant.name}] Expired prepares: {res['committed']} committed, "
+                      f"{res['aborted']} aborted")
+        except Exception as e:
+            print(f"[{participant.name}] Sweeper failed: {e}")
+
+
+def recover(r, store: PreparedStore, log: DecisionLog, apply_commit, indoubt_s: float = INDOUBT_S) -> dict:
+    """Resolve this participant's prepared transactions in bulk.
+
+    apply_commit(pipe, items) queues the participant's commit work on a pipeline.
+    Committed transactions are applied with the items from their commit record, prepared ones older than `indoubt_s` with no
+    commit record are dropped (presumed abort), younger ones are left in flight and
+    returned so the caller can keep tracking them.
+    """
+    prepared = store.load()
+    if not prepared:
+        return {"committed": 0, "aborted": 0, "in_flight": {}}
+    committed = log.lookup(prepared)
+    cutoff = time.time() - indoubt_s
+    pipe = r.pipeline()  # MULTI: outcomes and prepared-record cleanup land together
+    n_commit = n_abort = 0
+    in_flight = {}
+    for tx_id, payload in prepared.items():
+        if tx_id in committed:
+            apply_commit(pipe, committed[tx_id])
+            n_commit += 1
+        elif payload.get("ts", 0) <= cutoff:
+            n_abort += 1
+        else:
+            in_flight[tx_id] = payload
+            continue
+        store.forget(tx_id, client=pipe)
+    pipe.execute()
+    m_recovered_commit.inc(n_commit)
+    m_recovered_abort.inc(n_abort)
+    return {"committed": n_commit, "aborted": n_abort, "in_flight": in_flight}
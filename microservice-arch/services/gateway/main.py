@@ -1,15 +1,105 @@
 import os
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import json
+import time
+import asyncio
+from fastapi import FastAPI, Header, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 import httpx
 
+from services.common import locwire, tokens
+
 AUTH = os.getenv("AUTH_URL", "http://auth:8001")
 LOC = os.getenv("LOCATION_URL", "http://location:8002")
 MATCH = os.getenv("MATCHING_URL", "http://matching:8003")
 TRIP = os.getenv("TRIP_URL", "http://trip:8004")
 
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "100"))
+STREAM_MAX_BATCH = int(os.getenv("STREAM_MAX_BATCH", "2000"))
+
 app = FastAPI(title="Gateway")
 
+class LocationCoalescer:
+    """Keeps the latest position per driver and flushes micro-batches to the location service.
+
+    Streams from many drivers (or fleet aggregators) feed one shared buffer, so a driver that
+    pings several times inside one flush window costs a single Redis write.
+    """
+    def __init__(self, flush_ms: int, max_batch: int):
+        self.flush_s = flush_ms / 1000.0
+        self.max_batch = max_batch
+        self.latest = {}
+        self.full = asyncio.Event()
+        self.client = None
+        self.stats = {"received": 0, "flushed": 0, "batches": 0, "flush_errors": 0}
+
+    def offer(self, updates):
+        for u in updates:
+            self.latest[u[0]] = u
+        self.stats["received"] += len(updates)
+        if len(self.latest) >= self.max_batch:
+            self.full.set()
+
+    async def run(self):
+        self.client = httpx.AsyncClient(timeout=10.0)
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=self.flush_s)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # This task serves every stream; a batch it can't send must not stop it
+                self.stats["flush_errors"] += 1
+                print(f"[Gateway] location flush failed: {e!r}")
+
+    async def flush(self):
+        if not self.latest:
+            return
+        batch, self.latest = list(self.latest.values()), {}
+        try:
+            r = await self.client.post(
+                f"{LOC}/drivers/location/batch",
+                content=locwire.pack_updates(batch),
+                # Carries many drivers' positions, so it goes out under a service token
+                headers={"content-type": locwire.CONTENT_TYPE,
+                         "authorization": f"Bearer {tokens.issue('gateway', tokens.SERVICE_ROLE)}"},
+            )
+            r.raise_for_status()
+            self.stats["flushed"] += len(batch)
+            self.stats["batches"] += 1
+        except httpx.HTTPError as e:
+            self.stats["flush_errors"] += 1
+            print(f"[Gateway] location flush of {len(batch)} updates failed: {e}")
+
+coalescer = LocationCoalescer(STREAM_FLUSH_MS, STREAM_MAX_BATCH)
+
+@app.on_event("startup")
+async def startup_event():
+    asyncio.create_task(coalescer.run())
+
+def parse_stream_text(text: str):
+    """(updates, rejected) from a text frame: one update object or a list of them.
+
+    Skips pydantic on this path; each record gets locwire.check(), so nothing reaches the
+    coalescer that the location service would refuse or a frame could not carry.
+    """
+    data = json.loads(text)
+    items = data if isinstance(data, list) else [data]
+    updates, rejected = [], []
+    for i, u in enumerate(items):
+        try:
+            update = (str(u["driver_id"]), float(u["lat"]), float(u["lon"]), bool(u.get("available", True)))
+            locwire.check(*update[:3])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            rejected.append(locwire.rejection(i, u.get("driver_id") if isinstance(u, dict) else None,
+                                              f"missing {e}" if isinstance(e, KeyError) else e))
+            continue
+        updates.append(update)
+    return updates, rejected
+
 class Register(BaseModel):
     user_id: str
     role: str
@@ -19,8 +109,8 @@ class Login(BaseModel):
 
 class DriverLocation(BaseModel):
     driver_id: str
-    lat: float
-    lon: float
+    lat: float = Field(ge=-locwire.MAX_LAT, le=locwire.MAX_LAT)
+    lon: float = Field(ge=-locwire.MAX_LON, le=locwire.MAX_LON)
     available: bool = True
 
 class RideReq(BaseModel):
@@ -30,6 +120,27 @@ class RideReq(BaseModel):
     dest_lat: float
     dest_lon: float
 
+def require_user(authorization, user_id: str, role: str):
+    # Token checked locally (HMAC), no Redis lookup
+    try:
+        tokens.authorize(authorization, user_id, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+def require_users(authorization, user_ids, role: str):
+    # Batches: every id must be the token's subject, unless it is a service token
+    try:
+        tokens.authorize_many(authorization, user_ids, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+def forward_auth(authorization):
+    return {"Authorization": authorization} if authorization else None
+
 @app.post("/auth/register")
 async def gw_register(p: Register):
     async with httpx.AsyncClient() as c:
@@ -38,6 +149,25 @@ async def gw_register(p: Register):
         raise HTTPException(status_code=r.status_code, detail=r.json())
     return r.json()
 
+@app.post("/auth/register/batch")
+async def gw_register_batch(request: Request):
+    # Passed through as-is; the body can hold thousands of users
+    async with httpx.AsyncClient(timeout=30) as c:
+        r = await c.post(f"{AUTH}/register/batch", content=await request.body(),
+                         headers={"Content-Type": "application/json"})
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    return r.json()
+
+@app.post("/auth/users/exists")
+async def gw_users_exist(request: Request):
+    async with httpx.AsyncClient(timeout=30) as c:
+        r = await c.post(f"{AUTH}/users/exists", content=await request.body(),
+                         headers={"Content-Type": "application/json"})
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    return r.json()
+
 @app.post("/auth/login")
 async def gw_login(p: Login):
     async with httpx.AsyncClient() as c:
@@ -47,17 +177,98 @@ async def gw_login(p: Login):
     return r.json()
 
 @app.post("/drivers/location")
-async def gw_loc(p: DriverLocation):
+async def gw_loc(p: DriverLocation, authorization: str = Header(None)):
+    require_user(authorization, p.driver_id, "driver")
+    async with httpx.AsyncClient() as c:
+        r = await c.post(f"{LOC}/drivers/location", json=p.model_dump(), headers=forward_auth(authorization))
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    return r.json()
+
+@app.post("/drivers/location/batch")
+async def gw_loc_batch(request: Request, authorization: str = Header(None)):
+    # Forward the raw body so binary frames are not re-parsed here. The token is checked
+    # here, its driver ids against the records by the location service.
+    require_users(authorization, [], "driver")
+    body = await request.body()
+    headers = {"content-type": request.headers.get("content-type", "application/json"),
+               **(forward_auth(authorization) or {})}
     async with httpx.AsyncClient() as c:
-        r = await c.post(f"{LOC}/drivers/location", json=p.model_dump())
+        r = await c.post(f"{LOC}/drivers/location/batch", content=body, headers=headers)
     if r.status_code >= 400:
         raise HTTPException(status_code=r.status_code, detail=r.json())
     return r.json()
 
+@app.websocket("/drivers/stream")
+async def gw_loc_stream(ws: WebSocket):
+    # Long-lived channel for a driver app or fleet aggregator. Text frames carry JSON,
+    # binary frames carry locwire batches. Updates are acknowledged only on error: a
+    # malformed frame gets {"error"}, invalid records {"rejected": [...]} while the
+    # rest of the frame is still applied.
+    # With AUTH_REQUIRED the token (Authorization header, or ?token= for browsers) is
+    # checked at connect and again on every frame, so it expires mid-stream too: a
+    # driver token may only report its own position, a service token anyone's.
+    token = ws.query_params.get("token")
+    authorization = f"Bearer {token}" if token else ws.headers.get("authorization")
+    try:
+        tokens.authorize_many(authorization, [], "driver")
+    except (tokens.InvalidToken, PermissionError):
+        await ws.close(code=1008)
+        return
+    await ws.accept()
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            try:
+                if msg.get("bytes") is not None:
+                    rejected = []
+                    updates = locwire.unpack_updates(msg["bytes"], rejected)
+                else:
+                    updates, rejected = parse_stream_text(msg.get("text") or "")
+            except (ValueError, KeyError, TypeError) as e:
+                await ws.send_json({"error": str(e)})
+                continue
+            try:
+                tokens.authorize_many(authorization, [u[0] for u in updates], "driver")
+            except tokens.InvalidToken as e:
+                await ws.close(code=1008, reason=str(e))
+                break
+            except PermissionError as e:
+                await ws.send_json({"error": str(e)})
+                continue
+            if rejected:
+                await ws.send_json({"rejected": rejected})
+            coalescer.offer(updates)
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/drivers/stream/stats")
+def gw_loc_stream_stats():
+    return {**coalescer.stats, "buffered": len(coalescer.latest), "cpu_s": time.process_time()}
+
 @app.post("/rides/request")
-async def gw_request(p: RideReq):
+async def gw_request(p: RideReq, authorization: str = Header(None)):
+    require_user(authorization, p.rider_id, "rider")
+    async with httpx.AsyncClient() as c:
+        r = await c.post(f"{MATCH}/rides/request", json=p.model_dump(), headers=forward_auth(authorization))
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    return r.json()
+
+@app.get("/riders/{rider_id}/rides")
+async def gw_rider_rides(rider_id: str, cursor: str = None, limit: int = 20):
     async with httpx.AsyncClient() as c:
-        r = await c.post(f"{MATCH}/rides/request", json=p.model_dump())
+        r = await c.get(f"{MATCH}/riders/{rider_id}/rides", params={"cursor": cursor, "limit": limit})
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    return r.json()
+
+@app.get("/drivers/{driver_id}/rides")
+async def gw_driver_rides(driver_id: str, cursor: str = None, limit: int = 20):
+    async with httpx.AsyncClient() as c:
+        r = await c.get(f"{MATCH}/drivers/{driver_id}/rides", params={"cursor": cursor, "limit": limit})
     if r.status_code >= 400:
         raise HTTPException(status_code=r.status_code, detail=r.json())
     return r.json()
@@ -70,10 +281,48 @@ async def gw_start(ride_id: int):
         raise HTTPException(status_code=r.status_code, detail=r.json())
     return r.json()
 
+@app.post("/trips/{ride_id}/cancel")
+async def gw_cancel(ride_id: int):
+    async with httpx.AsyncClient() as c:
+        r = await c.post(f"{TRIP}/trips/{ride_id}/cancel")
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    return r.json()
+
 @app.post("/trips/{ride_id}/complete")
-async def gw_complete(ride_id: int):
+async def gw_complete(ride_id: int, run_async: bool = Query(False, alias="async")):
     async with httpx.AsyncClient() as c:
-        r = await c.post(f"{TRIP}/trips/{ride_id}/complete")
+        r = await c.post(f"{TRIP}/trips/{ride_id}/complete", params={"async": "true"} if run_async else None)
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+    # 202 with a transaction id in async mode
+    return JSONResponse(status_code=r.status_code, content=r.json())
+
+@app.get("/transactions/{tx_id}")
+async def gw_transaction(tx_id: str):
+    async with httpx.AsyncClient() as c:
+        r = await c.get(f"{TRIP}/transactions/{tx_id}")
     if r.status_code >= 400:
         raise HTTPException(status_code=r.status_code, detail=r.json())
     return r.json()
+
+@app.get("/transactions/{tx_id}/events")
+async def gw_transaction_events(tx_id: str):
+    # Relay the trip service's event stream as it arrives
+    c = httpx.AsyncClient(timeout=None)
+    r = await c.send(c.build_request("GET", f"{TRIP}/transactions/{tx_id}/events"), stream=True)
+    if r.status_code >= 400:
+        await r.aread()
+        await r.aclose()
+        await c.aclose()
+        raise HTTPException(status_code=r.status_code, detail=r.json())
+
+    async def relay():
+        try:
+            async for chunk in r.aiter_raw():
+                yield chunk
+        finally:
+            await r.aclose()
+            await c.aclose()
+
+    return StreamingResponse(relay(), media_type="text/event-stream")
@@ -1,6 +1,8 @@
 import os
-from fastapi import FastAPI
-from pydantic import BaseModel
+from typing import Any, Dict, List
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
 import redis
 
 import grpc
@@ -8,63 +10,153 @@ from concurrent import futures
 import twophase_pb2
 import twophase_pb2_grpc
 import threading
+import time
+from collections import OrderedDict
 
+from services.common import locwire, tokens
+from services.common.geoshard import ShardedGeoIndex, split_urls
+from services.common.metrics import REGISTRY
+from services.common.twopc import (
+    INDOUBT_S, DecisionLog, PendingTable, PreparedStore, count_vote, items_of, recover, sweep, sweep_loop, timed,
+)
+from services.location_service.writebehind import WriteBehind
 
 r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
 app = FastAPI(title="Location Service")
 
+# Write-behind tuning. The defaults write every update through immediately.
+FLUSH_MS = int(os.getenv("LOCATION_FLUSH_MS", "0"))
+MIN_MOVE_M = float(os.getenv("LOCATION_MIN_MOVE_M", "0"))
+MAX_AGE_S = float(os.getenv("LOCATION_MAX_AGE_S", "30"))
+
+# Drivers not seen for DRIVER_TTL_S are reaped from the geo index in batches.
+# Keep LOCATION_MAX_AGE_S below this so suppressed-but-alive drivers still heartbeat.
+DRIVER_TTL_S = float(os.getenv("DRIVER_TTL_S", "120"))
+REAP_INTERVAL_S = float(os.getenv("REAP_INTERVAL_S", "10"))
+REAP_BATCH = int(os.getenv("REAP_BATCH", "500"))
+
+# Geo index partitioned by grid cell, optionally spread over several Redis instances.
+geo = ShardedGeoIndex(r, split_urls(os.getenv("GEO_SHARD_URLS", "")), float(os.getenv("GEO_CELL_DEG", "0.5")))
+
+
 # This is our Participant Servicer class
 class ParticipantServicer(twophase_pb2_grpc.ParticipantServicer):
     def __init__(self, db_conn):
+        self.name = "Location"
         self.r = db_conn
-        # We need to store the driver_id between vote and commit
-        self.pending_transactions = {}
+        # We need to store the driver_id between vote and commit; expired by the sweeper
+        # if no outcome arrives
+        self.pending_transactions = PendingTable()
+        # Outcomes of recent OnePhaseCommit calls, so a retried call gets the same answer
+        self.decided = OrderedDict()
+        # Prepared state survives restarts; recover() resolves it against the decision log
+        self.prepared = PreparedStore(db_conn, "location")
+        self.log = DecisionLog(db_conn)
 
-    def VoteRequest(self, request, context):
-        tx_id = request.transaction_id
-        driver_id = request.driver_id
-        print(f"[Location: {tx_id}] Received VoteRequest for driver {driver_id}")
+    def _apply_commit(self, pipe, items):
+        drivers = [driver_id for _, driver_id in items if driver_id]
+        if drivers:
+            pipe.sadd("drivers:available", *drivers)
 
+    def _vote(self, items):
         # Our "vote" logic: can we do this?
         # For this simple system, we just check if a driver_id was provided.
         # A real system might check r.exists(f"user:{driver_id}")
-        if driver_id:
-            # Store the driver_id, ready for commit
-            self.pending_transactions[tx_id] = driver_id
-            print(f"[Location: {tx_id}] Voting COMMIT")
-            return twophase_pb2.VoteReply(vote_commit=True)
+        votes = [bool(driver_id) for _, driver_id in items]
+        if any(votes):
+            reply = twophase_pb2.VoteReply(vote_commit=True, item_commit=votes)
         else:
-            print(f"[Location: {tx_id}] driver_id missing. Voting ABORT")
-            return twophase_pb2.VoteReply(vote_commit=False)
+            reply = twophase_pb2.VoteReply(vote_commit=False)
+        count_vote(reply, "driver_missing")
+        return reply
 
+    @timed("vote")
+    def VoteRequest(self, request, context):
+        tx_id = request.transaction_id
+        items = items_of(request)
+        if self.pending_transactions.full():
+            reply = twophase_pb2.VoteReply(vote_commit=False)
+            count_vote(reply, "pending_full")
+            return reply
+        reply = self._vote(items)
+        if reply.vote_commit:
+            # Store the drivers, ready for commit, durably so a restart can finish them
+            self.prepared.prepare(tx_id, {"items": items})
+            self.pending_transactions.add(tx_id, items)
+        return reply
+
+    @timed("commit")
     def GlobalCommit(self, request, context):
         tx_id = request.transaction_id
-        print(f"[Location: {tx_id}] Received GlobalCommit")
-        
-        driver_id = self.pending_transactions.pop(tx_id, None)
         
-        if driver_id:
-            print(f"[Location: {tx_id}] Committing: Making driver {driver_id} available")
-            # This is the actual work
-            self.r.sadd("drivers:available", driver_id)
+        # The commit message lists the items that committed; prepared ones not listed are dropped
+        pending = self.pending_transactions.pop(tx_id)
+        items = items_of(request) or pending
+        if items:
+            # This is the actual work, together with dropping the prepared record
+            pipe = self.r.pipeline()
+            self._apply_commit(pipe, items)
+            self.prepared.forget(tx_id, client=pipe)
+            try:
+                pipe.execute()
+            except Exception:
+                # Still prepared: back into the sweeper's table, which settles it from the log
+                if pending is not None:
+                    self.pending_transactions.add(tx_id, pending)
+                raise
         else:
             print(f"[Location: {tx_id}] WARNING: No pending transaction found for commit.")
             
         return twophase_pb2.GlobalCommitReply()
 
+    @timed("abort")
     def GlobalAbort(self, request, context):
         tx_id = request.transaction_id
-        print(f"[Location: {tx_id}] Received GlobalAbort")
-        
         # Simple cleanup
-        self.pending_transactions.pop(tx_id, None)
-        print(f"[Location: {tx_id}] Aborted transaction.")
+        self.pending_transactions.pop(tx_id)
+        self.prepared.forget(tx_id)
         return twophase_pb2.GlobalAbortReply()
 
+    @timed("one_phase")
+    def OnePhaseCommit(self, request, context):
+        # We are the last participant asked: vote and apply in the same call. Nothing is
+        # prepared; the commit and the coordinator's decision record land in one MULTI.
+        tx_id = request.transaction_id
+        if tx_id in self.decided:
+            return self.decided[tx_id]
+        items = items_of(request)
+        reply = self._vote(items)
+        if reply.vote_commit:
+            committed = [item for item, ok in zip(items, reply.item_commit) if ok]
+            pipe = self.r.pipeline()
+            self._apply_commit(pipe, committed)
+            self.log.log_commit(tx_id, committed, client=pipe)
+            pipe.execute()
+        self.decided[tx_id] = reply
+        if len(self.decided) > 10000:
+            self.decided.popitem(last=False)
+        return reply
+
+    def recover(self):
+        res = recover(self.r, self.prepared, self.log, self._apply_commit)
+        for tx_id, payload in res["in_flight"].items():
+            # Keeps its original deadline; the sweeper resolves it if no outcome arrives
+            self.pending_transactions.add(tx_id, payload["items"], payload["ts"] + INDOUBT_S - time.time())
+        print(f"[Location] Recovery: {res['committed']} committed, {res['aborted']} aborted, "
+              f"{len(res['in_flight'])} still in flight")
+        return res
+
+    def sweep(self):
+        return sweep(self.r, self.pending_transactions, self.prepared, self.log, self._apply_commit)
+
+location_participant = ParticipantServicer(r)
+REGISTRY.gauge("twopc_participant_pending", lambda: len(location_participant.pending_transactions))
+REGISTRY.gauge("twopc_participant_prepared", location_participant.prepared.size)
+
 # Function to run the gRPC server
 def serve_grpc():
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    twophase_pb2_grpc.add_ParticipantServicer_to_server(ParticipantServicer(r), server)
+    twophase_pb2_grpc.add_ParticipantServicer_to_server(location_participant, server)
     
     # Using port 50052 as planned in docker-compose
     port = "50052"
@@ -76,27 +168,123 @@ def serve_grpc():
 # Start the gRPC server in a separate thread when FastAPI starts
 @app.on_event("startup")
 def startup_event():
+    # Resolve transactions left prepared by a crash; the ones still in flight go back into
+    # the pending table and the sweeper settles them if their outcome never arrives.
+    location_participant.recover()
+    threading.Thread(target=sweep_loop, args=(location_participant,), daemon=True).start()
     threading.Thread(target=serve_grpc, daemon=True).start()
+    threading.Thread(target=reap_loop, daemon=True).start()
+    writer.start()
 
 class Location(BaseModel):
     driver_id: str
-    lat: float
-    lon: float
+    lat: float = Field(ge=-locwire.MAX_LAT, le=locwire.MAX_LAT)
+    lon: float = Field(ge=-locwire.MAX_LON, le=locwire.MAX_LON)
     available: bool = True
 
+class LocationBatch(BaseModel):
+    # Records are validated one by one (see parse_json_batch) so one bad record
+    # doesn't sink the batch
+    updates: List[Dict[str, Any]]
+
+def parse_json_batch(body: bytes):
+    """(updates, rejected) from a JSON batch; raises ValidationError if the envelope is bad."""
+    updates, rejected = [], []
+    for i, item in enumerate(LocationBatch.model_validate_json(body).updates):
+        try:
+            u = Location.model_validate(item)
+        except ValidationError as e:
+            err = e.errors()[0]
+            rejected.append(locwire.rejection(i, item.get("driver_id"), f"{err['loc'][0]}: {err['msg']}"))
+            continue
+        updates.append((u.driver_id, u.lat, u.lon, u.available))
+    return updates, rejected
+
+def apply_locations(updates):
+    """Index (driver_id, lat, lon, available) tuples; one pipeline per geo shard.
+
+    The last update per driver wins, so a batch never flips availability twice.
+    """
+    return geo.update(updates, time.time())
+
+writer = WriteBehind(apply_locations, FLUSH_MS, MIN_MOVE_M, MAX_AGE_S)
+
+m_reaped = REGISTRY.counter("drivers_reaped")
+m_reap_runs = REGISTRY.counter("reap_runs")
+REGISTRY.gauge("drivers_geo_size", lambda: geo.sizes()["drivers_geo_size"])
+REGISTRY.gauge("drivers_available_size", lambda: geo.sizes()["drivers_available_size"])
+REGISTRY.gauge("drivers_seen_size", lambda: geo.sizes()["drivers_seen_size"])
+
+def reap_stale_drivers() -> int:
+    cutoff = time.time() - DRIVER_TTL_S
+    total = 0
+    while True:
+        ids = geo.reap(cutoff, REAP_BATCH)
+        if ids:
+            writer.forget(ids)
+            total += len(ids)
+        if len(ids) < REAP_BATCH:
+            break
+    m_reaped.inc(total)
+    m_reap_runs.inc()
+    return total
+
+def reap_loop():
+    while True:
+        time.sleep(REAP_INTERVAL_S)
+        try:
+            n = reap_stale_drivers()
+            if n:
+                print(f"[Location] Reaped {n} stale drivers")
+        except redis.RedisError as e:
+            print(f"[Location] Reaper failed: {e}")
+
+def require_user(authorization, user_id: str, role: str):
+    # Token checked locally (HMAC), no Redis lookup
+    try:
+        tokens.authorize(authorization, user_id, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+def require_users(authorization, user_ids, role: str):
+    # Batches: every id must be the token's subject, unless it is a service token
+    try:
+        tokens.authorize_many(authorization, user_ids, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
 @app.post("/drivers/location")
-def update_location(payload: Location):
-    r.geoadd("drivers:geo", (payload.lon, payload.lat, payload.driver_id))
-    if payload.available:
-        r.sadd("drivers:available", payload.driver_id)
-    else:
-        r.srem("drivers:available", payload.driver_id)
+def update_location(payload: Location, authorization: str = Header(None)):
+    require_user(authorization, payload.driver_id, "driver")
+    writer.offer([(payload.driver_id, payload.lat, payload.lon, payload.available)])
     return {"ok": True}
 
+@app.post("/drivers/location/batch")
+async def update_locations(request: Request, authorization: str = Header(None)):
+    # JSON: {"updates": [{driver_id, lat, lon, available}, ...]}
+    # Binary: locwire frame with Content-Type application/x-location-batch
+    # Records out of range are left out and listed in "rejected"; the rest are applied
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith(locwire.CONTENT_TYPE):
+            rejected = []
+            updates = locwire.unpack_updates(body, rejected)
+        else:
+            updates, rejected = parse_json_batch(body)
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    require_users(authorization, [u[0] for u in updates], "driver")
+    accepted = await run_in_threadpool(writer.offer, updates)
+    return {"ok": True, "received": len(updates) + len(rejected), "accepted": accepted, "rejected": rejected}
+
 @app.get("/drivers/nearby")
 def nearby(lat: float, lon: float, radius_km: float = 5.0, count: int = 5):
-    ids = r.execute_command(
-        "GEOSEARCH", "drivers:geo", "FROMLONLAT", lon, lat, "BYRADIUS", radius_km, "km", "ASC", "COUNT", count
-    )
-    avail = set(r.smembers("drivers:available"))
-    return [d for d in ids if d in avail]
+    return geo.search(lat, lon, radius_km, count, available_only=True)
+
+@app.get("/metrics")
+def metrics():
+    return REGISTRY.snapshot()
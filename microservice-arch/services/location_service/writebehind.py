@@ -0,0 +1,137 @@
+"""Write-behind buffer for driver locations.
+
+Keeps the latest position per driver in memory, drops updates that neither moved the
+driver far enough nor aged past the refresh interval, and hands only the newest state
+per driver to the sink on each flush.
+"""
+import math
+import threading
+import time
+
+import redis
+
+from services.common.metrics import REGISTRY
+
+EARTH_RADIUS_M = 6_371_000.0
+
+
+def distance_m(lat1, lon1, lat2, lon2) -> float:
+    # Equirectangular approximation; accurate to well under 1% at city scale.
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_M * math.hypot(x, y)
+
+
+class WriteBehind:
+    """
+    sink:       callable taking a list of (driver_id, lat, lon, available) tuples
+    flush_ms:   flush cadence; 0 writes accepted updates through immediately
+    min_move_m: updates closer than this to the last written position are suppressed...
+    max_age_s:  ...unless the last write is older than this (keeps positions fresh)
+    """
+    def __init__(self, sink, flush_ms=0, min_move_m=0.0, max_age_s=30.0, clock=time.monotonic):
+        self.sink = sink
+        self.flush_s = flush_ms / 1000.0
+        self.min_move_m = min_move_m
+        self.max_age_s = max_age_s
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.written = {}  # driver_id -> (lat, lon, available, ts) of the last successful write
+        self.m_received = REGISTRY.counter("location_updates_received")
+        self.m_suppressed = REGISTRY.counter("location_updates_suppressed")
+        self.m_coalesced = REGISTRY.counter("location_updates_coalesced")
+        self.m_written = REGISTRY.counter("location_updates_written")
+        self.m_flushes = REGISTRY.counter("location_flushes")
+        self.m_dropped = REGISTRY.counter("location_updates_dropped")
+        REGISTRY.gauge("location_pending", lambda: len(self.pending))
+        REGISTRY.gauge("location_tracked_drivers", lambda: len(self.written))
+
+    def _suppress(self, u, now) -> bool:
+        # Compare with what the next flush will write when something is queued, so a
+        # suppressed update never lets an older queued state win; else the last write
+        queued = self.pending.get(u[0])
+        if queued is not None:
+            return queued[3] == u[3] and distance_m(queued[1], queued[2], u[1], u[2]) < self.min_move_m
+        prev = self.written.get(u[0])
+        if prev is None or prev[2] != u[3] or now - prev[3] >= self.max_age_s:
+            return False
+        return distance_m(prev[0], prev[1], u[1], u[2]) < self.min_move_m
+
+    def offer(self, updates) -> int:
+        """Returns the number of updates accepted (not suppressed)."""
+        now = self.clock()
+        accepted = []
+        with self.lock:
+            for u in updates:
+                if self.min_move_m > 0 and self._suppress(u, now):
+                    continue
+                if self.flush_s > 0:
+                    if u[0] in self.pending:
+                        self.m_coalesced.inc()
+                    self.pending[u[0]] = u
+                accepted.append(u)
+        self.m_received.inc(len(updates))
+        self.m_suppressed.inc(len(updates) - len(accepted))
+        if self.flush_s <= 0 and accepted:
+            self._write(accepted)
+        return len(accepted)
+
+    def forget(self, driver_ids):
+        with self.lock:
+            for d in driver_ids:
+                self.written.pop(d, None)
+                self.pending.pop(d, None)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = list(self.pending.values()), {}
+        if not batch:
+            return
+        try:
+            self._write(batch)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._requeue(batch)
+            raise
+        except redis.ResponseError:
+            # Redis refused something in the batch. Re-queueing it would fail every later
+            # flush, so write records one at a time and drop only the refused ones.
+            self._write_each(batch)
+
+    def _requeue(self, batch):
+        # Redis unreachable: put the batch back unless a newer position arrived meanwhile
+        with self.lock:
+            for u in batch:
+                self.pending.setdefault(u[0], u)
+
+    def _write_each(self, batch):
+        for i, u in enumerate(batch):
+            try:
+                self._write([u])
+            except (redis.ConnectionError, redis.TimeoutError):
+                self._requeue(batch[i:])
+                raise
+            except redis.ResponseError as e:
+                self.m_dropped.inc()
+                print(f"[Location] write-behind dropped the update for {u[0]}, Redis refused it: {e}")
+
+    def _write(self, batch):
+        self.sink(batch)
+        now = self.clock()
+        with self.lock:
+            for u in batch:
+                self.written[u[0]] = (u[1], u[2], u[3], now)
+        self.m_written.inc(len(batch))
+        self.m_flushes.inc()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_s)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[Location] write-behind flush failed: {e}")
+
+    def start(self):
+        if self.flush_s > 0:
+            threading.Thread(target=self._loop, daemon=True).start()
@@ -1,10 +1,62 @@
 import os
-from fastapi import FastAPI, HTTPException
+import threading
+import time
+from fastapi import FastAPI, Header, HTTPException, Query
 from pydantic import BaseModel
 import redis
 
+from services.common import ride_events, ridecodec, tokens
+from services.common.archive import SegmentArchive, archive_closed
+from services.common.geoshard import ShardedGeoIndex, split_urls
+from services.common.history import MAX_PAGE, RideHistory, record
+from services.common.idalloc import ride_ids
+from services.common.metrics import REGISTRY
+from services.common.readcache import ReadCache
+
 r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
+geo = ShardedGeoIndex(r, split_urls(os.getenv("GEO_SHARD_URLS", "")), float(os.getenv("GEO_CELL_DEG", "0.5")))
 app = FastAPI(title="Matching Service")
+# Ids come from a leased block (or a snowflake generator), not one INCR per ride
+ids = ride_ids(r, os.getenv("NODE_ID", "matching-0"))
+
+# Rides closed for ARCHIVE_AFTER_S move from Redis to segment files in ARCHIVE_DIR
+# (a volume shared by every matching replica).
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/data/ride-archive")
+ARCHIVE_AFTER_S = float(os.getenv("ARCHIVE_AFTER_S", "3600"))
+ARCHIVE_INTERVAL_S = float(os.getenv("ARCHIVE_INTERVAL_S", "60"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "10000"))
+archive = SegmentArchive(ARCHIVE_DIR)
+history = RideHistory(r, archive)
+
+# Ride reads are served from memory; the transition script publishes invalidations.
+# RIDE_CACHE_MAX=0 turns the cache off.
+rides_cache = ReadCache(r, int(os.getenv("RIDE_CACHE_MAX", "100000")), float(os.getenv("RIDE_CACHE_TTL_S", "30")))
+for _name in rides_cache.snapshot():
+    REGISTRY.gauge(f"ride_{_name}", lambda _name=_name: rides_cache.snapshot()[_name])
+
+def archive_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_S)
+        try:
+            # Keep going while full batches are waiting
+            while archive_closed(r, ARCHIVE_DIR, ARCHIVE_AFTER_S, ARCHIVE_BATCH) >= ARCHIVE_BATCH:
+                pass
+        except (redis.RedisError, OSError) as e:
+            print(f"[Matching] Archiver failed: {e}")
+
+@app.on_event("startup")
+def startup_event():
+    rides_cache.start()
+    threading.Thread(target=archive_loop, daemon=True).start()
+
+def require_user(authorization, user_id: str, role: str):
+    # Token checked locally (HMAC), no Redis lookup
+    try:
+        tokens.authorize(authorization, user_id, role)
+    except tokens.InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
 
 class RideRequest(BaseModel):
     rider_id: str
@@ -14,19 +66,18 @@ class RideRequest(BaseModel):
     dest_lon: float
 
 @app.post("/rides/request")
-def request_ride(req: RideRequest):
-    candidates = r.execute_command(
-        "GEOSEARCH", "drivers:geo", "FROMLONLAT", req.pickup_lon, req.pickup_lat, "BYRADIUS", 10, "km", "ASC", "COUNT", 1
-    )
-    avail = set(r.smembers("drivers:available"))
-    candidates = [d for d in candidates if d in avail]
+def request_ride(req: RideRequest, authorization: str = Header(None)):
+    require_user(authorization, req.rider_id, "rider")
+    candidates = geo.search(req.pickup_lat, req.pickup_lon, 10, 1, available_only=True)
     if not candidates:
         raise HTTPException(status_code=404, detail="no drivers available")
     driver_id = candidates[0]
 
-    ride_id = r.incr("seq:ride")
+    ride_id = ids.next()
     ride_key = f"ride:{ride_id}"
-    r.hset(ride_key, mapping={
+    # Ride, driver reservation, history indexes and the "matched" event in one round trip
+    pipe = r.pipeline()
+    pipe.hset(ride_key, mapping=ridecodec.encode({
         "rider_id": req.rider_id,
         "driver_id": driver_id,
         "status": "matched",
@@ -34,13 +85,40 @@ def request_ride(req: RideRequest):
         "pickup_lon": req.pickup_lon,
         "dest_lat": req.dest_lat,
         "dest_lon": req.dest_lon,
-    })
-    r.srem("drivers:available", driver_id)
+    }))
+    pipe.srem("drivers:available", driver_id)
+    record(pipe, ride_id, req.rider_id, driver_id, time.time())
+    ride_events.append(pipe, ride_id, "matched", rider_id=req.rider_id, driver_id=driver_id)
+    pipe.execute()
     return {"ride_id": ride_id, "driver_id": driver_id, "status": "matched"}
 
 @app.get("/rides/{ride_id}")
 def get_ride(ride_id: int):
-    data = r.hgetall(f"ride:{ride_id}")
+    data = rides_cache.get(f"ride:{ride_id}", lambda: ridecodec.decode(r.hgetall(f"ride:{ride_id}")))
     if not data:
-        raise HTTPException(status_code=404, detail="ride not found")
+        # Closed long enough ago to have been archived?
+        data = archive.get(ride_id)
+        if data is None:
+            raise HTTPException(status_code=404, detail="ride not found")
+        data["archived"] = True
     return {"ride_id": ride_id, **data}
+
+def ride_history(role: str, user_id: str, cursor, limit: int):
+    try:
+        rides, next_cursor = history.page(role, user_id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"rides": rides, "next_cursor": next_cursor}
+
+@app.get("/riders/{rider_id}/rides")
+def rider_rides(rider_id: str, cursor: str = None, limit: int = Query(20, ge=1, le=MAX_PAGE)):
+    # Newest first; pass next_cursor back as ?cursor= for the following page
+    return ride_history("rider", rider_id, cursor, limit)
+
+@app.get("/drivers/{driver_id}/rides")
+def driver_rides(driver_id: str, cursor: str = None, limit: int = Query(20, ge=1, le=MAX_PAGE)):
+    return ride_history("driver", driver_id, cursor, limit)
+
+@app.get("/metrics")
+def metrics():
+    return REGISTRY.snapshot()
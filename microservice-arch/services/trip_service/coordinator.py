@@ -0,0 +1,413 @@
+"""Two-phase commit coordinator for trip completion.
+
+Each phase is sent to every participant at once, so a phase costs the slowest
+participant's round trip instead of the sum of all of them. All calls in a transaction
+share one deadline rather than carrying their own timeouts.
+
+Participants live in a process-wide registry. Remote ones keep long-lived channels that
+gRPC reconnects in the background with exponential backoff; local ones are servicer
+objects in this process and are called directly, without protobuf over a socket.
+
+Round-trip savings on top of plain 2PC:
+- read-only voters (nothing to change) are left out of phase 2;
+- when exactly one remote participant remains, the local participants are prepared first
+  and the remote one gets a single OnePhaseCommit whose reply is the outcome;
+- group commit: completions arriving within a short window share one round, with
+  per-item votes so one bad ride does not abort the rest of its batch.
+
+Commit decisions are written to the durable decision log (services/common/twopc.py)
+before any GlobalCommit goes out; under one-phase commit the last agent writes it
+atomically with its own commit. Aborts are not logged (presumed abort).
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import grpc
+import twophase_pb2
+import twophase_pb2_grpc
+
+from services.common.metrics import REGISTRY
+
+TX_DEADLINE_S = float(os.getenv("TWOPC_DEADLINE_S", "4.0"))
+# Decision messages must go out even when voting used most of the budget.
+DECISION_MIN_S = float(os.getenv("TWOPC_DECISION_MIN_S", "1.0"))
+RETRY_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED}
+
+# Per-participant latency histograms are named twopc_<phase>_seconds_<participant>.
+PHASES = {"VoteRequest": "vote", "GlobalCommit": "commit", "GlobalAbort": "abort", "OnePhaseCommit": "one_phase"}
+
+m_rounds = REGISTRY.counter("twopc_rounds")
+m_rounds_committed = REGISTRY.counter("twopc_rounds_committed")
+m_rounds_aborted = REGISTRY.counter("twopc_rounds_aborted")
+m_items_committed = REGISTRY.counter("twopc_items_committed")
+m_items_aborted = REGISTRY.counter("twopc_items_aborted")
+# Rounds where a phase 2 message did not get through, or the last agent's outcome is
+# unknown: some participant is left prepared for its sweeper.
+m_in_doubt = REGISTRY.counter("twopc_in_doubt")
+m_in_flight = REGISTRY.gauge("twopc_rounds_in_flight")
+m_round_latency = REGISTRY.histogram("twopc_round_seconds")
+
+CHANNEL_OPTIONS = [
+    ("grpc.initial_reconnect_backoff_ms", 100),
+    ("grpc.min_reconnect_backoff_ms", 100),
+    ("grpc.max_reconnect_backoff_ms", 5000),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 5000),
+    ("grpc.keepalive_permit_without_calls", 1),
+]
+
+
+class RemoteParticipant:
+    is_local = False
+
+    def __init__(self, name: str, target: str):
+        self.name = name
+        self.target = target
+        self.state = grpc.ChannelConnectivity.IDLE
+        self.channel = grpc.insecure_channel(target, options=CHANNEL_OPTIONS)
+        self.stub = twophase_pb2_grpc.ParticipantStub(self.channel)
+        # Keeps the connection warm and lets /participants report health without a probe RPC.
+        self.channel.subscribe(self._on_state, try_to_connect=True)
+
+    def _on_state(self, state):
+        self.state = state
+
+    def call_async(self, method: str, args, timeout: float):
+        return getattr(self.stub, method).future(args, timeout=timeout)
+
+    def health(self) -> dict:
+        return {"target": self.target, "state": self.state.name}
+
+    def close(self):
+        self.channel.unsubscribe(self._on_state)
+        self.channel.close()
+
+
+class LocalParticipant:
+    is_local = True
+
+    def __init__(self, name: str, servicer):
+        self.name = name
+        self.servicer = servicer
+
+    def call_async(self, method: str, args, timeout: float):
+        # Runs inline; the returned future is already resolved.
+        fut = Future()
+        try:
+            fut.set_result(getattr(self.servicer, method)(args, None))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def health(self) -> dict:
+        return {"target": "in-process", "state": "READY"}
+
+    def close(self):
+        pass
+
+
+class ParticipantRegistry:
+    """Process-wide participants: long-lived remote channels and in-process servicers."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _put(self, participant):
+        with self._lock:
+            old = self._entries.get(participant.name)
+            self._entries[participant.name] = participant
+        if old is not None:
+            old.close()
+        return participant
+
+    def register(self, name: str, target: str):
+        with self._lock:
+            old = self._entries.get(name)
+            if isinstance(old, RemoteParticipant) and old.target == target:
+                return old
+        return self._put(RemoteParticipant(name, target))
+
+    def register_local(self, name: str, servicer):
+        return self._put(LocalParticipant(name, servicer))
+
+    def participants(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def health(self) -> dict:
+        with self._lock:
+            return {p.name: p.health() for p in self._entries.values()}
+
+    def close(self):
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), {}
+        for p in entries:
+            p.close()
+
+
+def _details(e: Exception) -> str:
+    return e.details() if isinstance(e, grpc.RpcError) else repr(e)
+
+
+def _abort_reason(reason: str):
+    REGISTRY.counter(f"twopc_abort_reason_{reason}").inc()
+
+
+def _observer(method: str, name: str, t0: float):
+    # Done-callback: the latency of each participant's call, even while others are in flight.
+    hist = REGISTRY.histogram(f"twopc_{PHASES[method]}_seconds_{name.lower()}")
+    errors = REGISTRY.counter(f"twopc_{PHASES[method]}_errors_{name.lower()}")
+
+    def done(fut):
+        hist.observe(time.perf_counter() - t0)
+        if fut.exception() is not None:
+            errors.inc()
+    return done
+
+
+def _call(participant, method: str, args, timeout: float):
+    # t0 before the call: local participants run inline inside call_async
+    t0 = time.perf_counter()
+    fut = participant.call_async(method, args, timeout)
+    fut.add_done_callback(_observer(method, participant.name, t0))
+    return fut
+
+
+def fan_out(participants, method: str, args, deadline: float) -> dict:
+    """Call `method` on every participant concurrently.
+
+    Remote calls are started first so local ones run while they are in flight.
+    Returns {name: reply} with the exception in place of the reply for failed calls.
+    """
+    timeout = max(deadline - time.monotonic(), 0.001)
+    ordered = sorted(participants, key=lambda p: p.is_local)
+    futures = {p.name: _call(p, method, args, timeout) for p in ordered}
+    results = {}
+    for name, fut in futures.items():
+        try:
+            results[name] = fut.result()
+        except Exception as e:
+            results[name] = e
+    return results
+
+
+def _item_votes(reply, n: int) -> list:
+    if isinstance(reply, Exception) or not reply.vote_commit:
+        return [False] * n
+    return list(reply.item_commit) if len(reply.item_commit) == n else [True] * n
+
+
+def _item_done(reply, n: int) -> list:
+    if isinstance(reply, Exception) or not reply.vote_commit or len(reply.item_read_only) != n:
+        return [False] * n
+    return list(reply.item_read_only)
+
+
+def _tally(tx_id: str, votes: dict, n: int):
+    """Returns (per-item commit mask, per-item already-done mask, names that still need a
+    phase 2 message)."""
+    mask, done, pending = [True] * n, [False] * n, []
+    for name, reply in votes.items():
+        if isinstance(reply, Exception):
+            print(f"[Coordinator: {tx_id}] RPC failed for {name}: {_details(reply)}")
+            _abort_reason("rpc_error")
+            pending.append(name)
+        elif not reply.vote_commit:
+            _abort_reason("vote_abort")
+        elif not reply.read_only:
+            pending.append(name)
+        mask = [a and b for a, b in zip(mask, _item_votes(reply, n))]
+        done = [a or b for a, b in zip(done, _item_done(reply, n))]
+    return mask, done, pending
+
+
+def _decide(tx_id: str, participants, committed, deadline: float):
+    if not participants:
+        return
+    if committed:
+        args = twophase_pb2.GlobalCommitArgs(transaction_id=tx_id, ride_ids=[i[0] for i in committed],
+                                             driver_ids=[i[1] for i in committed])
+        method = "GlobalCommit"
+    else:
+        # Abort also goes to participants we could not reach; they may have prepared.
+        args = twophase_pb2.GlobalAbortArgs(transaction_id=tx_id)
+        method = "GlobalAbort"
+    failed = False
+    for name, reply in fan_out(participants, method, args, deadline).items():
+        if isinstance(reply, Exception):
+            # A participant may be left prepared; it has to learn the outcome later.
+            print(f"[Coordinator: {tx_id}] {method} failed for {name}: {_details(reply)}")
+            failed = True
+    if failed:
+        m_in_doubt.inc()
+
+
+def _one_phase_commit(tx_id: str, participant, args, deadline: float):
+    """OnePhaseCommit with retries until the deadline; None if the outcome is unknown.
+
+    Retrying is safe because participants answer a repeated transaction_id with the
+    outcome they already reached.
+    """
+    while True:
+        try:
+            return _call(participant, "OnePhaseCommit", args, max(deadline - time.monotonic(), 0.001)).result()
+        except grpc.RpcError as e:
+            if e.code() not in RETRY_CODES or time.monotonic() + 0.05 >= deadline:
+                print(f"[Coordinator: {tx_id}] OnePhaseCommit to {participant.name} failed: {_details(e)}")
+                return None
+            time.sleep(0.05)
+
+
+def _vote_args(tx_id: str, items):
+    return twophase_pb2.VoteRequestArgs(transaction_id=tx_id, ride_ids=[i[0] for i in items],
+                                        driver_ids=[i[1] for i in items])
+
+
+def run_2pc_batch(tx_id: str, participants, items, deadline_s: float = TX_DEADLINE_S,
+                  decision_log=None) -> list:
+    """Drive one transaction over (ride_id, driver_id) items. Returns per-item outcomes:
+    True committed, False aborted, None in doubt (the last agent's outcome is unknown;
+    the prepared participants settle it later from the decision log).
+
+    An item commits only if every participant voted for it; items voted down are left
+    out of the commit, the rest of the batch still goes through.
+    """
+    m_rounds.inc()
+    m_in_flight.inc()
+    t0 = time.perf_counter()
+    try:
+        mask = _run_round(tx_id, participants, items, time.monotonic() + deadline_s, decision_log)
+    finally:
+        m_in_flight.dec()
+        m_round_latency.observe(time.perf_counter() - t0)
+    committed, aborted = mask.count(True), mask.count(False)
+    if committed:
+        m_rounds_committed.inc()
+    elif aborted == len(mask):
+        m_rounds_aborted.inc()
+    m_items_committed.inc(committed)
+    m_items_aborted.inc(aborted)
+    return mask
+
+
+def _run_round(tx_id: str, participants, items, deadline: float, decision_log) -> list:
+    by_name = {p.name: p for p in participants}
+    remote = [p for p in participants if not p.is_local]
+    last = remote[0] if len(remote) == 1 else None
+
+    # PHASE 1: VOTING (everyone except a last agent, which gets OnePhaseCommit below)
+    votes = fan_out([p for p in participants if p is not last], "VoteRequest", _vote_args(tx_id, items), deadline)
+    mask, done, pending = _tally(tx_id, votes, len(items))
+    # Items already done at a participant (a ride completed by an earlier round) count as
+    # committed, but nobody is asked to apply them again: Location would free a driver
+    # who may already be on the next ride.
+    todo = [ok and not d for ok, d in zip(mask, done)]
+
+    if last is not None and any(todo):
+        # The last agent only sees the items everyone else accepted and still has to apply.
+        keep = [i for i, ok in enumerate(todo) if ok]
+        reply = _one_phase_commit(tx_id, last, _vote_args(tx_id, [items[i] for i in keep]), deadline)
+        mask = [ok and d for ok, d in zip(mask, done)]
+        if reply is None:
+            # Unknown outcome at the last agent: it may still have committed and logged the
+            # decision. The local participants stay prepared and their sweeper settles them
+            # from the decision log; aborting them here could split the outcome.
+            print(f"[Coordinator: {tx_id}] WARNING: {last.name} outcome in doubt, leaving local participants prepared")
+            m_in_doubt.inc()
+            pending = []
+            for i in keep:
+                mask[i] = None
+        else:
+            if not reply.vote_commit:
+                _abort_reason("vote_abort")
+            for i, ok in zip(keep, _item_votes(reply, len(keep))):
+                mask[i] = ok
+    elif any(todo) and decision_log is not None:
+        # The decision is only final once it is durable; if logging fails we abort.
+        try:
+            decision_log.log_commit(tx_id, [it for it, ok in zip(items, todo) if ok])
+        except Exception as e:
+            print(f"[Coordinator: {tx_id}] Could not log commit decision, aborting: {e!r}")
+            _abort_reason("log_failed")
+            mask = [ok and d for ok, d in zip(mask, done)]
+
+    # PHASE 2: DECISION
+    deadline = max(deadline, time.monotonic() + DECISION_MIN_S)
+    committed = [it for it, ok, d in zip(items, mask, done) if ok and not d]
+    _decide(tx_id, [by_name[n] for n in pending], committed, deadline)
+    return mask
+
+
+def run_2pc(tx_id: str, participants, ride_id: str, driver_id: str, deadline_s: float = TX_DEADLINE_S,
+            decision_log=None) -> bool:
+    """Drive one transaction to a decision. Returns True if it committed, None if in doubt."""
+    return run_2pc_batch(tx_id, participants, [(ride_id, driver_id)], deadline_s, decision_log)[0]
+
+
+class GroupCommitter:
+    """Collects completions for up to `window_ms` and runs one 2PC round per batch.
+
+    complete() blocks on the caller's own item; submit() returns a future instead. With
+    `window_ms` 0 every completion runs its own round: in the caller's thread for
+    complete(), on a pool of `async_workers` threads for submit().
+    """
+    def __init__(self, registry: ParticipantRegistry, decision_log=None, window_ms: float = 0,
+                 max_batch: int = 500, async_workers: int = 32):
+        self.registry = registry
+        self.decision_log = decision_log
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._queue = []
+        REGISTRY.gauge("twopc_batch_queue", lambda: len(self._queue))
+        self._executor = ThreadPoolExecutor(max_workers=async_workers, thread_name_prefix="2pc")
+        if self.window > 0:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _single(self, ride_id: str, driver_id: str) -> bool:
+        tx_id = str(uuid.uuid4())
+        return run_2pc(tx_id, self.registry.participants(), ride_id, driver_id, decision_log=self.decision_log)
+
+    def submit(self, ride_id: str, driver_id: str) -> Future:
+        if self.window <= 0:
+            return self._executor.submit(self._single, ride_id, driver_id)
+        fut = Future()
+        with self._cond:
+            self._queue.append(((ride_id, driver_id), fut))
+            self._cond.notify()
+        return fut
+
+    def complete(self, ride_id: str, driver_id: str) -> bool:
+        if self.window <= 0:
+            return self._single(ride_id, driver_id)
+        return self.submit(ride_id, driver_id).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # The window opens with the first waiting completion.
+                close_at = time.monotonic() + self.window
+                while len(self._queue) < self.max_batch:
+                    left = close_at - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            self._commit(batch)
+
+    def _commit(self, batch):
+        tx_id = str(uuid.uuid4())
+        try:
+            mask = run_2pc_batch(tx_id, self.registry.participants(), [item for item, _ in batch],
+                                 decision_log=self.decision_log)
+        except Exception as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        for (_, fut), ok in zip(batch, mask):
+            fut.set_result(ok)
@@ -1,66 +1,181 @@
 import os
-from fastapi import FastAPI, HTTPException
+import json
+import uuid
+import asyncio
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 import redis
+import redis.asyncio as aioredis
 
 import grpc
 from concurrent import futures
 import twophase_pb2
 import twophase_pb2_grpc
 import threading
-import uuid
+import time
+from collections import OrderedDict
+
+from services.common.metrics import REGISTRY
+from services.common.ridecodec import STATE_FIELDS, state_of
+from services.common.ridestate import RideStateMachine
+from services.common.twopc import (
+    INDOUBT_S, DecisionLog, PendingTable, PreparedStore, count_vote, items_of, recover, sweep, sweep_loop, timed,
+)
+from services.trip_service.coordinator import GroupCommitter, ParticipantRegistry
 
 r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
+# Only used by the server-sent events endpoint, which waits on pub/sub without a thread
+ar = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
 app = FastAPI(title="Trip Service")
 
+# Asynchronous completions: status is kept in tx:<id> for TX_STATUS_TTL_S and the
+# outcome is published on channel tx:<id>.
+TX_STATUS_TTL_S = int(os.getenv("TX_STATUS_TTL_S", "3600"))
+TX_EVENTS_TIMEOUT_S = float(os.getenv("TX_EVENTS_TIMEOUT_S", "30"))
+
+# Commit decisions (presumed abort: aborts are never logged)
+decision_log = DecisionLog(r)
+rides = RideStateMachine(r)
+
+# Participants shared by every completion.
+participants = ParticipantRegistry()
+# Participant 2: The Location service (inter-node), by docker compose service name
+participants.register("Location", os.getenv("LOCATION_GRPC_TARGET", "location:50052"))
+
 # This is our Participant Servicer class (for this service's OWN data)
 class ParticipantServicer(twophase_pb2_grpc.ParticipantServicer):
     def __init__(self, db_conn):
+        self.name = "Trip"
         self.r = db_conn
-        self.pending_transactions = {}
+        # Prepared rides by transaction, expired by the sweeper if no outcome arrives
+        self.pending_transactions = PendingTable()
+        # Outcomes of recent OnePhaseCommit calls, so a retried call gets the same answer
+        self.decided = OrderedDict()
+        # Prepared state survives restarts; recover() resolves it against the decision log
+        self.prepared = PreparedStore(db_conn, "trip")
+        self.log = DecisionLog(db_conn)
+        self.rides = RideStateMachine(db_conn)
 
+    def _apply_commit(self, pipe, items):
+        # ongoing -> completed; a ride cancelled since the vote stays cancelled.
+        # The driver is made available by the Location participant.
+        for ride_id, _ in items:
+            self.rides.transition(ride_id, "completed", client=pipe)
+
+    def _vote(self, tx_id, items, prepare):
+        # Our "vote" logic: is each ride ongoing, or already completed (nothing to do)?
+        # The prepared record is written optimistically in the same round trip.
+        pipe = self.r.pipeline(transaction=False)
+        for ride_id, _ in items:
+            pipe.hmget(f"ride:{ride_id}", *STATE_FIELDS)
+        if prepare:
+            self.prepared.prepare(tx_id, {"items": items}, client=pipe)
+        statuses = [state_of(values)[0] for values in pipe.execute()[:len(items)]]
+        votes = [status in ("ongoing", "completed") for status in statuses]
+        done = [status == "completed" for status in statuses]
+        if not any(votes):
+            reply = twophase_pb2.VoteReply(vote_commit=False)
+        elif "ongoing" not in statuses:
+            reply = twophase_pb2.VoteReply(vote_commit=True, read_only=True, item_commit=votes, item_read_only=done)
+        else:
+            reply = twophase_pb2.VoteReply(vote_commit=True, item_commit=votes, item_read_only=done)
+        count_vote(reply, "ride_not_found" if all(status is None for status in statuses) else "invalid_state")
+        if reply.vote_commit and not reply.read_only:
+            return reply
+        if prepare:
+            self.prepared.forget(tx_id)
+        return reply
+
+    @timed("vote")
     def VoteRequest(self, request, context):
         tx_id = request.transaction_id
-        ride_id = request.ride_id
-        print(f"[Trip: {tx_id}] Received VoteRequest for ride {ride_id}")
-
-        # Our "vote" logic: does this ride exist?
-        key = f"ride:{ride_id}"
-        if self.r.exists(key):
-            self.pending_transactions[tx_id] = ride_id
-            print(f"[Trip: {tx_id}] Voting COMMIT")
-            return twophase_pb2.VoteReply(vote_commit=True)
-        else:
-            print(f"[Trip: {tx_id}] Ride not found. Voting ABORT")
-            return twophase_pb2.VoteReply(vote_commit=False)
+        items = items_of(request)
+        if self.pending_transactions.full():
+            reply = twophase_pb2.VoteReply(vote_commit=False)
+            count_vote(reply, "pending_full")
+            return reply
+        reply = self._vote(tx_id, items, prepare=True)
+        if reply.vote_commit and not reply.read_only:
+            self.pending_transactions.add(tx_id, items)
+        return reply
 
+    @timed("one_phase")
+    def OnePhaseCommit(self, request, context):
+        tx_id = request.transaction_id
+        if tx_id in self.decided:
+            return self.decided[tx_id]
+        items = items_of(request)
+        reply = self._vote(tx_id, items, prepare=False)
+        if reply.vote_commit and not reply.read_only:
+            # Our commit and the decision record land in one MULTI
+            committed = [item for item, ok in zip(items, reply.item_commit) if ok]
+            pipe = self.r.pipeline()
+            self._apply_commit(pipe, committed)
+            self.log.log_commit(tx_id, committed, client=pipe)
+            pipe.execute()
+        self.decided[tx_id] = reply
+        if len(self.decided) > 10000:
+            self.decided.popitem(last=False)
+        return reply
+
+    @timed("commit")
     def GlobalCommit(self, request, context):
         tx_id = request.transaction_id
-        print(f"[Trip: {tx_id}] Received GlobalCommit")
-        
-        ride_id = self.pending_transactions.pop(tx_id, None)
         
-        if ride_id:
-            print(f"[Trip: {tx_id}] Committing: Setting ride {ride_id} to completed")
-            # This is the actual work
-            key = f"ride:{ride_id}"
-            self.r.hset(key, mapping={"status": "completed"})
-        else:
+        # The commit message lists the items that committed; prepared ones not listed are dropped
+        pending = self.pending_transactions.pop(tx_id)
+        items = items_of(request) or pending
+        if not items:
             print(f"[Trip: {tx_id}] WARNING: No pending transaction found for commit.")
+
+        if items:
+            # This is the actual work, together with dropping the prepared record
+            pipe = self.r.pipeline()
+            self._apply_commit(pipe, items)
+            self.prepared.forget(tx_id, client=pipe)
+            try:
+                pipe.execute()
+            except Exception:
+                # Still prepared: back into the sweeper's table, which settles it from the log
+                if pending is not None:
+                    self.pending_transactions.add(tx_id, pending)
+                raise
             
         return twophase_pb2.GlobalCommitReply()
 
+    @timed("abort")
     def GlobalAbort(self, request, context):
         tx_id = request.transaction_id
-        print(f"[Trip: {tx_id}] Received GlobalAbort")
-        
-        self.pending_transactions.pop(tx_id, None)
-        print(f"[Trip: {tx_id}] Aborted transaction.")
+        self.pending_transactions.pop(tx_id)
+        self.prepared.forget(tx_id)
         return twophase_pb2.GlobalAbortReply()
 
+    def recover(self):
+        res = recover(self.r, self.prepared, self.log, self._apply_commit)
+        for tx_id, payload in res["in_flight"].items():
+            # Keeps its original deadline; the sweeper resolves it if no outcome arrives
+            self.pending_transactions.add(tx_id, payload["items"], payload["ts"] + INDOUBT_S - time.time())
+        print(f"[Trip] Recovery: {res['committed']} committed, {res['aborted']} aborted, "
+              f"{len(res['in_flight'])} still in flight")
+        return res
+
+    def sweep(self):
+        return sweep(self.r, self.pending_transactions, self.prepared, self.log, self._apply_commit)
+
 # Function to run the gRPC server
+trip_participant = ParticipantServicer(r)
+# Participant 1: our own servicer, called in-process by the coordinator
+participants.register_local("Trip", trip_participant)
+REGISTRY.gauge("twopc_participant_pending", lambda: len(trip_participant.pending_transactions))
+REGISTRY.gauge("twopc_participant_prepared", trip_participant.prepared.size)
+
+# Completions within TWOPC_BATCH_WINDOW_MS share one 2PC round (0 = one round each).
+committer = GroupCommitter(participants, decision_log, float(os.getenv("TWOPC_BATCH_WINDOW_MS", "0")),
+                           int(os.getenv("TWOPC_BATCH_MAX", "500")), int(os.getenv("TWOPC_ASYNC_WORKERS", "32")))
+
 def serve_grpc():
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    twophase_pb2_grpc.add_ParticipantServicer_to_server(ParticipantServicer(r), server)
+    twophase_pb2_grpc.add_ParticipantServicer_to_server(trip_participant, server)
     
     # Using port 50051 as planned (for intra-node communication)
     port = "50051"
@@ -72,107 +187,128 @@ def serve_grpc():
 # Start the gRPC server in a separate thread when FastAPI starts
 @app.on_event("startup")
 def startup_event():
+    # Resolve transactions left prepared by a crash; the ones still in flight go back into
+    # the pending table and the sweeper settles them if their outcome never arrives.
+    trip_participant.recover()
+    threading.Thread(target=sweep_loop, args=(trip_participant,), daemon=True).start()
     threading.Thread(target=serve_grpc, daemon=True).start()
 
+@app.on_event("shutdown")
+def shutdown_event():
+    participants.close()
+
+@app.get("/participants")
+def participant_health():
+    # open_fds lets soak tests check that completions no longer leak channels
+    return {"participants": participants.health(), "open_fds": len(os.listdir("/proc/self/fd"))}
+
+def transition_or_raise(ride_id: int, to: str, free_driver: bool = False) -> dict:
+    res = rides.transition(ride_id, to, free_driver)
+    if res["outcome"] == "missing":
+        raise HTTPException(status_code=404, detail="ride not found")
+    if res["outcome"] == "conflict":
+        raise HTTPException(status_code=409, detail=f"ride is {res['status']}, cannot become {to}")
+    return {"ride_id": ride_id, "status": res["status"], "driver_id": res["driver_id"]}
+
 @app.post("/trips/{ride_id}/start")
 def start_trip(ride_id: int):
-    key = f"ride:{ride_id}"
-    if not r.exists(key):
-        raise HTTPException(status_code=404, detail="ride not found")
-    r.hset(key, mapping={"status": "ongoing"})
-    return {"ride_id": ride_id, "status": "ongoing"}
+    # matched -> ongoing, checked and applied in one round trip
+    return transition_or_raise(ride_id, "ongoing")
+
+@app.post("/trips/{ride_id}/cancel")
+def cancel_trip(ride_id: int):
+    # matched/ongoing -> cancelled; the driver goes back to the available set
+    return transition_or_raise(ride_id, "cancelled", free_driver=True)
+
+def publish_outcome(tx_id: str, fut):
+    # Runs on the thread that finished the 2PC round
+    try:
+        ok = fut.result()
+        outcome = {"status": "committed" if ok else "in_doubt" if ok is None else "aborted"}
+    except Exception as e:
+        outcome = {"status": "aborted", "error": repr(e)}
+    pipe = r.pipeline(transaction=False)
+    pipe.hset(f"tx:{tx_id}", mapping=outcome)
+    pipe.expire(f"tx:{tx_id}", TX_STATUS_TTL_S)
+    pipe.publish(f"tx:{tx_id}", outcome["status"])
+    pipe.execute()
 
 @app.post("/trips/{ride_id}/complete")
-def complete_trip(ride_id: int):
+def complete_trip(ride_id: int, run_async: bool = Query(False, alias="async")):
     # This is now the 2PC COORDINATOR logic
     
     # 1. Get transaction data
-    key = f"ride:{ride_id}"
-    if not r.exists(key):
+    status, driver_id = state_of(r.hmget(f"ride:{ride_id}", *STATE_FIELDS))
+    if status is None:
         raise HTTPException(status_code=404, detail="ride not found")
-    
-    data = r.hgetall(key)
-    driver_id = data.get("driver_id")
+    if status == "completed":
+        # Repeated completion: nothing to commit
+        return {"ride_id": ride_id, "status": "completed", "driver_id": driver_id, "note": "Already completed"}
+    if status != "ongoing":
+        raise HTTPException(status_code=409, detail=f"ride is {status}, cannot become completed")
     
     if not driver_id:
         # Cannot do 2PC without a driver to make available
         raise HTTPException(status_code=400, detail="Driver ID missing from ride")
 
-    tx_id = str(uuid.uuid4())
-    print(f"[Coordinator: {tx_id}] Starting 2PC for ride {ride_id}")
+    if run_async:
+        # Accept now, run the protocol in the background; poll or subscribe for the outcome
+        tx_id = str(uuid.uuid4())
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(f"tx:{tx_id}", mapping={"ride_id": ride_id, "status": "pending"})
+        pipe.expire(f"tx:{tx_id}", TX_STATUS_TTL_S)
+        pipe.execute()
+        committer.submit(str(ride_id), driver_id).add_done_callback(lambda fut: publish_outcome(tx_id, fut))
+        return JSONResponse(status_code=202, content={
+            "ride_id": ride_id, "transaction_id": tx_id, "status": "pending",
+            "status_url": f"/transactions/{tx_id}", "events_url": f"/transactions/{tx_id}/events",
+        })
 
-    # 2. Setup gRPC channels and stubs
-    # Participant 1: Our own gRPC server (intra-node)
-    channel_self = grpc.insecure_channel("localhost:50051")
-    stub_self = twophase_pb2_grpc.ParticipantStub(channel_self)
-    
-    # Participant 2: The Location service (inter-node)
-    # We use the docker compose service name 'location'
-    channel_location = grpc.insecure_channel("location:50052")
-    stub_location = twophase_pb2_grpc.ParticipantStub(channel_location)
-
-    participants = [
-        ("Trip", stub_self),
-        ("Location", stub_location)
-    ]
-    
-    vote_args = twophase_pb2.VoteRequestArgs(
-        transaction_id=tx_id,
-        ride_id=str(ride_id),
-        driver_id=driver_id
-    )
-
-    # 3. PHASE 1: VOTING
-    print(f"[Coordinator: {tx_id}] --- Voting Phase ---")
-    all_votes_commit = True
-    votes = []
-    
-    for name, stub in participants:
+    # 2. Trip is voted in-process; Location, the only remote participant, gets one OnePhaseCommit.
+    # With group commit this ride shares the round with others completing at the same time.
+    ok = committer.complete(str(ride_id), driver_id)
+    if ok:
+        return {"ride_id": ride_id, "status": "completed", "driver_id": driver_id, "note": "Transaction committed"}
+    if ok is None:
+        # Location may still have committed; the prepared Trip side settles from the decision log
+        raise HTTPException(status_code=504, detail=f"Transaction outcome in doubt; it settles within "
+                                                    f"{INDOUBT_S:g}s, check GET /rides/{ride_id}")
+    raise HTTPException(status_code=500, detail="Transaction aborted by a participant")
+
+@app.get("/metrics")
+def metrics():
+    # Coordinator (twopc_*) and in-process participant (twopc_participant_*) metrics
+    return REGISTRY.snapshot()
+
+@app.get("/transactions/{tx_id}")
+def get_transaction(tx_id: str):
+    data = r.hgetall(f"tx:{tx_id}")
+    if not data:
+        raise HTTPException(status_code=404, detail="transaction not found")
+    return {"transaction_id": tx_id, **data}
+
+@app.get("/transactions/{tx_id}/events")
+async def transaction_events(tx_id: str):
+    # Server-sent events: the current status right away, then the outcome once decided
+    key = f"tx:{tx_id}"
+    pubsub = ar.pubsub()
+    await pubsub.subscribe(key)  # before reading, so the outcome cannot slip past
+    data = await ar.hgetall(key)
+    if not data:
+        await pubsub.aclose()
+        raise HTTPException(status_code=404, detail="transaction not found")
+
+    async def stream(data):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + TX_EVENTS_TIMEOUT_S
         try:
-            print(f"[Coordinator: {tx_id}] Sending VoteRequest to {name}")
-            reply = stub.VoteRequest(vote_args, timeout=2.0)
-            print(f"[Coordinator: {tx_id}] Received vote from {name}: {'COMMIT' if reply.vote_commit else 'ABORT'}")
-            votes.append(reply.vote_commit)
-            if not reply.vote_commit:
-                all_votes_commit = False
-        except grpc.RpcError as e:
-            print(f"[Coordinator: {tx_id}] RPC failed for {name}: {e.details()}")
-            all_votes_commit = False
-            votes.append(False)
-
-    # 4. PHASE 2: DECISION
-    print(f"[Coordinator: {tx_id}] --- Decision Phase ---")
-    if all_votes_commit:
-        # Send GlobalCommit
-        print(f"[Coordinator: {tx_id}] Decision: GLOBAL COMMIT")
-        commit_args = twophase_pb2.GlobalCommitArgs(
-            transaction_id=tx_id,
-            ride_id=str(ride_id),
-            driver_id=driver_id
-        )
-        for name, stub in participants:
-            try:
-                print(f"[Coordinator: {tx_id}] Sending GlobalCommit to {name}")
-                stub.GlobalCommit(commit_args, timeout=2.0)
-            except grpc.RpcError as e:
-                # This is a problem (a participant might not commit)
-                # In a real system, you'd need a recovery protocol
-                print(f"[Coordinator: {tx_id}] CRITICAL: GlobalCommit failed for {name}: {e.details()}")
-        
-        return {"ride_id": ride_id, "status": "completed", "note": "Transaction committed"}
-        
-    else:
-        # Send GlobalAbort
-        print(f"[Coordinator: {tx_id}] Decision: GLOBAL ABORT")
-        abort_args = twophase_pb2.GlobalAbortArgs(transaction_id=tx_id)
-        
-        for name, stub in participants:
-            # We only send abort to participants who *might* have voted commit
-            # (or if we just failed to reach them)
-            try:
-                print(f"[Coordinator: {tx_id}] Sending GlobalAbort to {name}")
-                stub.GlobalAbort(abort_args, timeout=2.0)
-            except grpc.RpcError as e:
-                print(f"[Coordinator: {tx_id}] GlobalAbort failed for {name}: {e.details()}")
+            yield f"event: status\ndata: {json.dumps({'transaction_id': tx_id, **data})}\n\n"
+            while data.get("status") == "pending" and loop.time() < deadline:
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=deadline - loop.time())
+                if msg is not None:
+                    data = await ar.hgetall(key)
+                    yield f"event: status\ndata: {json.dumps({'transaction_id': tx_id, **data})}\n\n"
+        finally:
+            await pubsub.aclose()
 
-        raise HTTPException(status_code=500, detail="Transaction aborted by a participant")
\ No newline at end of file
+    return StreamingResponse(stream(data), media_type="text/event-stream")
@@ -0,0 +1,62 @@
+# soak_2pc.py  (run while the microservice stack is up)
+# Drives many full ride cycles through the gateway and samples the trip service's open
+# file descriptors, which must stay flat now that participant channels are pooled.
+import time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_URL = "http://localhost:8000"
+TRIP_URL = "http://localhost:8004"
+COMPLETIONS = 100_000
+WORKERS = 16
+SAMPLE_EVERY = 2_000
+MAX_FD_GROWTH = 20
+
+
+def open_fds():
+    return requests.get(f"{TRIP_URL}/participants", timeout=5).json()["open_fds"]
+
+
+def worker(idx: int, n: int):
+    # Each worker owns one driver parked in its own region so the matcher picks it.
+    s = requests.Session()
+    driver, rider = f"soak_d{idx}_{uuid.uuid4().hex[:6]}", f"soak_r{idx}_{uuid.uuid4().hex[:6]}"
+    lat, lon = 10.0 + idx, 10.0
+    s.post(f"{BASE_URL}/auth/register", json={"user_id": driver, "role": "driver"})
+    s.post(f"{BASE_URL}/auth/register", json={"user_id": rider, "role": "rider"})
+    ok = 0
+    for _ in range(n):
+        s.post(f"{BASE_URL}/drivers/location", json={"driver_id": driver, "lat": lat, "lon": lon, "available": True})
+        r = s.post(f"{BASE_URL}/rides/request", json={"rider_id": rider, "pickup_lat": lat, "pickup_lon": lon,
+                                                      "dest_lat": lat + 0.01, "dest_lon": lon + 0.01})
+        if r.status_code != 200:
+            continue
+        ride_id = r.json()["ride_id"]
+        s.post(f"{BASE_URL}/trips/{ride_id}/start")
+        ok += s.post(f"{BASE_URL}/trips/{ride_id}/complete").status_code == 200
+    return ok
+
+
+def main():
+    baseline = open_fds()
+    print(f"open fds at start: {baseline}")
+    per_chunk = SAMPLE_EVERY // WORKERS
+    done, samples = 0, [baseline]
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=WORKERS) as ex:
+        while done < COMPLETIONS:
+            ok = sum(ex.map(worker, range(WORKERS), [per_chunk] * WORKERS))
+            if ok == 0:
+                raise SystemExit("no completions succeeded; is the stack up?")
+            done += ok
+            samples.append(open_fds())
+            rate = done / (time.time() - t0)
+            print(f"completions: {done}  rate: {rate:.1f}/s  open fds: {samples[-1]}")
+    growth = max(samples) - baseline
+    print(f"fd samples: min={min(samples)} max={max(samples)} growth={growth}")
+    print("PASSED: fd count stayed flat" if growth <= MAX_FD_GROWTH else "FAILED: fd count grew")
+
+
+if __name__ == "__main__":
+    main()
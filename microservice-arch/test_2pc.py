@@ -3,6 +3,8 @@ import redis
 import uuid
 import time
 
+from services.common.geoshard import CELLS_KEY, geo_key
+
 # --- CONFIG ---
 BASE_URL = "http://localhost:8000"
 REDIS_HOST = "localhost"
@@ -112,7 +114,11 @@ def test_ride_completion():
         # Cleanup
         print_status("Cleaning up test data...")
         r.delete(ride_key, f"user:{driver_id}", f"user:{rider_id}")
-        r.zrem("drivers:geo", driver_id)
+        cell = r.hget(CELLS_KEY, driver_id)
+        if cell:
+            r.zrem(geo_key(cell), driver_id)
+        r.hdel(CELLS_KEY, driver_id)
+        r.zrem("drivers:seen", driver_id)
         r.srem("drivers:available", driver_id)
         print_check("Cleanup complete.")
 
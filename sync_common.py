@@ -0,0 +1,45 @@
+"""Keep the modules shared by the two designs identical.
+
+Each design builds and runs from its own directory (its own Dockerfile and compose
+build context), so the shared modules are vendored into both trees:
+microservice-arch/services/common holds the source, layered-arch/layered/common the
+copy. They import one another relatively, so the same file works in either package and
+reads its settings from the environment.
+
+    python sync_common.py           copy the source modules over the layered copies
+    python sync_common.py --check   exit 1 if a copy differs from its source
+"""
+import filecmp
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(ROOT, "microservice-arch", "services", "common")
+COPY = os.path.join(ROOT, "layered-arch", "layered", "common")
+SHARED = [
+    "archive.py", "geoshard.py", "history.py", "idalloc.py", "locwire.py", "readcache.py",
+    "ride_events.py", "ridecodec.py", "ridestate.py", "tokens.py", "usercache.py",
+]
+
+
+def drifted():
+    return [name for name in SHARED
+            if not os.path.exists(os.path.join(COPY, name))
+            or not filecmp.cmp(os.path.join(SOURCE, name), os.path.join(COPY, name), shallow=False)]
+
+
+def main(argv):
+    stale = drifted()
+    if "--check" in argv:
+        for name in stale:
+            print(f"layered-arch/layered/common/{name} differs from microservice-arch/services/common/{name}")
+        return 1 if stale else 0
+    for name in stale:
+        shutil.copyfile(os.path.join(SOURCE, name), os.path.join(COPY, name))
+        print(f"updated layered-arch/layered/common/{name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))